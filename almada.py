@@ -6,15 +6,25 @@
 # Philip Blackwell September 2009
 
 import sys, os
+import errno
+import signal
 import logging
 import select
+import socket
 
-from Almada.location_server import LocationServer
+from Almada.clock import shared_clock as clock
+from Almada.location_server import LocationServer, LocationServerGroup, Coalescer, merge_batches
 from Almada.lat_backend import LatServer
 from Almada.config import Config, ConfigError, DEFAULT_RTLS_URL
 from Almada.infield_device_server import InfieldDeviceServer
+from Almada.log_writer import LogWriter
+from Almada.capture import CaptureWriter
+from Almada.reconnect import Reconnector
+from Almada.load_shedding import new_load_shedder
+from Almada.stats import shared_stats as stats, StatsServer
 try:
     from Almada.location.locmod import new_locmod
+    from Almada.location.locmod_pool import LocModPool
 except:
     logging.critical("Error importing locmod!")
     
@@ -23,67 +33,161 @@ class AlmadaServer(object):
     Interface between Nanotron Location Server, LAT Backend, and Infield Devices.
     """
     
-    def __init__(self, locmod, location_server, experiment=None, lat_server=None, infield_device_server=None):
+    max_update_delay = 0.5 # The longest we'll put off a location update while readings keep arriving.
+    
+    def __init__(self, locmod, location_server, experiment=None, lat_server=None, infield_device_server=None, stats_server=None, load_shedder=None):
         """
         locmod - LocMod
-        location_server - Interface to the location server
+        location_server - Interface to the location server (or a LocationServerGroup for several)
         experiment - Experiment database to record to, if any.
         lat_server - Interface to the LAT backend
         infield_device_server - Interface to the infield devices
+        stats_server - StatsServer to serve the processing stats on, if any.
+        load_shedder - LoadShedder to drop readings when overloaded, if any (before the locmod, after recording).
         """
 
         super(AlmadaServer, self).__init__()
         
-        self.location_server = location_server
+        if location_server and not isinstance(location_server, LocationServerGroup):
+            location_server = LocationServerGroup([location_server])
+        self.location_servers = location_server
         self.experiment = experiment
         self.infield_device_server = infield_device_server
         self.lat_server = lat_server
+        self.stats_server = stats_server
+        self.load_shedder = load_shedder
         self.locmod = locmod
+        
+        self.update_pending = False # Whether there are readings that haven't been through the locmod yet.
+        self.workers_requested = 0 # LocModPool workers to add, once no update is in progress (see request_worker).
+        self.last_update_time = 0.0
+        self.coalescer = Coalescer()
+        
+        # Keep the connections to the location servers and LAT backend up.
+        self.reconnectors = {} # connection -> Reconnector
+        if self.location_servers:
+            for location_server in self.location_servers.location_servers:
+                name = "location server at %s:%d" % (location_server.hostname, location_server.port)
+                self.reconnectors[location_server] = Reconnector(location_server, name)
+        if self.lat_server:
+            name = "LAT backend server at %s:%d" % (self.lat_server.hostname, self.lat_server.port)
+            self.reconnectors[self.lat_server] = Reconnector(self.lat_server, name)
                  
+    def link_states(self):
+        "A dictionary of the state (LinkState) of each connection, by name."
+        
+        return dict((reconnector.name, reconnector.state) for reconnector in self.reconnectors.values())
+        
     def most_recent(self, readings):
         """
-        Take a list of readings from the location server, and return only the most recent from each pair.
+        Take a batch of readings from the location server, and return only the most recent from each pair.
         
         We would prefer to drop a few measurements than to get further and further behind real time.
         """
         
-        if not readings:
-            return []
+        with stats.timer("most_recent", len(readings)):
+            return self.coalescer.coalesce(readings)
+                        
+    def finish(self):
+        "Finalise everything before termination"
+        
+        if self.experiment:
+            self.experiment.stop_recording()
+            self.experiment.create_indexes()
+            self.experiment.append_ground_truth_distances()
+                        
+    def ingest(self, sockets):
+        "Take in the readings waiting on the location servers (given their readable sockets). Leave the location update for later."
+        
+        batches = []
+        for location_server in self.location_servers.ready(sockets):
+            try:
+                batches.append(location_server.new_reading_batch())
+            except socket.error, e:
+                self.reconnectors[location_server].lost(e)
+        readings = merge_batches(batches)
+        stats.count_readings(readings.tag_ids)
+        readings = self.most_recent(readings)
+        if self.experiment:
+            with stats.timer("experiment", len(readings)):
+                self.experiment.add_readings(readings)
+        if self.load_shedder:
+            readings = self.load_shedder.shed(readings, self.coalescer.backlog())
+        if self.locmod:
+            self.locmod.add_readings(readings)
             
-        # Readings come in order of tag ID then anchor ID.
-        # We expect to see decreasing tag IDs as we read back from the end.
-        # As soon as we see the tag ID increase (or the anchor ID increase, in the case of a single tag), we know it is an older set of measurements.
-        # Keep only the most recent.
+        self.update_pending = True
         
-        i = len(readings) - 1
-        tag_id = readings[i].tag_id
-        anchor_id = readings[i].anchor_id
-        tag_ids = set([tag_id])
-        while i > 0:
-            reading = readings[i - 1]
-            if reading.tag_id > tag_id:
-                break
-            elif reading.tag_id == tag_id and reading.anchor_id > anchor_id:
-                break
-                
-            tag_id = reading.tag_id
-            tag_ids.add(tag_id)
-            anchor_id = reading.anchor_id
-            i -= 1
+    def locmod_pool(self):
+        "Is the locmod a LocModPool (updated asynchronously)?"
+        return self.locmod != None and isinstance(self.locmod, LocModPool)
+
+    def locmod_busy(self):
+        "Is there a location update still being worked on?"
+        return self.locmod_pool() and self.locmod.update_pending()
+        
+    def request_worker(self, *args):
+        "Ask for another LocModPool worker, added from the loop (so this can be a signal handler: SIGUSR1)."
         
-        if i > 0:
-            logging.warning("Discarding %d old readings from location server (keeping %d)" % (i, len(readings) - i))
-            logging.info("Keeping measurements from tag_ids: %s" % str(tag_ids))
+        if self.locmod_pool():
+            self.workers_requested += 1
         else:
-            logging.info("Keeping all readings from location_server: tag_ids: %s" % str(tag_ids))
+            logging.warning("Not adding a LocMod worker: the location updates aren't done by a pool (-w).")
+            
+    def add_requested_workers(self):
+        "Add any LocModPool workers asked for, rebalancing the tags over them."
         
-        return readings[i:]
-                        
-    def finish(self):
-        "Finalise everything before termination"
+        while self.workers_requested and not self.locmod_busy():
+            self.workers_requested -= 1
+            self.locmod.add_worker()
         
-        self.experiment.append_ground_truth_distances()
+    def update_locations(self):
+        "Estimate the tag locations from the readings so far, and pass them on."
+        
+        self.update_pending = False
+        self.last_update_time = clock.get_time()
+        
+        if not self.locmod:
+            self.coalescer.processed()
+            return
+
+        if self.locmod_pool():
+            # The results are passed on as they come back (see collect_locations).
+            self.locmod.request_update()
+            return
+            
+        tag_locations = self.locmod.update_locations()
+        self.coalescer.processed()
+        self.publish_locations(tag_locations)
+
+    def collect_locations(self, readers):
+        "Pass on the tag locations from the LocModPool workers that have finished (given their readable connections)."
+
+        tag_locations = self.locmod.collect(readers)
+        if not self.locmod.update_pending():
+            self.coalescer.processed()
+        self.publish_locations(tag_locations)
+
+    def publish_locations(self, tag_locations):
+        "Send tag locations to the LAT backend, and record them."
+
+        reading_times = {}
+        if stats.tracing() and hasattr(self.locmod, "reading_times"):
+            reading_times = self.locmod.reading_times(tag_locations.keys())
+
+        if self.lat_server:
+            try:
+                with stats.timer("lat_send", len(tag_locations)):
+                    self.lat_server.send_tag_updates(tag_locations, reading_times)
+            except socket.error, e:
+                self.reconnectors[self.lat_server].lost(e)
                         
+        if self.experiment:
+            with stats.timer("experiment", len(tag_locations)):
+                for tag_id, location in tag_locations.iteritems():
+                    x, y = location
+                    self.experiment.add_estimate(tag_id, x, y)
+                
     def loop(self):
         """
         Service loop. Runs forever.
@@ -91,50 +195,108 @@ class AlmadaServer(object):
         Take in readings from the location server.
         Push tag locations to the LAT backend.
         Service infield device clients.
+        
+        Nothing in the loop blocks: the LAT backend and infield devices are sent to from buffers as their sockets become writable.
+        Location updates are only done once there are no more readings waiting (or after max_update_delay),
+        so a slow update never holds up taking in the next batch of readings.
         """
         
-        sockets = [self.location_server.socket]
-        if self.infield_device_server:
-            sockets.append(self.infield_device_server.socket)
-        self.clients = []
+        self.update_pending = False
+        self.last_update_time = clock.get_time()
         
         while True:
             
-            (readers, writers, exceptors) = select.select(sockets + self.infield_device_server.clients, [], [], 0.1)
+            # Any lost connections are retried (with backoff) here, without waiting for them to connect:
+            # sockets still connecting are selected on for writing, and finished once writable.
+            connecting = {} # socket -> Reconnector
+            for reconnector in self.reconnectors.values():
+                reconnector.poll()
+                if reconnector.writer():
+                    connecting[reconnector.writer()] = reconnector
+            
+            if self.location_servers:
+                location_server_sockets = self.location_servers.sockets()
+            else:
+                location_server_sockets = []
+                
+            readers = list(location_server_sockets)
+            writers = connecting.keys()
+            if self.infield_device_server:
+                readers.append(self.infield_device_server.socket)
+                readers += self.infield_device_server.clients
+                writers += self.infield_device_server.writers()
+            if self.lat_server and self.lat_server.connected() and self.lat_server.wants_write():
+                writers.append(self.lat_server.socket)
+            if self.stats_server:
+                readers.append(self.stats_server.socket)
+            locmod_readers = []
+            if self.locmod_pool():
+                locmod_readers = self.locmod.readers()
+                readers += locmod_readers
+            
+            # Don't wait if there is an update to do.
+            if self.update_pending and not self.locmod_busy():
+                timeout = 0.0
+            else:
+                timeout = 0.1
+            
+            try:
+                (readers, writers, exceptors) = select.select(readers, writers, [], timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR: # A signal (see request_worker).
+                    continue
+                raise
+            
+            for writer in writers:
+                if writer in connecting:
+                    connecting[writer].ready()
+                elif self.lat_server and writer == self.lat_server.socket:
+                    try:
+                        self.lat_server.send_pending()
+                    except socket.error, e:
+                        self.reconnectors[self.lat_server].lost(e)
+                else:
+                    self.infield_device_server.send_pending(writer)
+            
+            location_server_readers = [reader for reader in readers if reader in location_server_sockets]
+            if location_server_readers:
+                self.ingest(location_server_readers)
+
+            ready_locmod_readers = [reader for reader in readers if reader in locmod_readers]
+            if ready_locmod_readers:
+                self.collect_locations(ready_locmod_readers)
             
             for reader in readers:
                             
-                if reader == self.infield_device_server.socket:
+                if self.infield_device_server and reader == self.infield_device_server.socket:
                     self.infield_device_server.accept_client()
                     
-                elif reader == self.location_server.socket:
+                elif self.stats_server and reader == self.stats_server.socket:
+                    self.stats_server.accept_client()
                     
-                    readings = self.location_server.new_readings()
-                    readings = self.most_recent(readings)
-                    for reading in readings:
-                        if locmod:
-                            self.locmod.add_reading(reading.anchor_id, reading.tag_id, reading.distance)
-                        if self.experiment:
-                            self.experiment.add_reading(reading.anchor_id, reading.tag_id, reading.distance)
-                    
-                    if self.locmod:
-                        tag_locations = self.locmod.update_locations()
-
-                        if self.lat_server:
-                            self.lat_server.send_tag_updates(tag_locations)
-                                        
-                        if self.experiment:
-                            for tag_id, location in tag_locations.iteritems():
-                                x, y = location
-                                self.experiment.add_estimate(tag_id, x, y)
+                elif reader in location_server_sockets or reader in locmod_readers:
+                    continue
                               
                 else:
                     self.infield_device_server.service_client(reader)
             
+            # With a LocModPool, the next update waits for the last one to come back (ingest carries on meanwhile).
+            self.add_requested_workers()
+            if self.update_pending and not self.locmod_busy():
+                overdue = clock.get_time() - self.last_update_time > self.max_update_delay
+                if overdue or not location_server_readers:
+                    self.update_locations()
+                    
+            if self.location_servers:
+                self.location_servers.report()
+            self.coalescer.report()
+            if self.load_shedder:
+                self.load_shedder.report()
             
 if __name__ == "__main__":
     
     from experiment.experiment_db import new_experiment
+    from experiment.partitioned_experiment import PartitionedExperiment, partition_periods
     
     ##############################
     # Command line options.
@@ -155,8 +317,26 @@ if __name__ == "__main__":
                               help="The arena ID to use for RTLS server config.")
     option_parser.add_option("-e", "--experiment", dest="experiment", default="experiment.db",
                              help="The experiment database to record t.")
+    option_parser.add_option("-P", "--partition", dest="partition", type="choice", choices=sorted(partition_periods.keys()),
+                             help="Record the experiment as a directory of databases, a new one each hour or day (carrying on if it exists).")
+    option_parser.add_option("-A", "--archive_after", dest="archive_after", type="float",
+                             help="With --partition, archive (compress) the experiment databases once they're this many days old.")
     option_parser.add_option("-L", "--location_log", dest="location_log",
                              help="The file to log location_server output to.")
+    option_parser.add_option("-z", "--location_log_compression", dest="location_log_compression",
+                             help="Compress the location_server log (gzip or zstd).")
+    option_parser.add_option("-s", "--location_log_max_size", dest="location_log_max_size", type="float",
+                             help="Rotate the location_server log after this many megabytes.")
+    option_parser.add_option("-t", "--location_log_max_age", dest="location_log_max_age", type="float",
+                             help="Rotate the location_server log after this many hours.")
+    option_parser.add_option("-k", "--capture", dest="capture",
+                             help="The file to capture location_server readings to (binary, for replay).")
+    option_parser.add_option("-w", "--locmod_workers", dest="locmod_workers", type="int", default=0,
+                             help="Run the location updates in this many worker processes (default=%default: in process). Send SIGUSR1 to add another.")
+    option_parser.add_option("-S", "--stats_port", dest="stats_port", type="int",
+                             help="Serve the processing stats on this (local) TCP port.")
+    option_parser.add_option("-T", "--trace_sample", dest="trace_sample", type="float", default=0.0,
+                             help="Trace the age of this fraction of the positions sent to the LAT backend (default=%default).")
     option_parser.add_option("-l", "--log_level", dest="log_level", type="int",
                              help="The log level.", default=0)
     option_parser.add_option("-o", "--log_file", dest="log_file",
@@ -165,6 +345,7 @@ if __name__ == "__main__":
                              help="The working directory for the above files")
 
     options, args = option_parser.parse_args()
+    stats.trace_sample_rate = options.trace_sample
 
     # Get the right working dir, ensure it's a valid directory.
     if options.working_dir:
@@ -206,33 +387,62 @@ if __name__ == "__main__":
     # Only have the location server output logged if a working directory was specified.
     if options.working_dir and options.location_log:
         filename = os.path.join(working_dir, options.location_log)
-        location_server_log = open(filename, "w")
+        max_bytes, max_age = None, None
+        if options.location_log_max_size:
+            max_bytes = int(options.location_log_max_size * 1024 * 1024)
+        if options.location_log_max_age:
+            max_age = options.location_log_max_age * 3600
+        try:
+            location_server_log = LogWriter(filename, options.location_log_compression, max_bytes, max_age)
+        except Exception, e:
+            sys.exit("Error opening location server log: %s" % str(e))
     else:
         location_server_log = None
+
+    # Likewise for the binary capture.
+    if options.working_dir and options.capture:
+        try:
+            capture = CaptureWriter(os.path.join(working_dir, options.capture))
+        except Exception, e:
+            sys.exit("Error opening capture: %s" % str(e))
+    else:
+        capture = None
         
-    # Load the location server. There's little point continuing if this fails.
+    # Load the location servers. There's little point continuing if these fail.
     # But we will for if we just want to test the infield devices.
-    try:
-        location_server = LocationServer(anchor_ids, 
-                                         hostname=config.location_server_hostname, 
-                                         port=config.location_server_port, 
-                                         logfile=location_server_log)
-        location_server.connect()
-    except Exception, e:
-        logging.critical("Error connecting to location server: %s" % str(e))
-        location_server = None
+    # Any that fail to connect are kept, and retried from the AlmadaServer loop.
+    location_server_addresses = config.location_servers
+    if not location_server_addresses:
+        location_server_addresses = [(config.location_server_hostname, config.location_server_port, None)]
+    location_servers = []
+    for hostname, port, server_anchor_ids in location_server_addresses:
+        if server_anchor_ids == None:
+            server_anchor_ids = anchor_ids
+        try:
+            location_server = LocationServer(server_anchor_ids, 
+                                             hostname=hostname, 
+                                             port=port, 
+                                             logfile=location_server_log,
+                                             capture=capture)
+            location_server.connect()
+        except Exception, e:
+            logging.critical("Error connecting to location server %s:%d: %s" % (hostname, port, str(e)))
+        location_servers.append(location_server)
+    location_server = LocationServerGroup(location_servers)
         
-    # Try to load the LAT backend server. Non-essential.
+    # Try to load the LAT backend server. Non-essential (retried from the AlmadaServer loop if it fails).
+    lat_server = LatServer(config.lat_server_hostname, config.lat_server_port)
     try:
-        lat_server = LatServer(config.lat_server_hostname, config.lat_server_port)
         lat_server.connect()
     except:
         logging.critical("Error connecting to LAT backend server at %s:%d" % (lat_server.hostname, lat_server.port))
-        lat_server = None
     
     # Load the LocMod. Not necessary for just collecting measurements.
     try:
-        locmod = new_locmod(config)
+        if options.locmod_workers:
+            locmod = LocModPool(config, options.locmod_workers)
+        else:
+            locmod = new_locmod(config)
     except Exception, e:
         logging.critical("Error loading location module: %s" % str(e))
         locmod = None
@@ -240,12 +450,21 @@ if __name__ == "__main__":
     # Only create the experiment database if a working directory was specified.
     if options.working_dir:
         experiment_filename = os.path.join(working_dir, options.experiment)
-        if os.path.exists(experiment_filename):
-            sys.exit("Experiment file (%s) already exists" % (experiment_filename))
-        experiment = new_experiment(experiment_filename)
+        if options.partition:
+            archive_after = None
+            if options.archive_after:
+                archive_after = options.archive_after * 86400
+            experiment = PartitionedExperiment(experiment_filename, options.partition, archive_after)
+        else:
+            if os.path.exists(experiment_filename):
+                sys.exit("Experiment file (%s) already exists" % (experiment_filename))
+            experiment = new_experiment(experiment_filename, indexes=False) # The indexes are built in finish.
     
         for anchor_id, location in config.anchors.items():
             experiment.add_anchor(anchor_id, location)
+            
+        # Readings and estimates are written in groups, from a background thread.
+        experiment.start_recording()
     
         # Specify a limited subset of reference points to give out in order in a file called "reference_points.txt"
         # FIXME: Make reference point sequences configurable, and/or less of a hack.
@@ -271,12 +490,32 @@ if __name__ == "__main__":
         experiment = None
         infield_device_server = None
 
+    # The stats server is optional, and only local.
+    stats_server = None
+    if options.stats_port:
+        stats_server = StatsServer(options.stats_port)
+        try:
+            stats_server.connect()
+        except socket.error, e:
+            logging.critical("Error starting stats server on port %d: %s" % (options.stats_port, str(e)))
+            stats_server = None
+
     logging.info("Starting Almada Server")
-    almada_server = AlmadaServer(locmod, location_server, experiment, lat_server, infield_device_server)
+    almada_server = AlmadaServer(locmod, location_server, experiment, lat_server, infield_device_server, stats_server,
+                                 new_load_shedder(config))
+    
+    # With the location updates in worker processes, 'kill -USR1' adds another worker (and rebalances the tags).
+    signal.signal(signal.SIGUSR1, almada_server.request_worker)
 
     try:
         almada_server.loop()
     except KeyboardInterrupt:
         print "Quitting momentarily, just need to clean up a bit."
-        experiment.append_ground_truth_distances()
+        if location_server_log:
+            location_server_log.close()
+        if capture:
+            capture.close()
+        if locmod and options.locmod_workers:
+            locmod.close()
+        almada_server.finish()
         sys.exit()
@@ -0,0 +1,210 @@
+"""
+A compact binary capture of the readings from the location server(s).
+
+The capture file is a short header followed by fixed size records (capture_dtype), appended in the order they were received:
+  timestamp, tag_id, anchor_id, distance, error_code
+Readings with error codes are kept, so the capture is a full record of what the location server sent.
+
+Alongside, a block index (<filename>.idx) holds the timestamp and record number of the start of each block of records,
+so a time range can be found without touching the records themselves. (It is rebuilt from the records if missing.)
+
+Reading a capture memory maps the file, so any part of it can be accessed at random,
+and several processes can share the same pages.
+
+Unlike the text location server log, a capture can be replayed directly (by FakeServer, or run_experiment),
+with no need to build an experiment database first.
+"""
+
+import os
+import struct
+import logging
+
+import numpy
+
+from Almada.location_server import ReadingBatch, reading_dtype
+
+capture_dtype = numpy.dtype([("timestamp", "<f8"),
+                             ("tag_id", "<i4"),
+                             ("anchor_id", "<i4"),
+                             ("distance", "<f8"),
+                             ("error_code", "<i4")])
+
+index_dtype = numpy.dtype([("timestamp", "<f8"),
+                           ("record", "<i8")])
+
+# Header: magic, record size, block size (records per index entry).
+header_magic = "ALMCAP01"
+header_format = "<8sII"
+header_size = struct.calcsize(header_format)
+
+DEFAULT_BLOCK_SIZE = 4096
+
+def index_filename(filename):
+    return filename + ".idx"
+
+def build_index(records, block_size):
+    "The block index for the given records."
+
+    starts = numpy.arange(0, len(records), block_size)
+    index = numpy.zeros(len(starts), dtype=index_dtype)
+    index["timestamp"] = records["timestamp"][starts]
+    index["record"] = starts
+    return index
+
+def read_header(f):
+    "The block size from the header of an open capture file."
+
+    magic, record_size, block_size = struct.unpack(header_format, f.read(header_size))
+    if magic != header_magic:
+        raise Exception("Not a capture file (bad header)")
+    if record_size != capture_dtype.itemsize:
+        raise Exception("Unexpected record size in capture file: %d" % record_size)
+    return block_size
+
+class CaptureWriter(object):
+    """Append readings to a capture file (creating it if necessary)."""
+
+    def __init__(self, filename, block_size=DEFAULT_BLOCK_SIZE):
+        super(CaptureWriter, self).__init__()
+
+        self.filename = filename
+
+        if os.path.exists(filename):
+            f = open(filename, "rb")
+            block_size = read_header(f)
+            f.close()
+
+            # Drop any partial record left by an interrupted write.
+            size = os.path.getsize(filename) - header_size
+            self.record_count = size // capture_dtype.itemsize
+            self.file = open(filename, "r+b")
+            self.file.truncate(header_size + self.record_count * capture_dtype.itemsize)
+            self.file.seek(0, os.SEEK_END)
+
+            # Make sure the index is up to date with the records.
+            build_index(Capture(filename).records, block_size).tofile(index_filename(filename))
+        else:
+            self.file = open(filename, "wb")
+            self.file.write(struct.pack(header_format, header_magic, capture_dtype.itemsize, block_size))
+            self.record_count = 0
+            open(index_filename(filename), "wb").close()
+
+        self.block_size = block_size
+        self.index_file = open(index_filename(filename), "ab")
+
+    def write(self, readings):
+        "Append an array of readings (reading_dtype, or a ReadingBatch)."
+
+        if isinstance(readings, ReadingBatch):
+            readings = readings.array
+        if not len(readings):
+            return
+
+        records = numpy.zeros(len(readings), dtype=capture_dtype)
+        for name in capture_dtype.names:
+            records[name] = readings[name]
+
+        # Index entries for any blocks that start within these records.
+        first = self.record_count
+        starts = numpy.arange(-first % self.block_size, len(records), self.block_size)
+        if len(starts):
+            index = numpy.zeros(len(starts), dtype=index_dtype)
+            index["timestamp"] = records["timestamp"][starts]
+            index["record"] = first + starts
+            self.index_file.write(index.tostring())
+            self.index_file.flush()
+
+        self.file.write(records.tostring())
+        self.file.flush()
+        self.record_count += len(records)
+
+    def close(self):
+        self.file.close()
+        self.index_file.close()
+
+class Capture(object):
+    """A memory mapped capture file, for reading."""
+
+    def __init__(self, filename):
+        super(Capture, self).__init__()
+
+        self.filename = filename
+        f = open(filename, "rb")
+        self.block_size = read_header(f)
+        f.close()
+
+        count = (os.path.getsize(filename) - header_size) // capture_dtype.itemsize
+        if count:
+            self.records = numpy.memmap(filename, dtype=capture_dtype, mode="r", offset=header_size, shape=(count,))
+        else:
+            self.records = numpy.zeros(0, dtype=capture_dtype)
+
+        self.index = self.load_index()
+
+    def load_index(self):
+        "The block index from file, or rebuilt from the records if it's missing or out of date."
+
+        expected = (len(self.records) + self.block_size - 1) // self.block_size
+        filename = index_filename(self.filename)
+        if os.path.exists(filename):
+            index = numpy.fromfile(filename, dtype=index_dtype)
+            if len(index) == expected:
+                return index
+        logging.warning("Rebuilding block index for capture: %s" % self.filename)
+        return build_index(self.records, self.block_size)
+
+    def __len__(self):
+        return len(self.records)
+
+    def time_range(self):
+        "The first and last timestamps in the capture."
+
+        if not len(self.records):
+            return None
+        return self.records["timestamp"][0], self.records["timestamp"][-1]
+
+    def first_record_at(self, timestamp):
+        "The number of the first record with a timestamp at or after the given one."
+
+        # Find the last block starting before the timestamp (using the index), then search within it and the next.
+        block = max(numpy.searchsorted(self.index["timestamp"], timestamp, side="left") - 1, 0)
+        offset = block * self.block_size
+        block_timestamps = self.records["timestamp"][offset:offset + 2 * self.block_size]
+        return offset + numpy.searchsorted(block_timestamps, timestamp, side="left")
+
+    def record_range(self, start_time=None, end_time=None):
+        "The range (first, last + 1) of the records with start_time <= timestamp < end_time."
+
+        first, last = 0, len(self.records)
+        if start_time != None:
+            first = self.first_record_at(start_time)
+        if end_time != None:
+            last = self.first_record_at(end_time)
+
+        return first, max(first, last)
+
+    def batches(self, start_time=None, end_time=None, batch_size=10000, errors=False):
+        "ReadingBatches of the records between the given times (without readings with errors, unless 'errors')."
+
+        first, last = self.record_range(start_time, end_time)
+        for i in range(first, last, batch_size):
+            records = self.records[i:min(i + batch_size, last)]
+            array = numpy.zeros(len(records), dtype=reading_dtype)
+            for name in capture_dtype.names:
+                array[name] = records[name]
+            if not errors:
+                array = array[array["error_code"] == 0]
+            yield ReadingBatch(array)
+
+    def readings(self, start_time=None, end_time=None):
+        "An iterator of (anchor_id, tag_id, distance, timestamp) tuples, like the rows of the distance_reading table."
+
+        for batch in self.batches(start_time, end_time):
+            for row in batch.rows("anchor_id", "tag_id", "distance", "timestamp"):
+                yield row
+
+def load_capture(filename):
+    "Load a capture for reading, if it exists."
+
+    if os.path.exists(filename):
+        return Capture(filename)
@@ -43,6 +43,7 @@ class Config(object):
         
         self.location_server_hostname = ""
         self.location_server_port = 6868
+        self.location_servers = [] # (hostname, port, anchor_ids) for each LocationServer line. anchor_ids None means all.
         
         self.lat_server_hostname = ""
         self.lat_server_port = 9292
@@ -61,6 +62,7 @@ class Config(object):
         self.position_filter = {}
         self.location_engine = {}
         self.particle_filter = {}
+        self.load_shedding = {} # See load_shedding.new_load_shedder
                         
         # The filename, and contents of the configuration files used
         self.filename = ""
@@ -125,15 +127,40 @@ class Config(object):
                     self.reference_points[name] = location
                 
                 elif label.lower() == "locationserver":
+                    # Optionally followed by the anchors it covers, eg: LocationServer: host, 6868; 1, 2, 3
+                    if ";" in config:
+                        config, anchor_ids = config.split(";")
+                        anchor_ids = map(int, anchor_ids.split(","))
+                    else:
+                        anchor_ids = None
                     hostname, port = config.split(",")
-                    self.location_server_hostname = hostname.strip()
-                    self.location_server_port = int(port)
+                    if not self.location_servers:
+                        self.location_server_hostname = hostname.strip()
+                        self.location_server_port = int(port)
+                    self.location_servers.append((hostname.strip(), int(port), anchor_ids))
 
                 elif label.lower() == "latserver":
                     hostname, port = config.split(",")
                     self.lat_server_hostname = hostname.strip()
                     self.lat_server_port = int(port)
                     
+                elif label.lower() == "prioritytag":
+                    # Never shed readings from this tag.
+                    self.load_shedding.setdefault("priority_tag_ids", []).append(int(config))
+
+                elif label.lower() == "tagratecap":
+                    # Readings per second from any one tag, optionally followed by the burst allowed, eg: TagRateCap: 20; 40
+                    if ";" in config:
+                        config, burst = config.split(";")
+                        self.load_shedding["tag_burst"] = float(burst)
+                    self.load_shedding["tag_rate"] = float(config)
+
+                elif label.lower() == "maxbatch":
+                    self.load_shedding["max_readings"] = int(config)
+
+                elif label.lower() == "maxlag":
+                    self.load_shedding["max_lag"] = float(config)
+
                 elif label.lower() in ["min_x", "max_x", "min_y", "max_y"]:
                     value = float(config)
                     self.__setattr__(label.lower(), value)
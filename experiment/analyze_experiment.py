@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 #
 # Analyze the results of an experiment, for one or many particular configurations.
+# Each experiment is a database file, or the directory of a partitioned experiment.
 #
 # Philip Blackwell October 2009
 
 import os, sys
+import json
 import logging
 import pickle
 from optparse import OptionParser
@@ -14,6 +16,7 @@ import numpy
 
 from Almada.config import Config
 from Almada.experiment.experiment_db import load_experiment
+from Almada.experiment.partitioned_experiment import PartitionedExperiment, manifest_filename
 from RTLS.PyFrontend.rtls_interface import RTLS
      
 def count_walls_between(rtls_interface, experiment, arena_id=1):
@@ -63,27 +66,23 @@ def dump_error_histogram(experiment, histogram_filename="error_histogram.pickle"
     pickle.dump((p, bins), open(histogram_filename, "w"))
     
 def distance_versus_ground_truth(experiment, tag_id=None, anchor_id=None, ground_truth_id=None):
+    "Arrays of the distance readings and their ground truth distances (where known), in order of ground truth distance."
     
-    sql = "SELECT distance, ground_truth_distance FROM distance_reading WHERE ground_truth_id IS NOT NULL"
+    readings = experiment.to_columns()["distance_reading"]
+    
+    selected = readings["ground_truth_id"] >= 0
     if tag_id:
-        sql += " AND tag_id = %d" % tag_id
+        selected &= readings["tag_id"] == tag_id
     if anchor_id:
-        sql += " AND anchor_id = %d" % anchor_id
+        selected &= readings["anchor_id"] == anchor_id
     if ground_truth_id:
-        sql += " AND ground_truth_id = %d" % ground_truth_id
-    sql += " ORDER BY ground_truth_distance"
-    
-    distance_readings = experiment.query(sql).fetchall() 
+        selected &= readings["ground_truth_id"] == ground_truth_id
     
-    # Arrays for distance and ground_truth
-    d, g = [], []
-    
-    for distance_reading in distance_readings:
-        distance, ground_truth_distance = distance_reading
-        d.append(distance)
-        g.append(ground_truth_distance)
+    d = readings["distance"][selected]
+    g = readings["ground_truth_distance"][selected]
+    order = numpy.argsort(g, kind="mergesort")
             
-    return d, g
+    return d[order], g[order]
     
 def analyze_distance_readings(experiment):
     "Much of the analysis is independent of any location algorithm: how did the raw distance reading compare with expected?"
@@ -107,18 +106,7 @@ def analyze_distance_readings(experiment):
         
         print "Ground truth %3d: %7s: %3d distance readings in %4.1f seconds" % (ground_truth_id, label, len(updates), duration)        
     
-    sql = "SELECT distance, ground_truth_distance FROM distance_reading WHERE ground_truth_id IS NOT NULL ORDER BY ground_truth_distance"
-    distance_readings = experiment.query(sql).fetchall()
-    
-    # Arrays for distance and ground_truth
-    d, g = [], []
-    
-    for distance_reading in distance_readings:
-        distance, ground_truth_distance = distance_reading
-        d.append(distance)
-        g.append(ground_truth_distance)
-            
-    return d, g
+    return distance_versus_ground_truth(experiment)
 
 def plot_moving_estimates(experiment, configuration_id, ground_truth_id):
     "A local line plot of all estimates (in order) for a particular ground truth."
@@ -140,8 +128,8 @@ def plot_moving_estimates(experiment, configuration_id, ground_truth_id):
     est_x = []
     est_y = []
     
-    sql = "SELECT x, y FROM estimate WHERE configuration_id = ? AND ground_truth_id = ? ORDER BY timestamp ASC"
-    for x, y in experiment.query(sql, (configuration_id, ground_truth_id)).fetchall():
+    estimates, timestamps, errors, error_sizes = experiment.ground_truth_estimate_info(configuration_id, ground_truth_id)
+    for x, y in estimates:
         est_x.append(x - bx)
         est_y.append(y - by)
     
@@ -264,12 +252,12 @@ def plot_percentile_errors(experiment, configuration_id, label=""):
     sql = "SELECT configuration_name, locmod_name FROM configuration WHERE id = %d" % configuration_id
     config_name, locmod_config_name = experiment.query(sql).fetchone()
   
-    sql = "SELECT error FROM estimate WHERE configuration_id = %d" % configuration_id
-    errors = [row["error"] for row in experiment.query(sql)]
+    estimates = experiment.to_columns()["estimate"]
+    errors = estimates["error"][estimates["configuration_id"] == configuration_id]
+    errors = numpy.sort(errors[~numpy.isnan(errors)]) # Estimates without ground truth have no error.
     
     print configuration_id, config_name, locmod_config_name, len(errors)
     
-    errors.sort()
     percentile = [float(i)/len(errors) for i in range(len(errors))]
                 
     pylab.plot(percentile, errors, label=label)
@@ -302,7 +290,12 @@ if __name__ == "__main__":
         backend_api = config.load_rtls()
     
     for i, experiment_filename in enumerate(args):
-        experiment = load_experiment(experiment_filename)    
+        if os.path.exists(os.path.join(experiment_filename, manifest_filename)):
+            manifest = json.load(open(os.path.join(experiment_filename, manifest_filename)))
+            experiment = PartitionedExperiment(experiment_filename, manifest["partition"])
+        else:
+            experiment = load_experiment(experiment_filename)    
+        experiment_filename = experiment_filename.rstrip(os.sep)
         experiment_dir, experiment_name = os.path.split(experiment_filename)
         
         configuration_ids = configuration_ids_by_experiment.get(i)
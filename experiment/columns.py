@@ -0,0 +1,140 @@
+"""
+A columnar copy of the experiment's main tables, for analysis.
+
+Each column of distance_reading, ground_truth and estimate is written to its own .npy file, in a directory next to
+the database (experiment.db -> experiment.db.columns/distance_reading.timestamp.npy, ...), and memory-mapped when loaded.
+So an analysis over millions of readings starts straight away, without going through SQLite a row at a time,
+and processes looking at the same experiment share the pages.
+
+The estimates are gathered from every configuration's estimate database (see schema.estimates_directory) as well.
+The copy is stamped with the size and modification time of the database (and its write-ahead log, and the estimate databases),
+and made afresh when they change. Missing values are NaN (REAL columns) or -1 (INTEGER columns).
+
+    columns = experiment.to_columns()
+    readings = columns["distance_reading"]
+    error = readings["distance"] - readings["ground_truth_distance"]
+"""
+
+import os
+import logging
+
+import numpy
+from numpy.lib.format import open_memmap
+
+from Almada.experiment import schema
+
+# The columns exported for each table, with their types.
+table_columns = {
+    "distance_reading": [("id", "i8"), ("anchor_id", "i8"), ("tag_id", "i8"), ("distance", "f8"), ("ground_truth_id", "i8"),
+                         ("ground_truth_distance", "f8"), ("ground_truth_error", "f8"), ("timestamp", "f8")],
+    "ground_truth": [("id", "i8"), ("tag_id", "i8"), ("start_time", "f8"), ("end_time", "f8"),
+                     ("start_x", "f8"), ("start_y", "f8"), ("end_x", "f8"), ("end_y", "f8")],
+    "estimate": [("id", "i8"), ("tag_id", "i8"), ("x", "f8"), ("y", "f8"), ("timestamp", "f8"),
+                 ("ground_truth_id", "i8"), ("error", "f8"), ("configuration_id", "i8")]}
+
+missing_values = {"i8": -1, "f8": numpy.nan}
+
+stamp_filename = "stamp"
+
+def columns_directory(database_filename):
+    return database_filename + ".columns"
+
+def database_stamp(database_filename):
+    "Identifies the state of the database: the size and modification time of its file, its write-ahead log if any, and its estimate databases."
+
+    filenames = [database_filename, database_filename + "-wal"]
+    directory = schema.estimates_directory(database_filename)
+    if os.path.exists(directory):
+        filenames += [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+
+    stamp = []
+    for filename in filenames:
+        if os.path.exists(filename):
+            status = os.stat(filename)
+            stamp.append("%s %d %.6f" % (os.path.basename(filename), status.st_size, status.st_mtime))
+    return "\n".join(stamp)
+
+def column_filename(directory, table, column):
+    return os.path.join(directory, "%s.%s.npy" % (table, column))
+
+def is_current(database_filename):
+    "Is there an export of the database, made since it last changed?"
+
+    filename = os.path.join(columns_directory(database_filename), stamp_filename)
+    if not os.path.exists(filename):
+        return False
+    return open(filename).read() == database_stamp(database_filename)
+
+def sources(experiment, table):
+    "The connections to the databases holding a table's rows, one at a time: for estimates, the main one and then each configuration's own."
+
+    yield experiment.connection
+    if table == "estimate":
+        for configuration_id in experiment.estimate_configuration_ids():
+            yield experiment.estimate_connection(configuration_id)
+
+def export_table(experiment, directory, table, chunk_size):
+    "Write the columns of a table to .npy files, a chunk of rows at a time."
+
+    columns = table_columns[table]
+    count = sum(source.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0] for source in sources(experiment, table))
+
+    arrays = [open_memmap(column_filename(directory, table, name) + ".tmp", mode="w+", dtype=dtype, shape=(count,))
+              for name, dtype in columns]
+
+    done = 0
+    for source in sources(experiment, table):
+        sql = "SELECT %s FROM %s ORDER BY id" % (", ".join(name for name, dtype in columns), table)
+        cursor = source.cursor()
+        cursor.execute(sql)
+        while done < count:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            values = numpy.array([tuple(row) for row in rows], dtype=float) # NULL -> NaN
+            for i, (name, dtype) in enumerate(columns):
+                column = values[:, i]
+                column[numpy.isnan(column)] = missing_values[dtype]
+                arrays[i][done:done + len(rows)] = column
+            done += len(rows)
+        cursor.close()
+
+    for array, (name, dtype) in zip(arrays, columns):
+        array.flush()
+        filename = column_filename(directory, table, name)
+        os.rename(filename + ".tmp", filename)
+
+    logging.info("Exported %d rows of %s" % (done, table))
+
+def export_columns(experiment, chunk_size=100000):
+    "Export the tables of an (on disk) experiment to their column files. The directory they're in."
+
+    database_filename = experiment.filename()
+    if not database_filename:
+        raise Exception("Can't export the columns of an experiment that isn't in a file.")
+
+    stamp = database_stamp(database_filename) # Taken first, so any change while we're exporting makes it stale.
+    directory = columns_directory(database_filename)
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+
+    filename = os.path.join(directory, stamp_filename)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    for table in sorted(table_columns):
+        export_table(experiment, directory, table, chunk_size)
+
+    f = open(filename, "w")
+    f.write(stamp)
+    f.close()
+
+    return directory
+
+def load_columns(directory):
+    "The column arrays (memory-mapped, read only) by table, then by column name."
+
+    columns = {}
+    for table, names in table_columns.iteritems():
+        columns[table] = dict((name, numpy.load(column_filename(directory, table, name), mmap_mode="r")) for name, dtype in names)
+    return columns
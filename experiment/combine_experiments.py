@@ -63,7 +63,7 @@ if __name__ == "__main__":
     options, args = parser.parse_args()
 
     try:
-        combined = new_experiment(options.combined)
+        combined = new_experiment(options.combined, indexes=False)
     except Exception, e:
         sys.exit("Error loading combined database: %s" % str(e))
     
@@ -77,3 +77,4 @@ if __name__ == "__main__":
             
     
     combine(combined, existing)
+    combined.create_indexes()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+Compaction of an experiment's distance readings: keep the recent ones, summarise the rest.
+
+Readings older than keep_recent (before the newest reading), and not within ground_truth_margin of a ground truth entry
+for their tag, are replaced by a row in distance_summary for each tag, anchor and time bucket:
+the number of readings, their median and spread (interquartile range).
+Readings around ground truth are kept at full resolution, as that's what the analysis compares against.
+
+The readings are compacted a window of time at a time, each in its own transaction, with how far it's got
+kept in the compaction table. So it can be stopped (or fail) at any point, and run again later to carry on
+(as the recording grows, say) without summarising anything twice. The bucket size is kept with it,
+and carrying on with a different one is refused (the buckets at the resume point would no longer line up).
+
+Only the distance_summary and compaction tables, and the readings' timestamp index (without which each window
+would be a scan of the whole table), are created if need be; the other indexes are left to migrate (experiment_db -m),
+so it can be run on a live recording made without them.
+"""
+
+import math
+import logging
+
+import numpy
+
+from Almada.experiment import schema
+
+compaction_state_sql = "SELECT compacted_until, bucket FROM compaction WHERE id = 1"
+update_compaction_state_sql = "INSERT OR REPLACE INTO compaction (id, compacted_until, bucket) VALUES (1, ?, ?)"
+window_readings_sql = "SELECT id, anchor_id, tag_id, distance, timestamp FROM distance_reading WHERE timestamp >= ? AND timestamp < ?"
+delete_reading_sql = "DELETE FROM distance_reading WHERE id = ?"
+add_summary_sql = "INSERT INTO distance_summary (anchor_id, tag_id, start_time, end_time, count, median, spread) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+def kept_intervals(experiment, margin):
+    "The times to keep readings for, by tag: arrays of ground truth start and end times (widened by margin), sorted by start."
+
+    intervals = {}
+    for tag_id, start_time, end_time in experiment.query("SELECT tag_id, start_time, end_time FROM ground_truth").fetchall():
+        if end_time == None:
+            end_time = numpy.inf # Still in progress.
+        intervals.setdefault(tag_id, []).append((start_time - margin, end_time + margin))
+
+    for tag_id, tag_intervals in intervals.items():
+        tag_intervals.sort()
+        starts, ends = numpy.array(tag_intervals, dtype=float).T
+        intervals[tag_id] = starts, numpy.maximum.accumulate(ends)
+    return intervals
+
+def keep_readings(tag_ids, timestamps, intervals):
+    "Which of the readings fall in the intervals for their tag."
+
+    keep = numpy.zeros(len(tag_ids), dtype=bool)
+    for tag_id in numpy.unique(tag_ids).tolist():
+        if not tag_id in intervals:
+            continue
+        starts, ends = intervals[tag_id]
+        tag = tag_ids == tag_id
+        i = numpy.searchsorted(starts, timestamps[tag], side="right") - 1
+        keep[tag] = (i >= 0) & (ends[numpy.maximum(i, 0)] > timestamps[tag])
+    return keep
+
+def quantiles(values, group_starts, group_sizes, q):
+    "The q quantile of each group of values (each group sorted), interpolated between the nearest."
+
+    position = group_starts + q * (group_sizes - 1)
+    below = numpy.floor(position).astype(numpy.int64)
+    above = numpy.minimum(below + 1, group_starts + group_sizes - 1)
+    fraction = position - below
+    return values[below] * (1 - fraction) + values[above] * fraction
+
+def summarise(anchor_ids, tag_ids, distances, timestamps, bucket):
+    "Summary rows (anchor_id, tag_id, start_time, end_time, count, median, spread) for each tag, anchor and time bucket."
+
+    buckets = numpy.floor(timestamps / bucket).astype(numpy.int64)
+    order = numpy.lexsort((distances, buckets, anchor_ids, tag_ids))
+    anchor_ids, tag_ids, buckets, distances = anchor_ids[order], tag_ids[order], buckets[order], distances[order]
+
+    new_group = numpy.r_[True, (tag_ids[1:] != tag_ids[:-1]) | (anchor_ids[1:] != anchor_ids[:-1]) | (buckets[1:] != buckets[:-1])]
+    group_starts = numpy.flatnonzero(new_group)
+    group_sizes = numpy.diff(numpy.r_[group_starts, len(distances)])
+
+    medians = quantiles(distances, group_starts, group_sizes, 0.5)
+    spreads = quantiles(distances, group_starts, group_sizes, 0.75) - quantiles(distances, group_starts, group_sizes, 0.25)
+    start_times = buckets[group_starts] * bucket
+
+    return zip(anchor_ids[group_starts].tolist(), tag_ids[group_starts].tolist(), start_times.tolist(), (start_times + bucket).tolist(),
+               group_sizes.tolist(), medians.tolist(), spreads.tolist())
+
+def compact(experiment, keep_recent=7 * 86400.0, bucket=60.0, ground_truth_margin=60.0, window=3600.0, now=None):
+    """
+    Summarise the readings older than keep_recent seconds (before 'now', by default the newest reading),
+    except those within ground_truth_margin seconds of ground truth for their tag, into bucket second summaries.
+    Done (and committed) window seconds at a time, carrying on from wherever the last compaction got to.
+    Returns the number of readings summarised.
+    """
+
+    schema.create_later_tables(experiment.cursor)
+    experiment.cursor.execute(schema.create_timestamp_index_sql)
+    experiment.connection.commit()
+
+    window = max(math.ceil(window / bucket), 1) * bucket # Windows are whole buckets, so no bucket is split between them.
+    first_time, last_time = experiment.query("SELECT MIN(timestamp), MAX(timestamp) FROM distance_reading").fetchone()
+    if first_time == None:
+        return 0
+    if now == None:
+        now = last_time
+    cutoff = math.floor((now - keep_recent) / bucket) * bucket
+
+    row = experiment.query(compaction_state_sql).fetchone()
+    if row:
+        start_time, compacted_bucket = row
+        if compacted_bucket != None and compacted_bucket != bucket:
+            raise Exception("Readings have been compacted into %g second buckets, not %g" % (compacted_bucket, bucket))
+    else:
+        start_time = math.floor(first_time / bucket) * bucket
+
+    intervals = kept_intervals(experiment, ground_truth_margin)
+    summarised = 0
+    kept = 0
+    while start_time < cutoff:
+        end_time = min(start_time + window, cutoff)
+
+        rows = experiment.query(window_readings_sql, (start_time, end_time)).fetchall()
+        if rows:
+            readings = numpy.array([tuple(row) for row in rows], dtype=float)
+            reading_ids = readings[:, 0].astype(numpy.int64)
+            anchor_ids = readings[:, 1].astype(numpy.int64)
+            tag_ids = readings[:, 2].astype(numpy.int64)
+            distances, timestamps = readings[:, 3], readings[:, 4]
+
+            compacted = ~keep_readings(tag_ids, timestamps, intervals)
+            experiment.cursor.executemany(add_summary_sql, summarise(anchor_ids[compacted], tag_ids[compacted], distances[compacted],
+                                                                     timestamps[compacted], bucket))
+            experiment.cursor.executemany(delete_reading_sql, [(reading_id,) for reading_id in reading_ids[compacted].tolist()])
+            summarised += compacted.sum()
+            kept += (~compacted).sum()
+
+        experiment.cursor.execute(update_compaction_state_sql, (end_time, bucket))
+        experiment.connection.commit()
+        logging.info("Compacted readings up to %.1f (%d summarised, %d kept around ground truth)" % (end_time, summarised, kept))
+        start_time = end_time
+
+    return int(summarised)
+
+if __name__ == "__main__":
+
+    import sys
+    from optparse import OptionParser
+
+    from Almada.experiment.experiment_db import load_experiment
+
+    parser = OptionParser()
+    parser.add_option("-e", "--experiment", dest="experiment",
+                      help="The sqlite database file for the experiment.", metavar="FILE")
+    parser.add_option("-k", "--keep", dest="keep", type="float", default=7.0,
+                      help="Keep the readings from this many days before the newest at full resolution (default=%default).")
+    parser.add_option("-b", "--bucket", dest="bucket", type="float", default=60.0,
+                      help="Summarise the older readings over this many seconds (default=%default).")
+    parser.add_option("-m", "--margin", dest="margin", type="float", default=60.0,
+                      help="Keep the readings within this many seconds of ground truth for their tag (default=%default).")
+    parser.add_option("-V", "--vacuum", action="store_true", default=False,
+                      help="Vacuum the database afterwards, to give the space back.")
+    parser.add_option("-l", "--log_level", dest="log_level", type="int", default=20,
+                      help="The log level (default=%default).")
+
+    (options, args) = parser.parse_args()
+    logging.basicConfig(level=options.log_level, format='%(asctime)s %(levelname)s %(message)s')
+
+    if not options.experiment:
+        sys.exit("No experiment file. Seek help (-h).")
+
+    experiment = load_experiment(options.experiment)
+    summarised = compact(experiment, options.keep * 86400, options.bucket, options.margin)
+    print "Summarised %d readings" % summarised
+
+    if options.vacuum:
+        experiment.cursor.execute("VACUUM;")
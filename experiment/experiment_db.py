@@ -15,10 +15,18 @@ import os
 import sqlite3
 import math
 import logging
+import itertools
+
+import numpy
 
 from Almada.clock import shared_clock as clock
+from Almada.experiment import schema
+from Almada.experiment import columns
+from Almada.experiment import compaction
 from Almada.experiment.schema import create_database
 from Almada.experiment.ground_truth import PartialGroundTruth, GroundTruthAction
+from Almada.experiment.ground_truth_index import GroundTruthIndex
+from Almada.experiment.recording_writer import RecordingWriter
     
 class Experiment(object):
     """An interface to the SQLite database underlying an experiment."""
@@ -28,10 +36,99 @@ class Experiment(object):
         self.connection = connection
         self.cursor = connection.cursor()
         self.connection.row_factory = sqlite3.Row
+        self.database_filename = self.query("PRAGMA database_list").fetchone()[2] # Looked up once: (in Python 2) a PRAGMA commits.
         self.configuration_id = None
         self.anchors = {}
         self.load_anchors()
         self.partial_ground_truths = {}
+        self.index = None # The GroundTruthIndex, loaded when first needed (see ground_truth_index).
+        self.recording_writer = None # While recording, readings and estimates are written by this (see start_recording).
+        self.recording_parameters = None # The commit_size and commit_interval given to start_recording, while recording.
+        self.estimate_writers = {} # While recording, configuration_id -> RecordingWriter for its estimate database.
+        self.estimate_connections = {} # configuration_id -> connection to its estimate database (see estimate_connection).
+      
+    def filename(self):
+        "The file the database is in."
+        return self.database_filename
+        
+    def start_recording(self, commit_size=1000, commit_interval=1.0):
+        """
+        Switch to WAL journaling, and have readings and estimates written by a background thread (a RecordingWriter),
+        committed in groups. Call stop_recording to flush them.
+        """
+        
+        self.query("PRAGMA journal_mode=WAL")
+        self.recording_parameters = (commit_size, commit_interval)
+        self.recording_writer = RecordingWriter(self.filename(), commit_size, commit_interval)
+        
+    def stop_recording(self):
+        "Write and commit everything recorded so far, and go back to writing directly."
+        
+        if self.recording_writer:
+            self.recording_writer.close()
+        for writer in self.estimate_writers.itervalues():
+            if writer != self.recording_writer:
+                writer.close()
+        self.estimate_writers = {}
+        self.recording_writer = None
+        self.recording_parameters = None
+
+    def commit(self):
+        "Commit the database, and the estimate databases."
+        
+        self.connection.commit()
+        for connection in self.estimate_connections.itervalues():
+            connection.commit()
+            
+    def close(self):
+        "Close the database, and the estimate databases (without committing)."
+        
+        for configuration_id in self.estimate_connections.keys():
+            self.close_estimates(configuration_id)
+        self.connection.close()
+      
+    def schema_version(self):
+        return schema.get_schema_version(self.cursor)
+        
+    def create_indexes(self):
+        "Build the indexes, if they were left out of a new experiment for a bulk load."
+        
+        schema.create_indexes(self.cursor)
+        self.connection.commit()
+        
+    def migrate(self):
+        "Upgrade the database to the current schema, in place. Whether anything needed doing."
+        
+        migrated = schema.migrate(self.cursor)
+        self.connection.commit()
+        return migrated
+        
+    def compact(self, keep_recent=7 * 86400.0, bucket=60.0, ground_truth_margin=60.0):
+        "Summarise the older readings into distance_summary, keeping those around ground truth (see compaction.compact)."
+        return compaction.compact(self, keep_recent, bucket, ground_truth_margin)
+        
+    def distance_summaries(self, tag_id, anchor_id):
+        "The summaries of the compacted readings (start_time, end_time, count, median, spread) for a tag and anchor, in time order."
+        
+        sql = "SELECT start_time, end_time, count, median, spread FROM distance_summary WHERE tag_id = ? AND anchor_id = ? ORDER BY start_time"
+        return self.query(sql, (tag_id, anchor_id))
+        
+    def export_columns(self):
+        "Export the distance_reading, ground_truth and estimate tables as column files, next to the database (see columns)."
+        
+        self.commit()
+        return columns.export_columns(self)
+        
+    def to_columns(self):
+        "The distance_reading, ground_truth and estimate tables as memory-mapped arrays, by table and column (exported first if need be)."
+        
+        self.commit()
+        filename = self.filename()
+        if columns.is_current(filename):
+            directory = columns.columns_directory(filename)
+        else:
+            directory = self.export_columns()
+        return columns.load_columns(directory)
       
     def query(self, *args):
         "A cursor with the select statement performed."
@@ -66,17 +163,27 @@ class Experiment(object):
         return [row[0] for row in rows]
         
     add_reading_sql = "INSERT INTO distance_reading (anchor_id, tag_id, distance, ground_truth_id, timestamp) VALUES (?, ?, ?, ?, ?)"
-    def add_reading(self, anchor_id, tag_id, distance, ground_truth=None):
-        "Add a reading, now. Don't worry about comparing to the ground truth distance."
+    def add_reading(self, anchor_id, tag_id, distance, ground_truth=None, timestamp=None):
+        "Add a reading, now (unless timestamp is given). Don't worry about comparing to the ground truth distance."
         
-        self.cursor.execute(self.add_reading_sql, (anchor_id, tag_id, distance, ground_truth, clock.get_time()))
+        if timestamp == None:
+            timestamp = clock.get_time()
+        if self.recording_writer:
+            self.recording_writer.add(self.add_reading_sql, [(anchor_id, tag_id, distance, ground_truth, timestamp)])
+            return
+        self.cursor.execute(self.add_reading_sql, (anchor_id, tag_id, distance, ground_truth, timestamp))
         self.connection.commit()
 
-    def add_readings(self, tag_id, distances, ground_truth_id=None):
-        "Like add reading for many readings, but all with an identical timestamp."
-        timestamp = clock.get_time()
-        for anchor_id, distance in distances:
-            self.cursor.execute(self.add_reading_sql, (anchor_id, tag_id, distance, ground_truth, timestamp))
+    def add_readings(self, readings, ground_truth_id=None):
+        "Like add reading for all the readings in a ReadingBatch (with their own timestamps), in one commit."
+        
+        rows = [(anchor_id, tag_id, distance, ground_truth_id, timestamp) 
+                for anchor_id, tag_id, distance, timestamp in readings.rows("anchor_id", "tag_id", "distance", "timestamp")]
+        if self.recording_writer:
+            self.recording_writer.add(self.add_reading_sql, rows)
+            return
+        self.cursor.executemany(self.add_reading_sql, rows)
+        self.connection.commit()
 
     add_full_reading_sql = "INSERT INTO distance_reading (anchor_id, tag_id, distance, ground_truth_id, ground_truth_distance, ground_truth_error, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)"
     def add_full_reading(self, anchor_id, tag_id, distance, ground_truth_id, ground_truth_distance, ground_truth_error, timestamp):
@@ -118,6 +225,8 @@ class Experiment(object):
         self.cursor.execute(self.add_ground_truth_sql, (label, tag_id, start_time, end_time, start_x, start_y, end_x, end_y))
         ground_truth_id = self.last_rowid()
         self.connection.commit()
+        if self.index:
+            self.index.add(ground_truth_id, tag_id, start_time, end_time, start_x, start_y, end_x, end_y)
         
         return ground_truth_id
         
@@ -125,9 +234,12 @@ class Experiment(object):
     def start_ground_truth(self, tag_id, label, location):
         
         x, y = location
-        self.cursor.execute(self.start_ground_truth_sql, (label, tag_id, clock.get_time(), x, y))
+        start_time = clock.get_time()
+        self.cursor.execute(self.start_ground_truth_sql, (label, tag_id, start_time, x, y))
         ground_truth_id = self.last_rowid()
         self.connection.commit()
+        if self.index:
+            self.index.add(ground_truth_id, tag_id, start_time, None, x, y)
         
         return ground_truth_id
         
@@ -138,11 +250,14 @@ class Experiment(object):
             x, y = None, None
         else:
             x, y = location
-        self.cursor.execute(self.end_ground_truth_sql, (clock.get_time(), x, y, ground_truth_id))
+        end_time = clock.get_time()
+        self.cursor.execute(self.end_ground_truth_sql, (end_time, x, y, ground_truth_id))
         if label != None:
             self.cursor.execute(self.update_ground_truth_label_sql, (label, ground_truth_id))
         
         self.connection.commit()
+        if self.index:
+            self.index.end(ground_truth_id, end_time, x, y)
         
     cancel_ground_truth_sql = ["DELETE FROM ground_truth WHERE id = ?;",
                               "UPDATE distance_reading set ground_truth_id = NULL WHERE ground_truth_id = ?;",
@@ -151,6 +266,16 @@ class Experiment(object):
         for statement in self.cancel_ground_truth_sql:
             self.cursor.execute(statement, (ground_truth_id,))
         self.connection.commit()
+        sql = self.cancel_ground_truth_sql[-1]
+        for configuration_id in self.estimate_configuration_ids():
+            if configuration_id in self.estimate_writers: # Being recorded to: done in turn with the estimates.
+                self.estimate_writers[configuration_id].add(sql, [(ground_truth_id,)])
+            else:
+                connection = self.estimate_connection(configuration_id)
+                connection.execute(sql, (ground_truth_id,))
+                connection.commit()
+        if self.index:
+            self.index.remove(ground_truth_id)
        
     distance_readings_sql = "SELECT * FROM distance_reading ORDER BY timestamp"
     def distance_readings(self):
@@ -162,62 +287,99 @@ class Experiment(object):
         return cursor
         
     observations_sql = "SELECT anchor_id, tag_id, distance, timestamp FROM distance_reading ORDER BY timestamp"
-    def observations(self, tag_ids=None, anchor_ids=None):
-        "An iterator of four tuples; tag_id, dictionary of distance reading by anchor_id, ground truth (x, y), and timestamp."
+    def observations(self, tag_ids=None, anchor_ids=None, chunk_size=100000):
+        """
+        An iterator of four tuples; tag_id, dictionary of distance reading by anchor_id, ground truth (x, y), and timestamp.
+        
+        A tag's observation (frame) ends when a reading comes from an anchor with an ID no higher than the first in the frame.
+        The readings are taken chunk_size at a time, and the frames found with arrays, tag by tag.
+        Observations without ground truth are left out, as is each tag's last (possibly incomplete) frame.
+        """
         
         if anchor_ids == None:
             anchor_ids = self.anchors.keys()
-            
-        if tag_ids == None:
-            tag_ids = self.tag_ids()
         
         cursor = self.connection.cursor()
-        distance_readings = cursor.execute(self.observations_sql)
+        cursor.row_factory = None
+        cursor.execute(self.observations_sql)
         
-        timestamps = {} # The last timestamp we have, by tag
-        observations = {} # Dictionaries of anchor_id -> distance by tag_id
-        for tag_id in tag_ids:
-            observations[tag_id] = {}
+        frames = {} # The frame in progress for each tag: anchor IDs, distances and the last timestamp.
         
-        last_anchor_id = 0
-                
-        while distance_readings:
-            
-            try:
-                anchor_id, tag_id, distance, timestamp = distance_readings.fetchone()
-            except:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
                 break
-
-            if not anchor_id in anchor_ids:
-                logging.debug("Ignoring reading from unknown anchor: %d" % anchor_id)
-                continue
-            if not tag_id in tag_ids:
-                logging.debug("Ignoring reading from unknown tag: %d" % tag_id)
-                continue
-
-            anchor_readings = observations[tag_id]
-
-            if anchor_readings and anchor_id <= min(anchor_readings):
-                # This means it's a fresh reading. Prepare the last entry for yield.
-                
-                location = self.ground_truth(tag_id, timestamps[tag_id])
-                result = tag_id, anchor_readings, location, timestamps[tag_id]
-                
-                observations[tag_id] = {anchor_id: distance}
-                timestamps[tag_id] = timestamp
+            
+            readings = numpy.fromiter(itertools.chain.from_iterable(rows), dtype=float, count=4 * len(rows)).reshape(len(rows), 4)
+            anchors = readings[:, 0].astype(numpy.int64)
+            tags = readings[:, 1].astype(numpy.int64)
+            
+            known = numpy.in1d(anchors, list(anchor_ids))
+            if tag_ids != None:
+                known &= numpy.in1d(tags, list(tag_ids))
+            if not known.all():
+                logging.debug("Ignoring %d readings from unknown anchors or tags" % (~known).sum())
+            
+            # The positions in the chunk of each tag's readings, in order.
+            by_tag = numpy.flatnonzero(known)
+            by_tag = by_tag[numpy.argsort(tags[by_tag], kind="mergesort")]
+            tag_starts = numpy.flatnonzero(numpy.r_[True, tags[by_tag][1:] != tags[by_tag][:-1]])
+            
+            results = [] # (position in the chunk, observation)
+            for positions in numpy.split(by_tag, tag_starts[1:]):
+                if len(positions):
+                    tag_id = int(tags[positions[0]])
+                    results.extend(self.tag_observations(tag_id, positions, anchors[positions], readings[positions, 2], readings[positions, 3], frames))
+            
+            results.sort()
+            for position, observation in results:
+                yield observation
                 
-                if location:
-                    yield result
-                else:
-                    logging.debug("Ignoring observation of %d at %.2f; no ground truth" % (tag_id, timestamp))
+    def tag_observations(self, tag_id, positions, anchors, distances, timestamps, frames):
+        "The observations completed by a chunk of one tag's readings (with their positions in the chunk), updating the tag's frame in progress."
+        
+        frame_anchors, frame_distances, frame_timestamp = frames.get(tag_id, ([], [], None))
+        
+        # A frame can only end where the anchor ID doesn't go up, so only those readings are candidates.
+        # Usually (anchors in order) they all do; otherwise they're checked in turn.
+        previous = numpy.r_[frame_anchors[-1:] or [anchors[0] - 1], anchors[:-1]]
+        start_anchor = (frame_anchors or [anchors[0]])[0]
+        candidates = numpy.flatnonzero(anchors <= previous)
+        if (anchors[candidates] <= numpy.r_[start_anchor, anchors[candidates][:-1]]).all():
+            boundaries = candidates.tolist()
+        else:
+            boundaries = []
+            for i in candidates.tolist():
+                if anchors[i] <= start_anchor:
+                    boundaries.append(i)
+                    start_anchor = anchors[i]
+        
+        anchors = anchors.tolist()
+        distances = distances.tolist()
+        timestamps = timestamps.tolist()
+        if not boundaries:
+            frames[tag_id] = (frame_anchors + anchors, frame_distances + distances, timestamps[-1])
+            return []
+        
+        end_times = [timestamps[i - 1] if i else frame_timestamp for i in boundaries]
+        ground_truths, ground_truth_ids = self.ground_truth_at(tag_id, end_times)
+        
+        results = []
+        starts = [0] + boundaries
+        for j, boundary in enumerate(boundaries):
+            if j:
+                readings = dict(zip(anchors[starts[j]:boundary], distances[starts[j]:boundary]))
             else:
-                anchor_readings[anchor_id] = distance
-                if timestamps.has_key(tag_id):
-                    delta = timestamp - timestamps[tag_id]
-                    if abs(delta > 0.1):
-                        logging.debug("Timestamps for observation differ by %.2f" % delta)
-                timestamps[tag_id] = timestamp
+                readings = dict(zip(frame_anchors + anchors[:boundary], frame_distances + distances[:boundary]))
+            
+            if ground_truth_ids[j] >= 0:
+                location = tuple(ground_truths[j].tolist())
+                results.append((positions[boundary], (tag_id, readings, location, end_times[j])))
+            else:
+                logging.debug("Ignoring observation of %d at %.2f; no ground truth" % (tag_id, end_times[j]))
         
+        frames[tag_id] = (anchors[boundaries[-1]:], distances[boundaries[-1]:], timestamps[-1])
+        return results
     
     ground_truth_details_sql = "SELECT label, start_x, start_y, end_x, end_y, start_time, end_time "\
                                "FROM ground_truth WHERE id = ?"
@@ -240,55 +402,43 @@ class Experiment(object):
         return [row[0] for row in rows]
 
 
+    ground_truth_index_sql = "SELECT id, tag_id, start_time, end_time, start_x, start_y, end_x, end_y FROM ground_truth"
+    def ground_truth_index(self):
+        "The GroundTruthIndex, loaded from the ground_truth table the first time."
+        
+        if self.index == None:
+            self.index = GroundTruthIndex(self.query(self.ground_truth_index_sql).fetchall())
+        return self.index
+        
+    def reload_ground_truth(self):
+        "Reload the GroundTruthIndex (after changing the ground_truth table other than through this object)."
+        self.index = None
+
+    def ground_truth_at(self, tag_id, timestamps):
+        "The ground truth positions (x, y) and ids for a tag at each of an array of timestamps (NaN and -1 where there's none)."
+        return self.ground_truth_index().ground_truth_at(tag_id, timestamps)
+
     def ground_truth_id(self, tag_id, timestamp=None):
         
         if timestamp == None:
             timestamp = clock.get_time()
         
-        sql = "SELECT id FROM ground_truth WHERE tag_id = ? AND start_time <= ? AND end_time > ?"
-        rows = self.query(sql, (tag_id, timestamp, timestamp)).fetchall()
-        
-        if not rows:
+        ground_truth = self.ground_truth_index().ground_truth(tag_id, timestamp)
+        if not ground_truth:
             return None
             
-        if len(rows) > 1:
-            raise Exception("Tag %d at %.2f matches more than one ground truth (%d)" % (tag_id, timestamp, len(rows)))
-            
-        return rows[0][0]
+        return ground_truth[0]
 
-    ground_truth_sql = "SELECT start_x, start_y, end_x, end_y, start_time, end_time FROM ground_truth "\
-                       "WHERE tag_id = ? and start_time <= ? and end_time > ?"
     def ground_truth(self, tag_id, timestamp=None):
         
         if timestamp == None:
             timestamp = clock.get_time()
         
-        cursor = self.connection.cursor()
-        
-        cursor.execute(self.ground_truth_sql, (tag_id, timestamp, timestamp))
-        rows = cursor.fetchall()
-        
-        if not rows:
+        ground_truth = self.ground_truth_index().ground_truth(tag_id, timestamp)
+        if not ground_truth:
             return None
         
-        if len(rows) > 1:
-            print rows
-            raise Exception("Tag %d at %.2f matches more than one ground truth (%d)" % (tag_id, timestamp, len(rows)))
-            
-        start_x, start_y, end_x, end_y, start_time, end_time = rows[0]
-        
-        # Static point
-        if end_x == None and end_y == None:
-            return start_x, start_y
-        
-        # Linear interpolation between the start and end points.
-        alpha = (timestamp - start_time) / (end_time - start_time)
-        dx = alpha * (end_x - start_x)
-        dy = alpha * (end_y - start_y)
-        x = start_x + dx
-        y = start_y + dy
-        
-        return x, y
+        return ground_truth[1]
     
     tag_id_for_ground_truth_sql = "SELECT DISTINCT(tag_id) FROM ground_truth WHERE id = ?"
     def tag_id_for_ground_truth(self, ground_truth_id):
@@ -301,24 +451,57 @@ class Experiment(object):
         
     
     append_ground_truth_distance_sql = "UPDATE distance_reading set ground_truth_id = ?, ground_truth_distance = ?, ground_truth_error = ? WHERE id = ?"
-    def append_ground_truth_distances(self):
-        "Go through each distance reading, where ground truth is known add the ground truth distance and error."
-    
-        distance_readings = self.connection.cursor()
-        distance_readings.execute("SELECT id, anchor_id, tag_id, distance, timestamp FROM distance_reading ORDER BY timestamp")
-    
-        for distance_reading in distance_readings:
+    append_ground_truth_readings_sql = "SELECT id, anchor_id, tag_id, distance, timestamp FROM distance_reading WHERE id > ? ORDER BY id LIMIT ?"
+    def append_ground_truth_distances(self, chunk_size=100000):
+        """
+        Go through each distance reading, where ground truth is known add the ground truth distance and error.
+        Done with arrays, chunk_size readings at a time (so the memory used is bounded), with the progress logged.
+        """
+        
+        total = self.query("SELECT COUNT(*) FROM distance_reading").fetchone()[0]
+        anchor_ids = sorted(self.anchors)
+        anchor_locations = numpy.array([self.anchors[anchor_id] for anchor_id in anchor_ids], dtype=float).reshape(len(anchor_ids), 2)
+        
+        done = 0
+        updated = 0
+        last_id = 0
+        while True:
+            rows = self.query(self.append_ground_truth_readings_sql, (last_id, chunk_size)).fetchall()
+            if not rows:
+                break
+            
+            readings = numpy.array([tuple(row) for row in rows], dtype=float)
+            reading_ids = readings[:, 0].astype(numpy.int64)
+            tag_ids = readings[:, 2].astype(numpy.int64)
+            distances, timestamps = readings[:, 3], readings[:, 4]
             
-            timestamp = distance_reading["timestamp"]
-            tag_id = distance_reading["tag_id"]
-            ground_truth_id = self.ground_truth_id(tag_id, timestamp)
-            ground_truth = self.ground_truth(tag_id, timestamp)
-            if ground_truth:
-                gx, gy = ground_truth
-                ax, ay = self.anchors[distance_reading["anchor_id"]]
-                distance = math.hypot(gx - ax, gy - ay)
-                error = distance_reading["distance"] - distance
-                self.cursor.execute(self.append_ground_truth_distance_sql, (ground_truth_id, distance, error, distance_reading["id"]))
+            # The anchor location for each reading (unknown anchors are left out).
+            anchor_index = numpy.searchsorted(anchor_ids, readings[:, 1])
+            anchor_index = numpy.minimum(anchor_index, max(len(anchor_ids) - 1, 0))
+            known = numpy.zeros(len(readings), dtype=bool)
+            if anchor_ids:
+                known = numpy.asarray(anchor_ids)[anchor_index] == readings[:, 1]
+            
+            positions = numpy.empty((len(readings), 2))
+            positions.fill(numpy.nan)
+            ground_truth_ids = numpy.empty(len(readings), dtype=numpy.int64)
+            ground_truth_ids.fill(-1)
+            for tag_id in numpy.unique(tag_ids).tolist():
+                tag = tag_ids == tag_id
+                positions[tag], ground_truth_ids[tag] = self.ground_truth_at(tag_id, timestamps[tag])
+            
+            found = known & (ground_truth_ids >= 0)
+            anchor_positions = anchor_locations[anchor_index[found]]
+            ground_truth_distances = numpy.hypot(*(positions[found] - anchor_positions).T)
+            errors = distances[found] - ground_truth_distances
+            
+            self.cursor.executemany(self.append_ground_truth_distance_sql,
+                                    zip(ground_truth_ids[found].tolist(), ground_truth_distances.tolist(), errors.tolist(), reading_ids[found].tolist()))
+            
+            done += len(rows)
+            updated += found.sum()
+            last_id = int(reading_ids[-1])
+            logging.info("Ground truth distances: %d of %d readings (%d with ground truth)" % (done, total, updated))
                
         self.connection.commit()
             
@@ -327,27 +510,119 @@ class Experiment(object):
         sql = "SELECT id FROM configuration"
         return [row["id"] for row in self.query(sql)]
         
-    def register_configuration(self, configuration_name="", configuration_text="", locmod_name="", locmod_text=""):        
-        "Register a new configuration, which new estimates will be associated with."
+    def register_configuration(self, configuration_name="", configuration_text="", locmod_name="", locmod_text="", configuration_id=None):        
+        """
+        Register a new configuration, which new estimates will be associated with (in an estimate database of its own, if on disk).
+        configuration_id - The ID to give it, if not the next one (PartitionedExperiment keeps them the same in every shard).
+        """
+        
+        sql = "INSERT INTO configuration (id, configuration_name, configuration_text, locmod_name, locmod_text) VALUES (?, ?, ?, ?, ?)"
+        self.configuration_id = self.insert(sql, (configuration_id, configuration_name, configuration_text, locmod_name, locmod_text))
+
+        filename = self.filename()
+        if filename:
+            directory = schema.estimates_directory(filename)
+            if not os.path.exists(directory):
+                os.mkdir(directory)
+            self.remove_estimate_database(self.configuration_id) # Left over from an earlier configuration with the same ID, if any.
+            connection = sqlite3.connect(schema.estimate_filename(filename, self.configuration_id))
+            schema.create_estimate_database(connection.cursor())
+            connection.commit()
+            connection.close()
+
+    def has_estimate_database(self, configuration_id):
+        "Whether a configuration's estimates are in a database of its own (rather than the main estimate table)."
         
-        sql = "INSERT INTO configuration (configuration_name, configuration_text, locmod_name, locmod_text) VALUES (?, ?, ?, ?)"
-        self.configuration_id = self.insert(sql, (configuration_name, configuration_text, locmod_name, locmod_text))
+        filename = self.filename()
+        return bool(filename) and configuration_id != None and os.path.exists(schema.estimate_filename(filename, configuration_id))
 
+    def estimate_connection(self, configuration_id):
+        """
+        The connection to query (or add to) a configuration's estimate table with: to its own database (opened when first needed),
+        or the main connection for those from before there were estimate databases (or if the experiment is in memory).
+        Estimate databases are never attached to the main connection, as (in Python 2) attaching commits whatever is under way.
+        """
+        
+        if configuration_id in self.estimate_connections:
+            return self.estimate_connections[configuration_id]
+        if not self.has_estimate_database(configuration_id):
+            return self.connection
+        
+        connection = sqlite3.connect(schema.estimate_filename(self.filename(), configuration_id))
+        connection.row_factory = sqlite3.Row
+        self.estimate_connections[configuration_id] = connection
+        return connection
+        
+    def estimate_query(self, configuration_id, *args):
+        "A cursor with the select statement performed on a configuration's estimate table (see estimate_connection)."
+        
+        cursor = self.estimate_connection(configuration_id).cursor()
+        cursor.execute(*args)
+        return cursor
+        
+    def close_estimates(self, configuration_id):
+        "Close the connection to a configuration's estimate database, if open."
+        
+        connection = self.estimate_connections.pop(configuration_id, None)
+        if connection:
+            connection.close()
+            
+    def remove_estimate_database(self, configuration_id):
+        "Delete a configuration's estimate database (and its journal), if there is one."
+        
+        filename = schema.estimate_filename(self.filename(), configuration_id)
+        if os.path.exists(filename):
+            logging.warning("Deleting %s" % filename)
+        for suffix in ["", "-wal", "-shm", "-journal"]:
+            if os.path.exists(filename + suffix):
+                os.remove(filename + suffix)
+            
+    def estimate_configuration_ids(self):
+        "The configurations with estimate databases of their own."
+        
+        filename = self.filename()
+        if not filename:
+            return []
+        return [configuration_id for configuration_id in self.configuration_ids()
+                if os.path.exists(schema.estimate_filename(filename, configuration_id))]
+            
+    def estimate_writer(self, configuration_id):
+        "While recording, the RecordingWriter for a configuration's estimates."
+        
+        if not configuration_id in self.estimate_writers:
+            if self.has_estimate_database(configuration_id):
+                self.estimate_connection(configuration_id).execute("PRAGMA journal_mode=WAL")
+                filename = schema.estimate_filename(self.filename(), configuration_id)
+                self.estimate_writers[configuration_id] = RecordingWriter(filename, *self.recording_parameters)
+            else:
+                self.estimate_writers[configuration_id] = self.recording_writer
+        return self.estimate_writers[configuration_id]
        
+    add_estimate_sql = "INSERT INTO estimate (tag_id, x, y, timestamp, configuration_id) VALUES (?, ?, ?, ?, ?)"
     def add_estimate(self, tag_id, x, y):
         "Add an estimate by the current location module."
         
         if self.configuration_id:
-            sql = "INSERT INTO estimate(tag_id, x, y, timestamp, configuration_id) VALUES (?, ?, ?, ?, ?)"
-            self.insert(sql, (tag_id, x, y, clock.get_time(), self.configuration_id))
+            row = (tag_id, x, y, clock.get_time(), self.configuration_id)
+            if self.recording_writer:
+                self.estimate_writer(self.configuration_id).add(self.add_estimate_sql, [row])
+            else:
+                connection = self.estimate_connection(self.configuration_id)
+                connection.execute(self.add_estimate_sql, row)
+                connection.commit()
         else:
             logging.warning("Ignored distance estimate because current configuration ID is not set.")
         
+    add_full_estimate_sql = "INSERT INTO estimate (tag_id, x, y, timestamp, ground_truth_id, error, configuration_id) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    def add_full_estimate(self, tag_id, x, y, timestamp, ground_truth_id, error):
+        "Add an estimate by the current configuration, with its ground truth and error (as run_experiment does). Committed with the next commit()."
+        
+        row = (tag_id, x, y, timestamp, ground_truth_id, error, self.configuration_id)
+        self.estimate_connection(self.configuration_id).execute(self.add_full_estimate_sql, row)
     
+    estimates_sql = "SELECT tag_id, x, y, timestamp FROM estimate WHERE configuration_id = ? ORDER BY timestamp"
     def estimates(self, configuration_id):
-        
-        sql = "SELECT tag_id, x, y, timestamp FROM estimate WHERE configuration_id = ? ORDER BY timestamp"
-        return self.query(sql, (configuration_id,))
+        return self.estimate_query(configuration_id, self.estimates_sql, (configuration_id,))
         
 
     def ground_truth_estimate_info(self, configuration_id, ground_truth_id):
@@ -361,8 +636,9 @@ class Experiment(object):
         error_sizes = []
         
         sql = "SELECT x, y, timestamp FROM estimate WHERE configuration_id = ? AND ground_truth_id = ? ORDER BY timestamp ASC"
-        for x, y, timestamp in self.query(sql, (configuration_id, ground_truth_id)).fetchall():
-            gx, gy = self.ground_truth(tag_id, timestamp)
+        rows = self.estimate_query(configuration_id, sql, (configuration_id, ground_truth_id)).fetchall()
+        positions, ids = self.ground_truth_at(tag_id, [row[2] for row in rows])
+        for (x, y, timestamp), (gx, gy) in zip(rows, positions.tolist()):
             ex = x - gx
             ey = y - gy
             e = math.hypot(ex, ey)
@@ -375,21 +651,35 @@ class Experiment(object):
         return estimates, timestamps, errors, error_sizes
 
     def clear_generated_data(self, configuration_id=None):
-        """Clear all estimate data (leave distance_reading, anchor and ground truth tables.)"""
+        """
+        Clear all estimate data (leave distance_reading, anchor and ground truth tables.)
+        Configurations with estimate databases of their own are cleared by deleting the file.
+        """
         
-        delete_estimates_sql = "DELETE FROM estimate;"
+        delete_estimates_sql = "DELETE FROM main.estimate"
         delete_configurations_sql = "DELETE FROM configuration";
         
         if configuration_id:
+            configuration_ids = [configuration_id]
             delete_estimates_sql += " WHERE configuration_id = %d" % configuration_id
             delete_configurations_sql += " WHERE id = %d" % configuration_id
+        else:
+            configuration_ids = self.estimate_configuration_ids()
+            
+        self.connection.commit()
+        filename = self.filename()
+        for configuration_id in configuration_ids:
+            self.close_estimates(configuration_id)
+            if filename:
+                self.remove_estimate_database(configuration_id)
             
         logging.warning(delete_estimates_sql)
         logging.warning(delete_configurations_sql)
-        self.cursor.execute(delete_estimates_sql)
+        deleted = self.cursor.execute(delete_estimates_sql).rowcount
         self.cursor.execute(delete_configurations_sql)
-        self.cursor.execute("VACUUM;")
         self.connection.commit()
+        if deleted > 0: # Only the main estimate table takes up space in the database itself.
+            self.cursor.execute("VACUUM;")
         
     def apply_ground_truth_info(self, tag_id, location, action, reference_name):
         """Take note of new ground truth info
@@ -410,15 +700,19 @@ class Experiment(object):
         if not action == GroundTruthAction.abandoned_code:
             self.partial_ground_truths[tag_id] = PartialGroundTruth(self, tag_id, location, reference_name, action)
 
-def new_experiment(filename):
-    "Create and return a new experiment object from the given database"
+def new_experiment(filename, indexes=True):
+    """
+    Create and return a new experiment object from the given database.
+    For a bulk load (such as a live recording), leave out the indexes, and create them after (Experiment.create_indexes).
+    """
     
     if os.path.exists(filename):
         raise Exception("Database file already exists: %s" % filename)
     
     connection = sqlite3.connect(filename)
     cursor = connection.cursor()
-    create_database(cursor)
+    create_database(cursor, indexes)
+    connection.commit()
     cursor.close()
     
     return Experiment(connection)
@@ -449,6 +743,8 @@ if __name__ == "__main__":
                       help="Dump the results for the configuration with %metavar", metavar="CONFIG_ID")
     parser.add_option("-l", "--list", action="store_true", default=False,
                       help="List the available configurations")
+    parser.add_option("-m", "--migrate", action="store_true", default=False,
+                      help="Upgrade the database to the current schema (in place).")
 
     (options, args) = parser.parse_args()
     
@@ -468,6 +764,14 @@ if __name__ == "__main__":
         experiment.clear_generated_data()
         sys.exit()
         
+    if options.migrate:
+        version = experiment.schema_version()
+        if experiment.migrate():
+            print "Upgraded %s from schema version %d to %d" % (options.experiment, version, experiment.schema_version())
+        else:
+            print "%s is up to date (schema version %d)" % (options.experiment, version)
+        sys.exit()
+        
     if options.list:
         configuration_ids = experiment.configuration_ids()
         for configuration_id in configuration_ids:
@@ -0,0 +1,152 @@
+"""
+An in-memory index of the ground truth intervals, by tag, so finding the ground truth for a reading or an estimate
+doesn't need an SQL query each time.
+
+Each tag's intervals are kept as arrays sorted by start time, built when first needed (and rebuilt after a change),
+so a batch of timestamps is looked up with a binary search.
+As with the SQL (start_time <= t < end_time), an interval only matches once it has been ended.
+If a tag's intervals overlap, every interval is checked, and a timestamp matching more than one is an error.
+
+Experiment keeps one of these in sync as ground truth is started, ended and cancelled (see Experiment.ground_truth_index).
+"""
+
+import bisect
+
+import numpy
+
+class TagIntervals(object):
+    """The (ended) ground truth intervals for one tag, as arrays sorted by start time."""
+
+    def __init__(self, rows):
+        "rows - (id, start_time, end_time, start_x, start_y, end_x, end_y), with None for unknown end points."
+
+        super(TagIntervals, self).__init__()
+
+        rows = sorted(rows, key=lambda row: row[1])
+        columns = numpy.array(rows, dtype=float).reshape(len(rows), 7).T # None -> NaN
+        self.ids = columns[0].astype(numpy.int64)
+        self.start_times, self.end_times = columns[1], columns[2]
+        self.start_x, self.start_y, self.end_x, self.end_y = columns[3:7]
+        self.overlapping = len(rows) > 1 and (self.start_times[1:] < numpy.maximum.accumulate(self.end_times)[:-1]).any()
+        self.rows = rows # For looking up one timestamp at a time, without the overhead of the arrays.
+        self.row_start_times = [row[1] for row in rows]
+
+    def find_one(self, tag_id, timestamp):
+        "The row of the interval the timestamp falls in, or None."
+
+        if self.overlapping:
+            i, found = self.find(tag_id, numpy.array([timestamp], dtype=float))
+            if found[0]:
+                return self.rows[i[0]]
+            return None
+
+        i = bisect.bisect_right(self.row_start_times, timestamp) - 1
+        if i >= 0 and self.rows[i][2] > timestamp:
+            return self.rows[i]
+        return None
+
+    def find(self, tag_id, timestamps):
+        "The index of the interval each timestamp falls in, and whether it falls in one at all."
+
+        if not len(self.ids):
+            return numpy.zeros(len(timestamps), dtype=int), numpy.zeros(len(timestamps), dtype=bool)
+
+        if not self.overlapping:
+            i = numpy.searchsorted(self.start_times, timestamps, side="right") - 1
+            i = numpy.maximum(i, 0)
+            found = (self.start_times[i] <= timestamps) & (self.end_times[i] > timestamps)
+            return i, found
+
+        matches = (self.start_times <= timestamps[:, numpy.newaxis]) & (self.end_times > timestamps[:, numpy.newaxis])
+        counts = matches.sum(axis=1)
+        if (counts > 1).any():
+            j = numpy.flatnonzero(counts > 1)[0]
+            raise Exception("Tag %d at %.2f matches more than one ground truth (%d)" % (tag_id, timestamps[j], counts[j]))
+        return matches.argmax(axis=1), counts == 1
+
+    def positions(self, i, timestamps):
+        "The ground truth (x, y) at each timestamp, given the interval it falls in: interpolated, or the start point if there's no end point."
+
+        alpha = (timestamps - self.start_times[i]) / (self.end_times[i] - self.start_times[i])
+        static = numpy.isnan(self.end_x[i]) & numpy.isnan(self.end_y[i])
+        alpha[static] = 0.0
+        x = self.start_x[i] + alpha * numpy.where(static, 0.0, self.end_x[i] - self.start_x[i])
+        y = self.start_y[i] + alpha * numpy.where(static, 0.0, self.end_y[i] - self.start_y[i])
+        return numpy.column_stack((x, y))
+
+class GroundTruthIndex(object):
+    """The ground truth intervals by tag, for looking up the ground truth (id and position) at given times."""
+
+    def __init__(self, rows=[]):
+        "rows - (id, tag_id, start_time, end_time, start_x, start_y, end_x, end_y), as in the ground_truth table."
+
+        super(GroundTruthIndex, self).__init__()
+        self.rows = {} # tag_id -> {id -> (id, start_time, end_time, start_x, start_y, end_x, end_y)}
+        self.tag_ids = {} # id -> tag_id
+        self.intervals = {} # tag_id -> TagIntervals, built when first needed.
+
+        for row in rows:
+            self.add(*row)
+
+    def add(self, ground_truth_id, tag_id, start_time, end_time=None, start_x=None, start_y=None, end_x=None, end_y=None):
+        "Add (or replace) an interval."
+
+        self.rows.setdefault(tag_id, {})[ground_truth_id] = (ground_truth_id, start_time, end_time, start_x, start_y, end_x, end_y)
+        self.tag_ids[ground_truth_id] = tag_id
+        self.intervals.pop(tag_id, None)
+
+    def end(self, ground_truth_id, end_time, end_x=None, end_y=None):
+        "Set the end of an interval (as Experiment.end_ground_truth)."
+
+        tag_id = self.tag_ids[ground_truth_id]
+        row = self.rows[tag_id][ground_truth_id]
+        self.add(ground_truth_id, tag_id, row[1], end_time, row[3], row[4], end_x, end_y)
+
+    def remove(self, ground_truth_id):
+        "Remove an interval (as Experiment.cancel_ground_truth)."
+
+        tag_id = self.tag_ids.pop(ground_truth_id, None)
+        if tag_id != None:
+            del self.rows[tag_id][ground_truth_id]
+            self.intervals.pop(tag_id, None)
+
+    def tag_intervals(self, tag_id):
+        if not tag_id in self.intervals:
+            rows = [row for row in self.rows.get(tag_id, {}).itervalues() if row[2] != None]
+            self.intervals[tag_id] = TagIntervals(rows)
+        return self.intervals[tag_id]
+
+    def ground_truth(self, tag_id, timestamp):
+        "The ground truth ID and position (x, y) for a tag at a single timestamp, or None."
+
+        row = self.tag_intervals(tag_id).find_one(tag_id, timestamp)
+        if row == None:
+            return None
+
+        ground_truth_id, start_time, end_time, start_x, start_y, end_x, end_y = row
+        if end_x == None and end_y == None:
+            return ground_truth_id, (start_x, start_y)
+
+        alpha = (timestamp - start_time) / (end_time - start_time)
+        return ground_truth_id, (start_x + alpha * (end_x - start_x), start_y + alpha * (end_y - start_y))
+
+    def ground_truth_at(self, tag_id, timestamps):
+        """
+        The ground truth for a tag at each of the given timestamps, as two arrays:
+        positions - (x, y) for each timestamp, NaN where there's no ground truth.
+        ids - The ground truth ID for each timestamp, -1 where there's none.
+        """
+
+        timestamps = numpy.asarray(timestamps, dtype=float)
+        intervals = self.tag_intervals(tag_id)
+        i, found = intervals.find(tag_id, timestamps)
+
+        positions = numpy.empty((len(timestamps), 2))
+        positions.fill(numpy.nan)
+        ids = numpy.empty(len(timestamps), dtype=numpy.int64)
+        ids.fill(-1)
+        if found.any():
+            positions[found] = intervals.positions(i[found], timestamps[found])
+            ids[found] = intervals.ids[i[found]]
+
+        return positions, ids
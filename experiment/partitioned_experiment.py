@@ -0,0 +1,680 @@
+#!/usr/bin/env python
+"""
+An experiment recorded as a series of shards, one SQLite database per hour or day, for long running recordings.
+
+The shards are kept in a directory, with a manifest (manifest.json) listing each one's time period and state.
+Recording rolls over to a new shard when the shared clock passes the end of the current period.
+Each shard is a complete experiment database: the anchors and configurations are added to every one,
+and any ground truth still in progress is carried over (with the same ID), so each shard can be analysed on its own.
+Ground truth and configuration IDs are given out from the manifest, so an ID means the same thing in every shard.
+
+When a shard is closed, a background thread builds its indexes and ground truth distances, and (if archive_after is given)
+compresses the shards that are old enough into the archive directory, with their estimate databases
+(see schema.estimates_directory) in a tar file alongside. The recording carries on meanwhile.
+Ground truth that ends (or is cancelled) after its shard has closed is updated there by the same thread.
+
+Queries (query, ground_truth, observations, ground_truth_estimate_info, to_columns...) work across the shards, as for an Experiment,
+and those for a time range only look in the shards for that range. Archived shards are left out.
+There's no connection or cursor: SQL goes through query, which gives the rows of each shard in turn
+(so an aggregate, such as MIN(timestamp), gives a row per shard). The shards queried are kept open
+for the next query, up to max_readers of them.
+
+If the directory already has a manifest, recording carries on in it (in a fresh shard, or the current period's).
+"""
+
+import os
+import json
+import gzip
+import sqlite3
+import tarfile
+import math
+import time
+import shutil
+import logging
+import threading
+import itertools
+import collections
+import Queue
+
+import numpy
+
+from Almada.clock import shared_clock as clock
+from Almada.experiment import schema
+from Almada.experiment import columns
+from Almada.experiment.experiment_db import Experiment, new_experiment, load_experiment
+from Almada.experiment.ground_truth import PartialGroundTruth, GroundTruthAction
+
+partition_periods = {"hour": 3600.0, "day": 86400.0}
+
+manifest_filename = "manifest.json"
+archive_dirname = "archive"
+
+def checkpoint(filename):
+    "Fold a closed database's write-ahead log back into it, switching it out of WAL journaling, so it's a single file."
+
+    connection = sqlite3.connect(filename)
+    connection.execute("PRAGMA journal_mode=DELETE")
+    connection.close()
+
+class ShardRows(object):
+    "The rows of a query over the shards, to read as from a cursor (iterate, fetchone or fetchall)."
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        return self.rows
+
+    def next(self):
+        return self.rows.next()
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchall(self):
+        return list(self.rows)
+
+class PartitionedExperiment(object):
+    """An experiment kept as a shard (SQLite database) per time period, with a manifest."""
+
+    overlap = 60.0 # Readings are written as they arrive, so a shard may hold some from up to this long before its period.
+    max_readers = 4 # The most shards (other than the current one) kept open for queries.
+
+    def __init__(self, directory, partition="hour", archive_after=None):
+        """
+        directory - Where the shards and manifest are kept (created if need be).
+        partition - The period of each shard: "hour" or "day".
+        archive_after - Archive shards once they're this many seconds old (None to keep them).
+        """
+
+        super(PartitionedExperiment, self).__init__()
+
+        if not partition in partition_periods:
+            raise Exception("Unrecognised experiment partition: %s" % partition)
+
+        self.directory = directory
+        self.archive_after = archive_after
+        self.lock = threading.Lock() # For the manifest, which the background thread updates too.
+
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+        if os.path.exists(self.path(manifest_filename)):
+            self.manifest = json.load(open(self.path(manifest_filename)))
+            if self.manifest["partition"] != partition:
+                logging.warning("Experiment %s is partitioned by %s, not %s" % (directory, self.manifest["partition"], partition))
+        else:
+            self.manifest = {"partition": partition, "next_ground_truth_id": 1, "next_configuration_id": 1, "shards": []}
+            self.save_manifest()
+        self.period = partition_periods[self.manifest["partition"]]
+
+        self.current = None # The Experiment being recorded to, and its entry in the manifest.
+        self.current_shard = None
+        self.readers = collections.OrderedDict() # Filename -> Experiment, for queries on the other shards, least recently used first.
+        self.readers_in_use = {} # Filename -> the number of queries with rows still to be read from it.
+
+        self.anchors = {}
+        self.configurations = [] # The arguments to register_configuration (with the ID), to register in each new shard.
+        self.configuration_id = None
+        self.recording = None # The arguments to start_recording, while recording.
+        self.partial_ground_truths = {}
+        self.ground_truth_rows = {} # The ground truth in progress, by ID: (label, tag_id, start_time, start_x, start_y)
+        self.ground_truth_shards = {} # The shards (filenames) holding each ground truth in progress, by ID.
+
+        latest = self.latest_experiment()
+        if latest:
+            self.anchors.update(latest.anchors)
+        if not "next_configuration_id" in self.manifest: # From before configuration IDs were kept in the manifest.
+            self.manifest["next_configuration_id"] = max([0] + self.configuration_ids()) + 1
+            self.save_manifest()
+
+        # Closing shards (and updating or archiving them) is done by a background thread.
+        self.jobs = Queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="PartitionedExperiment")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def save_manifest(self):
+        "Write the manifest (to a new file, then moved into place)."
+
+        with self.lock:
+            filename = self.path(manifest_filename)
+            f = open(filename + ".tmp", "w")
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+            f.close()
+            os.rename(filename + ".tmp", filename)
+
+    def shards(self, start_time=None, end_time=None):
+        "The manifest entries of the (unarchived) shards that may hold data from the given time range, in time order."
+
+        shards = []
+        for shard in self.manifest["shards"]:
+            if shard["archived"]:
+                continue
+            if end_time != None and shard["start_time"] - self.overlap > end_time:
+                continue
+            if start_time != None and shard["end_time"] <= start_time:
+                continue
+            shards.append(shard)
+        return sorted(shards, key=lambda shard: shard["start_time"])
+
+    ##############################
+    # Recording
+    ##############################
+
+    def current_experiment(self):
+        "The Experiment for the current period, rolling over to a new shard if it's time to."
+
+        start_time = math.floor(clock.get_time() / self.period) * self.period
+        if self.current and self.current_shard["start_time"] == start_time:
+            return self.current
+
+        if self.current:
+            self.close_current()
+        self.open_shard(start_time)
+        return self.current
+
+    def open_shard(self, start_time):
+        "Open (or create) the shard for the period starting at start_time, to record to."
+
+        existing = [shard for shard in self.manifest["shards"] if shard["start_time"] == start_time and not shard["archived"]]
+        if existing:
+            shard = existing[0]
+        else:
+            name = time.strftime("%Y%m%d-%H%M%S", time.gmtime(start_time))
+            shard = {"filename": "%s.db" % name, "start_time": start_time, "end_time": start_time + self.period,
+                     "finalised": False, "archived": None}
+            with self.lock:
+                self.manifest["shards"].append(shard)
+
+        filename = self.path(shard["filename"])
+        self.close_reader(filename)
+        if os.path.exists(filename):
+            experiment = load_experiment(filename)
+        else:
+            experiment = new_experiment(filename, indexes=False) # The indexes are built when it's closed.
+
+        for anchor_id, location in sorted(self.anchors.items()):
+            if tuple(experiment.anchors.get(anchor_id, ())) != tuple(location):
+                experiment.update_anchor(anchor_id, location)
+        configuration_ids = experiment.configuration_ids()
+        for configuration in self.configurations:
+            if not configuration[-1] in configuration_ids:
+                experiment.register_configuration(*configuration)
+        experiment.configuration_id = self.configuration_id
+
+        # Carry over the ground truth in progress.
+        for ground_truth_id, row in sorted(self.ground_truth_rows.items()):
+            if not shard["filename"] in self.ground_truth_shards[ground_truth_id]:
+                experiment.cursor.execute(self.insert_ground_truth_sql, (ground_truth_id,) + row)
+                self.ground_truth_shards[ground_truth_id].append(shard["filename"])
+        experiment.connection.commit()
+        experiment.reload_ground_truth()
+
+        if self.recording:
+            experiment.start_recording(*self.recording)
+
+        self.current = experiment
+        self.current_shard = shard
+        with self.lock:
+            shard["finalised"] = False
+        self.save_manifest()
+        logging.info("Recording experiment to %s" % filename)
+
+    def close_current(self):
+        "Stop recording to the current shard, and have it finalised (and old shards archived) in the background."
+
+        self.current.stop_recording()
+        self.current.close()
+        self.jobs.put((self.finalise, (self.current_shard,)))
+        if self.archive_after:
+            open_shards = set(itertools.chain(*self.ground_truth_shards.values()))
+            self.jobs.put((self.archive, (clock.get_time() - self.archive_after, open_shards)))
+        self.current = None
+        self.current_shard = None
+
+    def start_recording(self, commit_size=1000, commit_interval=1.0):
+        "As Experiment.start_recording, for each shard in turn."
+
+        self.recording = (commit_size, commit_interval)
+        self.current_experiment().start_recording(commit_size, commit_interval)
+
+    def stop_recording(self):
+        self.recording = None
+        if self.current:
+            self.current.stop_recording()
+
+    def create_indexes(self):
+        "Build the current shard's indexes."
+        self.current_experiment().create_indexes()
+
+    def append_ground_truth_distances(self):
+        "Add the ground truth distances to the current shard, and wait for the other shards to be finished."
+
+        self.current_experiment().append_ground_truth_distances()
+        with self.lock:
+            self.current_shard["finalised"] = True
+        self.save_manifest()
+        self.close()
+
+    def close(self):
+        "Wait for the background thread to finish updating (and archiving) the closed shards, and close the shards opened for queries."
+
+        if self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join()
+        for filename in self.readers.keys():
+            self.close_reader(filename)
+
+    def add_anchor(self, anchor_id, location):
+        "Add (or update) an anchor, in every shard from now on. (When carrying on an experiment, the anchors may already be there.)"
+
+        experiment = self.current_experiment()
+        self.anchors[anchor_id] = location
+        if tuple(experiment.anchors.get(anchor_id, ())) != tuple(location):
+            experiment.update_anchor(anchor_id, location)
+
+    update_anchor = add_anchor
+
+    def register_configuration(self, configuration_name="", configuration_text="", locmod_name="", locmod_text=""):
+        "Register a new configuration (in every shard from now on), which new estimates will be associated with."
+
+        experiment = self.current_experiment()
+        with self.lock:
+            configuration_id = self.manifest["next_configuration_id"]
+            self.manifest["next_configuration_id"] += 1
+        self.save_manifest()
+
+        configuration = (configuration_name, configuration_text, locmod_name, locmod_text, configuration_id)
+        self.configurations.append(configuration)
+        experiment.register_configuration(*configuration)
+        self.configuration_id = configuration_id
+
+    def add_reading(self, anchor_id, tag_id, distance, ground_truth=None, timestamp=None):
+        self.current_experiment().add_reading(anchor_id, tag_id, distance, ground_truth, timestamp)
+
+    def add_readings(self, readings, ground_truth_id=None):
+        self.current_experiment().add_readings(readings, ground_truth_id)
+
+    def add_estimate(self, tag_id, x, y):
+        self.current_experiment().add_estimate(tag_id, x, y)
+
+    ##############################
+    # Ground truth
+    ##############################
+
+    insert_ground_truth_sql = "INSERT INTO ground_truth (id, label, tag_id, start_time, start_x, start_y) VALUES (?, ?, ?, ?, ?, ?)"
+    def start_ground_truth(self, tag_id, label, location):
+        "As Experiment.start_ground_truth, with an ID unique across the shards."
+
+        experiment = self.current_experiment()
+        with self.lock:
+            ground_truth_id = self.manifest["next_ground_truth_id"]
+            self.manifest["next_ground_truth_id"] += 1
+        self.save_manifest()
+
+        x, y = location
+        row = (label, tag_id, clock.get_time(), x, y)
+        experiment.cursor.execute(self.insert_ground_truth_sql, (ground_truth_id,) + row)
+        experiment.connection.commit()
+        experiment.reload_ground_truth()
+
+        self.ground_truth_rows[ground_truth_id] = row
+        self.ground_truth_shards[ground_truth_id] = [self.current_shard["filename"]]
+        return ground_truth_id
+
+    def end_ground_truth(self, ground_truth_id, location=None, label=None):
+        "As Experiment.end_ground_truth, in each shard holding the ground truth."
+
+        experiment = self.current_experiment()
+        end_time = clock.get_time()
+        if location == None:
+            x, y = None, None
+        else:
+            x, y = location
+        statements = [(Experiment.end_ground_truth_sql, (end_time, x, y, ground_truth_id))]
+        if label != None:
+            statements.append((Experiment.update_ground_truth_label_sql, (label, ground_truth_id)))
+
+        if self.update_ground_truth(ground_truth_id, statements):
+            experiment.end_ground_truth(ground_truth_id, location, label)
+
+    def cancel_ground_truth(self, ground_truth_id):
+        "As Experiment.cancel_ground_truth, in each shard holding the ground truth."
+
+        experiment = self.current_experiment()
+        statements = [(statement, (ground_truth_id,)) for statement in Experiment.cancel_ground_truth_sql]
+
+        if self.update_ground_truth(ground_truth_id, statements):
+            experiment.cancel_ground_truth(ground_truth_id)
+
+    def update_ground_truth(self, ground_truth_id, statements):
+        """
+        The ground truth is no longer in progress: have the statements done (in the background) on the closed shards holding it,
+        and those shards finalised again. Whether it needs doing on the current shard too.
+        """
+
+        self.ground_truth_rows.pop(ground_truth_id, None)
+        filenames = self.ground_truth_shards.pop(ground_truth_id, [self.current_shard["filename"]])
+        for filename in filenames:
+            if filename != self.current_shard["filename"]:
+                shard = [shard for shard in self.manifest["shards"] if shard["filename"] == filename][0]
+                self.jobs.put((self.update_shard, (shard, statements)))
+                self.jobs.put((self.finalise, (shard,)))
+        return self.current_shard["filename"] in filenames
+
+    def apply_ground_truth_info(self, tag_id, location, action, reference_name):
+        "Take note of new ground truth info (see Experiment.apply_ground_truth_info)."
+
+        if tag_id in self.partial_ground_truths:
+            self.partial_ground_truths[tag_id].finalise(reference_name, action, location)
+            del self.partial_ground_truths[tag_id]
+
+        if not action == GroundTruthAction.abandoned_code:
+            self.partial_ground_truths[tag_id] = PartialGroundTruth(self, tag_id, location, reference_name, action)
+
+    ##############################
+    # Background thread
+    ##############################
+
+    def run(self):
+        "Background thread: do the jobs queued (function, arguments) until close is called."
+
+        while True:
+            job = self.jobs.get()
+            if job == None:
+                break
+            function, args = job
+            try:
+                function(*args)
+            except Exception, e:
+                logging.error("Error in experiment %s (%s): %s" % (self.directory, function.__name__, str(e)))
+
+    def update_shard(self, shard, statements):
+        "Execute the statements on a closed shard."
+
+        if shard["archived"]:
+            logging.warning("Not updating archived experiment shard %s" % shard["filename"])
+            return
+        experiment = load_experiment(self.path(shard["filename"]))
+        for sql, args in statements:
+            experiment.cursor.execute(sql, args)
+        experiment.connection.commit()
+        experiment.close()
+
+    def finalise(self, shard):
+        "Build the indexes and ground truth distances of a closed shard."
+
+        if shard["archived"]:
+            return
+        filename = self.path(shard["filename"])
+        experiment = load_experiment(filename)
+        experiment.create_indexes()
+        experiment.append_ground_truth_distances()
+        experiment.close()
+        for database in [filename] + self.estimate_databases(filename):
+            checkpoint(database)
+        with self.lock:
+            shard["finalised"] = True
+        self.save_manifest()
+        logging.info("Finalised experiment shard %s" % shard["filename"])
+
+    def archive(self, before_time, open_shards=()):
+        """
+        Compress the finalised shards that ended before the given time into the archive directory, out of the way of queries.
+        Those in open_shards (holding ground truth in progress) are left for now.
+        """
+
+        directory = self.path(archive_dirname)
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+
+        with self.lock:
+            shards = list(self.manifest["shards"])
+        for shard in shards:
+            if shard["archived"] or not shard["finalised"] or shard["end_time"] > before_time or shard["filename"] in open_shards:
+                continue
+
+            filename = self.path(shard["filename"])
+            archived = os.path.join(archive_dirname, shard["filename"] + ".gz")
+            source = open(filename, "rb")
+            destination = gzip.open(self.path(archived), "wb")
+            shutil.copyfileobj(source, destination)
+            destination.close()
+            source.close()
+
+            estimates = schema.estimates_directory(filename)
+            archived_estimates = None
+            if os.path.exists(estimates):
+                archived_estimates = os.path.join(archive_dirname, os.path.basename(estimates) + ".tar.gz")
+                archive = tarfile.open(self.path(archived_estimates), "w:gz")
+                archive.add(estimates, arcname=os.path.basename(estimates))
+                archive.close()
+
+            with self.lock:
+                if archived_estimates:
+                    shard["archived_estimates"] = archived_estimates
+                shard["archived"] = archived
+            self.save_manifest()
+            os.remove(filename)
+            if os.path.exists(estimates):
+                shutil.rmtree(estimates)
+            logging.info("Archived experiment shard %s" % archived)
+
+    def estimate_databases(self, filename):
+        "The files of a shard's estimate databases (one per configuration)."
+
+        estimates = schema.estimates_directory(filename)
+        if not os.path.exists(estimates):
+            return []
+        return [os.path.join(estimates, name) for name in sorted(os.listdir(estimates)) if name.endswith(".db")]
+
+    ##############################
+    # Queries, across the shards.
+    ##############################
+
+    def shard_experiment(self, shard):
+        "The Experiment for a shard, to query (closing the least recently used readers, beyond max_readers)."
+
+        if self.current_shard and shard["filename"] == self.current_shard["filename"]:
+            return self.current
+        filename = self.path(shard["filename"])
+        experiment = self.readers.pop(filename, None)
+        if experiment == None:
+            experiment = load_experiment(filename)
+        self.readers[filename] = experiment
+
+        excess = len(self.readers) - self.max_readers
+        for filename in self.readers.keys():
+            if excess <= 0:
+                break
+            if not self.readers_in_use.get(filename):
+                self.close_reader(filename)
+                excess -= 1
+        return experiment
+
+    def close_reader(self, filename):
+        experiment = self.readers.pop(filename, None)
+        if experiment:
+            experiment.close()
+
+    def experiments(self, start_time=None, end_time=None):
+        "An iterator over the Experiments for the shards that may hold data from the given time range, in time order."
+
+        for shard in self.shards(start_time, end_time):
+            yield self.shard_experiment(shard)
+
+    def shard_rows(self, function, start_time=None, end_time=None):
+        "An iterator over the rows of function(experiment) for each shard in turn, keeping the shard open until they're read."
+
+        for shard in self.shards(start_time, end_time):
+            experiment = self.shard_experiment(shard)
+            filename = self.path(shard["filename"])
+            self.readers_in_use[filename] = self.readers_in_use.get(filename, 0) + 1
+            try:
+                for row in function(experiment):
+                    yield row
+            finally:
+                self.readers_in_use[filename] -= 1
+
+    def latest_experiment(self):
+        shards = self.shards()
+        if shards:
+            return self.shard_experiment(shards[-1])
+        return None
+
+    def query(self, sql, args=(), start_time=None, end_time=None):
+        "The rows from each shard (for the time range, if given), in time order of the shards, as a ShardRows."
+        return ShardRows(self.shard_rows(lambda experiment: experiment.query(sql, args), start_time, end_time))
+
+    def tag_ids(self):
+        return sorted(set(itertools.chain(*[experiment.tag_ids() for experiment in self.experiments()])))
+
+    def ground_truth_ids(self):
+        return sorted(set(itertools.chain(*[experiment.ground_truth_ids() for experiment in self.experiments()])))
+
+    def ground_truth_details(self, ground_truth_id):
+        "The details from the last shard holding the ground truth."
+
+        for shard in reversed(self.shards()):
+            details = self.shard_experiment(shard).ground_truth_details(ground_truth_id)
+            if details:
+                return details
+        return None
+
+    def tag_id_for_ground_truth(self, ground_truth_id):
+        for experiment in self.experiments():
+            if experiment.ground_truth_details(ground_truth_id):
+                return experiment.tag_id_for_ground_truth(ground_truth_id)
+        raise Exception("No ground truth with ID %d" % ground_truth_id)
+
+    def ground_truth_estimate_info(self, configuration_id, ground_truth_id):
+        "As Experiment.ground_truth_estimate_info, from each shard holding the ground truth in turn."
+
+        info = [], [], [], []
+        for experiment in self.experiments():
+            if experiment.ground_truth_details(ground_truth_id):
+                for results, shard_results in zip(info, experiment.ground_truth_estimate_info(configuration_id, ground_truth_id)):
+                    results.extend(shard_results)
+        return info
+
+    def configuration_ids(self):
+        return sorted(set(itertools.chain(*[experiment.configuration_ids() for experiment in self.experiments()])))
+
+    def ground_truth_at(self, tag_id, timestamps):
+        "As Experiment.ground_truth_at, looking in the shards for the times given."
+
+        timestamps = numpy.asarray(timestamps, dtype=float)
+        positions = numpy.empty((len(timestamps), 2))
+        positions.fill(numpy.nan)
+        ids = numpy.empty(len(timestamps), dtype=numpy.int64)
+        ids.fill(-1)
+        if not len(timestamps):
+            return positions, ids
+
+        for experiment in self.experiments(timestamps.min(), timestamps.max()):
+            missing = ids < 0
+            if not missing.any():
+                break
+            shard_positions, shard_ids = experiment.ground_truth_at(tag_id, timestamps[missing])
+            positions[missing] = shard_positions
+            ids[missing] = shard_ids
+        return positions, ids
+
+    def ground_truth_id(self, tag_id, timestamp=None):
+        if timestamp == None:
+            timestamp = clock.get_time()
+        for experiment in self.experiments(timestamp, timestamp):
+            ground_truth_id = experiment.ground_truth_id(tag_id, timestamp)
+            if ground_truth_id != None:
+                return ground_truth_id
+        return None
+
+    def ground_truth(self, tag_id, timestamp=None):
+        if timestamp == None:
+            timestamp = clock.get_time()
+        for experiment in self.experiments(timestamp, timestamp):
+            ground_truth = experiment.ground_truth(tag_id, timestamp)
+            if ground_truth:
+                return ground_truth
+        return None
+
+    def distance_readings(self, start_time=None, end_time=None):
+        "An iterator over the readings (of the shards for the given time range)."
+        return self.shard_rows(lambda experiment: experiment.distance_readings(), start_time, end_time)
+
+    def observations(self, tag_ids=None, anchor_ids=None, start_time=None, end_time=None):
+        "As Experiment.observations, shard by shard (so a frame running over the end of a shard is left out)."
+
+        if anchor_ids == None:
+            anchor_ids = self.anchors.keys()
+        return self.shard_rows(lambda experiment: experiment.observations(tag_ids, anchor_ids), start_time, end_time)
+
+    def estimates(self, configuration_id, start_time=None, end_time=None):
+        return self.shard_rows(lambda experiment: experiment.estimates(configuration_id), start_time, end_time)
+
+    def to_columns(self):
+        """
+        As Experiment.to_columns, with each shard's columns joined (in memory, rather than memory-mapped).
+        The IDs are those in each shard, so distance_reading and estimate IDs repeat across the shards.
+        Ground truth carried over from shard to shard is given once (as in the last shard holding it).
+        """
+
+        shards = [experiment.to_columns() for experiment in self.experiments()]
+        result = {}
+        for table, names in columns.table_columns.iteritems():
+            result[table] = {}
+            for name, dtype in names:
+                result[table][name] = numpy.concatenate([numpy.asarray(shard[table][name]) for shard in shards] or
+                                                        [numpy.zeros(0, dtype=dtype)])
+
+        ground_truth = result["ground_truth"]
+        ids, last = numpy.unique(ground_truth["id"][::-1], return_index=True)
+        rows = len(ground_truth["id"]) - 1 - last
+        for name in ground_truth:
+            ground_truth[name] = ground_truth[name][rows]
+        return result
+
+    def clear_generated_data(self, configuration_id=None):
+        "As Experiment.clear_generated_data, in every shard (the configurations cleared aren't registered in new shards)."
+
+        for experiment in self.experiments():
+            experiment.clear_generated_data(configuration_id)
+        self.configurations = [configuration for configuration in self.configurations
+                               if configuration_id and configuration[-1] != configuration_id]
+        if self.configuration_id and (not configuration_id or self.configuration_id == configuration_id):
+            self.configuration_id = None
+
+if __name__ == "__main__":
+
+    import sys
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("-e", "--experiment", dest="experiment",
+                      help="The directory of the partitioned experiment.", metavar="DIR")
+    parser.add_option("-l", "--list", action="store_true", default=False,
+                      help="List the shards.")
+    parser.add_option("-a", "--archive", dest="archive", type="float",
+                      help="Archive the shards that ended more than this many days ago (not while it's being recorded to).")
+
+    (options, args) = parser.parse_args()
+
+    if not options.experiment or not os.path.exists(os.path.join(options.experiment, manifest_filename)):
+        sys.exit("No partitioned experiment. Seek help (-h).")
+
+    manifest = json.load(open(os.path.join(options.experiment, manifest_filename)))
+    experiment = PartitionedExperiment(options.experiment, manifest["partition"])
+
+    if options.archive != None:
+        experiment.archive(time.time() - options.archive * 86400)
+
+    if options.list:
+        for shard in experiment.manifest["shards"]:
+            state = shard["archived"] and "archived" or (shard["finalised"] and "finalised" or "open")
+            print "%s  %s - %s  %s" % (shard["filename"], time.strftime("%Y-%m-%d %H:%M", time.gmtime(shard["start_time"])),
+                                       time.strftime("%Y-%m-%d %H:%M", time.gmtime(shard["end_time"])), state)
+
+    experiment.close()
@@ -0,0 +1,133 @@
+"""
+Write the live recording of an experiment from a background thread, committing in groups.
+
+Committing each reading as it arrives means an fsync for every one, on the main loop.
+Instead, the inserts are queued, and a writer thread (with its own connection to the database) does them
+with executemany, committing once enough rows have built up or enough time has passed.
+The database is switched to WAL journaling, so the main connection can still read while the writer writes.
+
+If a group can't be written, it's rolled back (so none of it is committed with the next group). If the database was
+just busy (locked by another connection's write), the group is tried again later, up to max_retries times;
+otherwise (or after that) its rows are lost, and counted.
+
+See Experiment.start_recording and Experiment.stop_recording.
+"""
+
+import time
+import sqlite3
+import logging
+import threading
+import Queue
+
+from Almada.clock import shared_clock as clock
+
+def is_busy(error):
+    "Is the sqlite3 error just that another connection has the database locked?"
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error))
+
+class RecordingWriter(object):
+    """Inserts into an SQLite database, done in groups by a background thread."""
+
+    max_retries = 10 # Attempts at writing a group while the database is busy, before its rows are given up on.
+
+    def __init__(self, filename, commit_size=1000, commit_interval=1.0, queue_size=10000):
+        """
+        filename - The database file.
+        commit_size - Commit once this many rows are waiting.
+        commit_interval - Commit at least this often (seconds), if there's anything waiting.
+        queue_size - The most inserts to have queued before add waits for the writer.
+        """
+
+        super(RecordingWriter, self).__init__()
+
+        self.filename = filename
+        self.commit_size = commit_size
+        self.commit_interval = commit_interval
+        self.queue = Queue.Queue(queue_size)
+        self.error = None # The last error writing.
+        self.lost_rows = 0 # Rows given up on, in total.
+        self.retries = 0 # Attempts so far at writing the current group.
+
+        self.thread = threading.Thread(target=self.run, name="RecordingWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, sql, rows):
+        "Queue rows to be inserted with the given statement. Waits only if the queue is full."
+
+        if rows:
+            self.queue.put((sql, rows))
+
+    def close(self):
+        "Write and commit everything queued so far, then stop the writer thread."
+
+        self.queue.put(None)
+        self.thread.join()
+        if self.lost_rows:
+            logging.error("Recording writer for %s lost %d rows (last error: %s)" % (self.filename, self.lost_rows, self.error))
+
+    def write(self, pending):
+        "Insert the pending rows (statement -> rows, in the order they were queued), and commit."
+
+        for sql, rows in pending:
+            self.cursor.executemany(sql, rows)
+        self.connection.commit()
+
+    def write_pending(self, pending, pending_rows):
+        "Write the pending rows. Whether they're done with: written, or given up on (busy errors are left to retry)."
+
+        try:
+            self.write(pending)
+        except sqlite3.Error, e:
+            self.connection.rollback()
+            self.error = e
+            if is_busy(e) and self.retries < self.max_retries:
+                self.retries += 1
+                logging.warning("Database %s busy, will retry %d rows (attempt %d): %s" % (self.filename, pending_rows, self.retries, str(e)))
+                return False
+            self.lost_rows += pending_rows
+            logging.error("Error writing %d rows to %s, given up on (%d lost in total): %s" % (pending_rows, self.filename, self.lost_rows, str(e)))
+        self.retries = 0
+        return True
+
+    def run(self):
+        "Background thread: take inserts from the queue, and write them in groups until close is called."
+
+        self.connection = sqlite3.connect(self.filename)
+        self.cursor = self.connection.cursor()
+
+        pending = [] # (sql, rows), grouped by statement while consecutive.
+        pending_rows = 0
+        last_commit_time = clock.get_time()
+        closing = False
+
+        while not closing:
+            timeout = max(self.commit_interval - (clock.get_time() - last_commit_time), 0.01)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                item = False
+
+            if item == None:
+                closing = True
+            elif item:
+                sql, rows = item
+                if pending and pending[-1][0] == sql:
+                    pending[-1][1].extend(rows)
+                else:
+                    pending.append((sql, list(rows)))
+                pending_rows += len(rows)
+
+            due = clock.get_time() - last_commit_time >= self.commit_interval
+            if pending and (closing or due or pending_rows >= self.commit_size):
+                if self.write_pending(pending, pending_rows):
+                    pending = []
+                    pending_rows = 0
+                last_commit_time = clock.get_time() # If busy, it's retried after another interval.
+            elif not pending:
+                last_commit_time = clock.get_time() # The interval runs from the first row waiting.
+
+        while pending and not self.write_pending(pending, pending_rows):
+            time.sleep(self.commit_interval)
+
+        self.connection.close()
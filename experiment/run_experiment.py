@@ -15,9 +15,13 @@ from Almada.clock import shared_clock as clock
 from Almada.config import Config, ConfigError
 from Almada.location.locmod import new_locmod
 from Almada.experiment.experiment_db import load_experiment
+from Almada.capture import load_capture
         
-def run_locmod(experiment, locmod, config):
-    "Run the locmod for a particular configuration against the distance readings to generate a new set of estimates."
+def run_locmod(experiment, locmod, config, readings=None):
+    """
+    Run the locmod for a particular configuration against the distance readings to generate a new set of estimates.
+    The readings are (anchor_id, tag_id, distance, timestamp) tuples, from the experiment unless given (from a capture, for example).
+    """
 
     last_anchor_id = 0
 
@@ -26,8 +30,11 @@ def run_locmod(experiment, locmod, config):
     experiment.register_configuration(config.filename, config.text, config.locmod_filename, config.locmod_text)
 
 
-    sql = "SELECT anchor_id, tag_id, distance, timestamp FROM distance_reading ORDER BY timestamp"
-    for anchor_id, tag_id, distance, timestamp in experiment.query(sql):
+    if readings == None:
+        sql = "SELECT anchor_id, tag_id, distance, timestamp FROM distance_reading ORDER BY timestamp"
+        readings = experiment.query(sql)
+
+    for anchor_id, tag_id, distance, timestamp in readings:
 
         # Skip if the reading is not relavent to this configuration
         if not anchor_id in config.anchors:
@@ -48,8 +55,7 @@ def run_locmod(experiment, locmod, config):
                     gx, gy = ground_truth
                     error = math.hypot(x - gx, y - gy)
                     ground_truth_id = experiment.ground_truth_id(tag_id)
-                    sql = "INSERT INTO estimate(tag_id, x, y, timestamp, ground_truth_id, error, configuration_id) VALUES (?, ?, ?, ?, ?, ?, ?)"
-                    experiment.cursor.execute(sql, (tag_id, x, y, clock.get_time(), ground_truth_id, error, experiment.configuration_id))
+                    experiment.add_full_estimate(tag_id, x, y, clock.get_time(), ground_truth_id, error)
                     logging.debug("Inserted estimate: (%06.2f, %06.2f) error %05.2fm from (%06.2f, %06.2f)" % (x, y, error, gx, gy))
                 else:
                     logging.debug("Not adding estimate, location not known.")
@@ -59,7 +65,7 @@ def run_locmod(experiment, locmod, config):
 
         last_anchor_id = anchor_id
 
-    experiment.connection.commit()
+    experiment.commit()
         
             
 if __name__ == "__main__":
@@ -81,6 +87,8 @@ if __name__ == "__main__":
                              help="Run all posible configs unless c or C are provided")
     option_parser.add_option("-d", "--working_dir", dest="working_dir",
                              help="The working directory for the above files")
+    option_parser.add_option("-k", "--capture", dest="capture",
+                             help="Run against the readings in this capture file, instead of those in the experiment.")
     option_parser.add_option("-l", "--log_level", dest="log_level", type="int",
                              help="The log level.", default=30)
     option_parser.add_option("-o", "--log_file", dest="log_file",
@@ -110,6 +118,12 @@ if __name__ == "__main__":
     experiment_filename = os.path.join(working_dir, options.experiment)
     experiment = load_experiment(experiment_filename)
 
+    capture = None
+    if options.capture:
+        capture = load_capture(os.path.join(working_dir, options.capture))
+        if capture == None:
+            sys.exit("Capture not found: %s" % options.capture)
+
     if options.all:
         config_names = [os.path.split(path)[1] for path in glob.glob("%s/*.cfg" % working_dir)]
         locmod_config_names = [os.path.split(path)[1] for path in glob.glob("%s/*.lcfg" % working_dir)]
@@ -151,4 +165,7 @@ if __name__ == "__main__":
 
             locmod = new_locmod(config)
 
-            run_locmod(experiment, locmod, config)
+            readings = None
+            if capture:
+                readings = capture.readings()
+            run_locmod(experiment, locmod, config, readings)
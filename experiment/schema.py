@@ -6,6 +6,8 @@ The schema for the experiment database.
 Philip Blackwell September 2009
 """
 
+import os
+
 create_table_distance_reading_comment = """
 # distance_reading Table:
 # Each Tag-Anchor Distance reading as reported by the Base (with error code 0)
@@ -78,21 +80,131 @@ CREATE TABLE estimate (id INTEGER PRIMARY KEY,
                        error REAL,
                        configuration_id);"""
 
+create_table_distance_summary_comment = """
+# distance_summary Table:
+# Older distance readings, downsampled by compaction: for each tag, anchor and time bucket,
+# the number of readings, their median and spread (interquartile range).
+"""
+
+create_table_distance_summary_sql = """
+CREATE TABLE IF NOT EXISTS distance_summary (id INTEGER PRIMARY KEY,
+                                             anchor_id INTEGER(4),
+                                             tag_id INTEGER(4),
+                                             start_time REAL,
+                                             end_time REAL,
+                                             count INTEGER,
+                                             median REAL,
+                                             spread REAL);"""
+
+create_table_compaction_comment = """
+# compaction Table:
+# How far compaction has got: readings before compacted_until have been summarised (unless kept),
+# into buckets of this many seconds (which later compactions have to stick to).
+"""
+
+create_table_compaction_sql = """
+CREATE TABLE IF NOT EXISTS compaction (id INTEGER PRIMARY KEY,
+                                       compacted_until REAL,
+                                       bucket REAL);"""
+
+# Tables added since the first version (created by create_indexes, if they're missing).
+create_later_tables_sql = [create_table_distance_summary_sql,
+                           create_table_compaction_sql]
+
 create_database_sql = [create_table_distance_reading_sql, 
                        create_table_anchor_sql, 
                        create_table_ground_truth_sql,
                        create_table_configuration_sql,
-                       create_table_estimate_sql]
+                       create_table_estimate_sql] + create_later_tables_sql
 
-def create_database(cursor):
-    "Execute the sql to create the database."
+create_indexes_comment = """
+# Indexes:
+# Readings are nearly always taken in time order, or picked out by tag or ground truth entry.
+# Ground truth is looked up by tag and time, estimates by configuration (and ground truth), in time order.
+# Some include the columns the queries want, so the table itself needn't be read.
+"""
+
+create_timestamp_index_sql = "CREATE INDEX IF NOT EXISTS distance_reading_timestamp ON distance_reading (timestamp);"
+
+create_indexes_sql = [
+create_timestamp_index_sql,
+"CREATE INDEX IF NOT EXISTS distance_reading_tag_id ON distance_reading (tag_id, timestamp);",
+"CREATE INDEX IF NOT EXISTS distance_reading_ground_truth_id ON distance_reading (ground_truth_id, anchor_id, timestamp);",
+"CREATE INDEX IF NOT EXISTS ground_truth_tag_id ON ground_truth (tag_id, start_time, end_time, id);",
+"CREATE INDEX IF NOT EXISTS distance_summary_tag_id ON distance_summary (tag_id, anchor_id, start_time);"]
+
+create_estimate_indexes_sql = [
+"CREATE INDEX IF NOT EXISTS estimate_configuration_id ON estimate (configuration_id, timestamp);",
+"CREATE INDEX IF NOT EXISTS estimate_ground_truth_id ON estimate (configuration_id, ground_truth_id, timestamp, x, y);"]
+
+create_indexes_sql += create_estimate_indexes_sql
+
+create_estimate_database_comment = """
+# Estimate databases:
+# Each configuration registered has its estimates in a database of its own (just the estimate table),
+# in a directory next to the experiment database (experiment.db -> experiment.db.estimates/1.db, ...).
+# So they can be written in parallel, and cleared by deleting the file.
+# Estimates for configurations from before are in the experiment database's own estimate table.
+"""
+
+def estimates_directory(database_filename):
+    return database_filename + ".estimates"
+
+def estimate_filename(database_filename, configuration_id):
+    return os.path.join(estimates_directory(database_filename), "%d.db" % configuration_id)
+
+def create_estimate_database(cursor):
+    "Execute the sql to create a configuration's estimate database."
+    cursor.execute(create_table_estimate_sql)
+    for statement in create_estimate_indexes_sql:
+        cursor.execute(statement)
+
+# The schema version is kept in the database's user_version:
+# 0 (or 1) - The tables only.
+# 2 - With the indexes.
+# 3 - With the distance_summary and compaction tables.
+schema_version = 3
+
+def get_schema_version(cursor):
+    return cursor.execute("PRAGMA user_version").fetchone()[0]
+
+def create_database(cursor, indexes=True):
+    """
+    Execute the sql to create the database.
+    The indexes can be left until later (create_indexes), so a bulk load doesn't have to keep them up to date.
+    """
     for statement in create_database_sql:
         cursor.execute(statement)
+    cursor.execute("PRAGMA user_version = 1")
+    if indexes:
+        create_indexes(cursor)
+
+def create_later_tables(cursor):
+    "Create the tables added since the first version, if they're missing (without building any indexes)."
+    for statement in create_later_tables_sql:
+        cursor.execute(statement)
+
+def create_indexes(cursor):
+    "Build the indexes (if they aren't there already), and bring the schema up to date."
+    create_later_tables(cursor)
+    for statement in create_indexes_sql:
+        cursor.execute(statement)
+    cursor.execute("ANALYZE;")
+    cursor.execute("PRAGMA user_version = %d" % schema_version)
+
+def migrate(cursor):
+    "Upgrade an existing database to the current schema, in place. Whether anything needed doing."
+    
+    version = get_schema_version(cursor)
+    if version >= schema_version:
+        return False
+    create_indexes(cursor)
+    return True
     
 def dump_sql(f):
     "Dump the sql to create the database to the given file 'f'."
 
-    for statement in create_database_sql:
+    for statement in create_database_sql + create_indexes_sql:
         f.write ("%s\n" % statement)
 
 if __name__ == "__main__":
@@ -4,6 +4,7 @@ A TCP/IP interface to any Infield Devices.
 Philip Blackwell 2009-09-25
 """
 
+import errno
 import logging
 import re
 import socket
@@ -11,6 +12,7 @@ import socket
 from Almada.experiment.ground_truth import GroundTruthAction
 from Almada.experiment.sound import action_sounds
 from Almada.config import DEFAULT_IFD_PORT
+from Almada.stats import shared_stats as stats
 
 class InfieldDeviceServer(object):
     """
@@ -30,6 +32,7 @@ class InfieldDeviceServer(object):
         self.sequence = sequence
         self.port = port
         self.clients = []        
+        self.send_buffers = {} # client -> data waiting to be sent
         
         print self.reference_points
         print self.sequence
@@ -42,6 +45,32 @@ class InfieldDeviceServer(object):
         self.socket.bind(('', self.port))
         self.socket.listen(10) # 10 queued connections
         
+    def send(self, client, data):
+        "Buffer data for the client, and send as much as it will take now."
+        
+        self.send_buffers[client] = self.send_buffers.get(client, "") + data
+        self.send_pending(client)
+        
+    def send_pending(self, client):
+        "Send as much of the client's buffer as we can without blocking."
+        
+        data = self.send_buffers.get(client)
+        if not data:
+            return
+            
+        try:
+            sent = client.send(data)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        self.send_buffers[client] = data[sent:]
+        
+    def writers(self):
+        "The clients with buffered data waiting for their socket to be writable."
+        
+        return [client for client, data in self.send_buffers.iteritems() if data]
+        
     def service_client_request(self, request, client):
         """
         Service a request from an Infield Device.
@@ -54,7 +83,7 @@ class InfieldDeviceServer(object):
             for tag_id in self.tag_ids:
                 tag_ids += " %d" % tag_id
             logging.info("Sending tags response: %s" % tag_ids)
-            client.send("%s\r\n" % tag_ids)
+            self.send(client, "%s\r\n" % tag_ids)
         if request.lower() == "reference":
             if self.sequence:
                 reference_point_labels = self.sequence
@@ -63,7 +92,9 @@ class InfieldDeviceServer(object):
                 reference_point_labels.sort()
             response = "Reference Points: " + " ".join(reference_point_labels)
             logging.info("Sending reference points response: %s" % response)
-            client.send("%s\r\n" % response)
+            self.send(client, "%s\r\n" % response)
+        if request.lower() == "stats":
+            self.send(client, stats.text())
 
     arrived_re = re.compile("Tag ([0-9]+) Arrived at Reference (.*)")
     passed_re = re.compile("Tag ([0-9]+) Passed Reference (.*)")
@@ -115,10 +146,12 @@ class InfieldDeviceServer(object):
         else:
             logging.info("IFD: Dropping client connection")
             self.clients.remove(client)
+            self.send_buffers.pop(client, None)
 
     def accept_client(self):
         """Accept a new client on the socket."""
         conn, addr = self.socket.accept()
+        conn.setblocking(0)
         self.clients.append(conn)
         logging.info("IFD: New client connection: %s" % (str(addr)))
 
@@ -6,12 +6,20 @@ Should also be able to get config.
 
 FIXME: Updates should be done as frequently as possible, then filtered appropriately in the backend. 
        (As it is, updates are simply limited to 1Hz.)
+
+Once connected, the socket is non-blocking. Updates are buffered, and sent as the backend is ready for them,
+so a slow backend never holds up the caller. (The owner should call send_pending when the socket is writable.)
+
+While disconnected, the latest location for each tag is held (up to max_held_tags), and sent once reconnected.
 """
 
+import errno
 import logging
 import socket
 
 from Almada.clock import shared_clock as clock
+from Almada.stats import shared_stats as stats
+from Almada.reconnect import start_connect, finish_connect
 
 class LatServer(object):
     """docstring for LatServer"""
@@ -23,21 +31,108 @@ class LatServer(object):
         self.hostname = hostname
         self.port = port    
         self.tags = {}
+        self.reading_times = {} # tag_id -> when the newest reading behind its latest location was received (for tracing).
         self.update_period = 1.0
         self.last_update_time = 0.0
+        self.socket = None
+        self.connecting_socket = None # While connecting without waiting (see start_connect).
+        self.send_buffer = ""
+        self.mid_line = False # Whether the buffer starts with the rest of a line the backend has had part of.
+        self.max_send_buffer = 65536 # If the backend falls this far behind, drop what it hasn't taken.
+        self.max_held_tags = 1000 # The most tags to hold updates for while disconnected.
+        self.dropped_tag_updates = 0 # Updates not held because there were already too many tags.
             
     def connect(self):
         ""
         
         logging.info("Connecting to LAT backend server at %s:%d" % (self.hostname, self.port))
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.settimeout(1.0)
-        self.socket.connect((self.hostname, self.port))
+        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connection.settimeout(1.0)
+        connection.connect((self.hostname, self.port))
+        self.setup_connection(connection)
+        
+    def start_connect(self):
+        "Start connecting without waiting. The socket to wait on being writable, before calling finish_connect (see Reconnector)."
+        
+        logging.info("Connecting to LAT backend server at %s:%d" % (self.hostname, self.port))
+        self.connecting_socket = start_connect(self.hostname, self.port)
+        return self.connecting_socket
+        
+    def finish_connect(self):
+        "Once the socket from start_connect is writable, take it on (or raise an exception if it didn't connect)."
+        
+        connection, self.connecting_socket = self.connecting_socket, None
+        try:
+            finish_connect(connection)
+        except:
+            connection.close()
+            raise
+        self.setup_connection(connection)
+        
+    def setup_connection(self, connection):
+        "Take on a newly connected socket."
+        
+        connection.setblocking(0)
+        self.socket = connection
+        self.send_buffer = ""
+        self.mid_line = False
         logging.info("Connected to LAT backend server")
+        
+    def close(self):
+        "Close the connection. Anything buffered but not yet sent is lost."
+        
+        if self.socket:
+            self.socket.close()
+        self.socket = None
+        if self.connecting_socket:
+            self.connecting_socket.close()
+        self.connecting_socket = None
+        self.send_buffer = ""
+        self.mid_line = False
+        
+    def connected(self):
+        return self.socket != None
+            
+    def send(self, data):
+        "Buffer the data to be sent, and send as much as the backend will take now."
+        
+        if len(self.send_buffer) + len(data) > self.max_send_buffer:
+            # Drop whole lines only: the rest of a line the backend has had part of still has to go first.
+            kept = ""
+            if self.mid_line:
+                kept = self.send_buffer[:self.send_buffer.find("\n") + 1] or self.send_buffer
+            dropped_lines = self.send_buffer[len(kept):].count("\n")
+            logging.warning("LAT backend is not keeping up, dropping %d lines of updates" % dropped_lines)
+            self.send_buffer = kept
+        self.send_buffer += data
+        self.send_pending()
+        
+    def send_pending(self):
+        "Send as much of the buffer as we can without blocking."
+        
+        if not self.send_buffer:
+            return
+            
+        try:
+            sent = self.socket.send(self.send_buffer)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if sent:
+            self.mid_line = self.send_buffer[sent - 1] != "\n"
+        self.send_buffer = self.send_buffer[sent:]
+        
+    def wants_write(self):
+        "Whether there is buffered data waiting for the socket to be writable."
+        return bool(self.send_buffer)
             
                         
-    def send_tag_updates(self, tags):
-        "Send location information given in the dictionary 'tags' (tag_id -> location)"
+    def send_tag_updates(self, tags, reading_times={}):
+        """
+        Send location information given in the dictionary 'tags' (tag_id -> location)
+        reading_times - tag_id -> when the newest reading behind the location was received (for tracing), if known.
+        """
 
         # FIXME: Uses plain text interface. Should use proper LAT XML interface.
 
@@ -48,19 +143,49 @@ class LatServer(object):
             if not self.tags.has_key(tag_id):
                 self.tags[tag_id] = []
             self.tags[tag_id].append(location)
+        self.reading_times.update(reading_times)
+            
+        if not self.socket:
+            self.hold_tag_updates()
+            return result
             
         now = clock.get_time()
         if now - self.last_update_time > self.update_period:
             
+            updates = ""
             for tag_id, locations in self.tags.iteritems():
                 x, y = locations[-1]
                 result[tag_id] = x, y
                 logging.info("Sending tag update: %d (%.2f, %.2f)" % (tag_id, x, y))
-                if self.socket:
-                    self.socket.send("%d %.2f %.2f\r\n" % (tag_id, x, y))
+                updates += "%d %.2f %.2f\r\n" % (tag_id, x, y)
+            if updates:
+                self.send(updates)
+                self.trace(result.keys(), now)
             
             # Reset for next time.
             self.tags = {}
+            self.reading_times = {}
             self.last_update_time = clock.get_time()
             
         return result
+        
+    def trace(self, tag_ids, now):
+        "Record the age of a sample of the positions just sent (from when their newest reading was received)."
+        
+        for tag_id in tag_ids:
+            reading_time = self.reading_times.get(tag_id)
+            if reading_time != None and stats.sampled():
+                age = now - reading_time
+                stats.record("position_age", age)
+                logging.debug("Trace: tag %d position sent %.3f seconds after its newest reading was received" % (tag_id, age))
+        
+    def hold_tag_updates(self):
+        "While disconnected, keep only the latest location for each tag (for at most max_held_tags tags)."
+        
+        for tag_id in self.tags.keys():
+            self.tags[tag_id] = self.tags[tag_id][-1:]
+            
+        if len(self.tags) > self.max_held_tags:
+            for tag_id in sorted(self.tags)[self.max_held_tags:]:
+                del self.tags[tag_id]
+                self.dropped_tag_updates += 1
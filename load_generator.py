@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""
+A synthetic location server, for load testing.
+
+Simulates many tags wandering around the configured anchors, and sends the distance readings
+(with errors drawn from the measured error histogram) in the Nanotron line protocol,
+at a fixed aggregate rate, to every client that connects. Point an AlmadaServer at it
+and turn up the rate to find where it stops keeping up.
+
+Tags are ranged in turn, each against every anchor, with the anchor IDs in order (as the real location server does).
+Note that tag IDs above 999 don't fit the usual fixed width layout, so are parsed the slow way by LocationServer.
+"""
+
+import sys
+import logging
+
+import numpy
+
+from Almada.clock import shared_clock as clock
+from Almada.location_server import FakeServer, DEFAULT_LOCATION_SERVER_PORT, reading_dtype, format_lines
+from Almada.location.location_2d import expected_distances
+from Almada.location.distance_model import load_histogram
+
+class ErrorModel(object):
+    """Random distance errors, following a histogram (as from error_histogram.pickle)."""
+
+    def __init__(self, histogram):
+        super(ErrorModel, self).__init__()
+        p, bins = histogram
+        self.bins = numpy.array(bins)
+        self.widths = numpy.diff(self.bins)
+        self.cdf = numpy.cumsum(numpy.array(p) * self.widths)
+        self.cdf /= self.cdf[-1]
+
+    def sample(self, n):
+        "An array of n errors (uniform within the chosen bins)."
+
+        i = numpy.searchsorted(self.cdf, numpy.random.random(n))
+        return self.bins[i] + numpy.random.random(n) * self.widths[i]
+
+class LoadGenerator(FakeServer):
+    """A FakeServer sending readings for simulated tags at a fixed rate."""
+
+    def __init__(self, anchors, tag_count, rate, error_model=None, port=DEFAULT_LOCATION_SERVER_PORT,
+                 first_tag_id=1, max_speed=1.5, report_period=10.0):
+        """
+        anchors - {anchor_id: (x, y)}, as in Config.
+        tag_count - The number of tags to simulate.
+        rate - The readings (lines) per second to send, in total.
+        error_model - An ErrorModel for the distance errors (none if not given).
+        max_speed - The fastest a tag moves (m/s).
+        """
+
+        super(LoadGenerator, self).__init__(port=port)
+
+        self.anchors = anchors
+        self.anchor_ids = sorted(anchors.keys())
+        self.rate = rate
+        self.error_model = error_model
+        self.max_speed = max_speed
+        self.report_period = report_period
+
+        self.tag_ids = numpy.arange(first_tag_id, first_tag_id + tag_count)
+
+        # The tags wander around a box a little bigger than the anchors.
+        locations = numpy.array([anchors[anchor_id] for anchor_id in self.anchor_ids], dtype=float)
+        margin = 2.0
+        self.lower = locations.min(axis=0) - margin
+        self.upper = locations.max(axis=0) + margin
+
+        self.positions = self.lower + numpy.random.random((tag_count, 2)) * (self.upper - self.lower)
+        self.velocities = numpy.zeros((tag_count, 2))
+        self.update_times = numpy.zeros(tag_count) + clock.get_time()
+        self.next_tag = 0
+
+        self.start_time = None
+        self.sent_lines = 0
+        self.last_report_time = clock.get_time()
+        self.last_report_lines = 0
+
+    def move_tags(self, tags, now):
+        "Move the given tags (indices) on to the given time, with a random walk bouncing off the edges of the box."
+
+        dt = (now - self.update_times[tags])[:, numpy.newaxis]
+        velocities = self.velocities[tags] + numpy.random.normal(0, 0.5, (len(tags), 2)) * numpy.sqrt(dt)
+        speeds = numpy.sqrt((velocities ** 2).sum(axis=1))[:, numpy.newaxis]
+        velocities *= numpy.minimum(1.0, self.max_speed / numpy.maximum(speeds, 1e-9))
+
+        positions = self.positions[tags] + velocities * dt
+        outside = (positions < self.lower) | (positions > self.upper)
+        velocities[outside] *= -1
+        positions = numpy.clip(positions, self.lower, self.upper)
+
+        self.positions[tags] = positions
+        self.velocities[tags] = velocities
+        self.update_times[tags] = now
+
+    def tag_readings(self, tags, now):
+        "An array of readings (reading_dtype) for the given tags (indices), each against all the anchors."
+
+        anchor_count = len(self.anchor_ids)
+        readings = numpy.zeros(len(tags) * anchor_count, dtype=reading_dtype)
+        if self.error_model:
+            errors = iter(self.error_model.sample(len(readings)).tolist())
+            perturb = lambda d: max(d + errors.next(), 0.0)
+        else:
+            perturb = None
+
+        distances = []
+        for x, y in self.positions[tags].tolist():
+            expected = expected_distances(x, y, self.anchors, perturb)
+            distances.extend([expected[anchor_id] for anchor_id in self.anchor_ids])
+
+        readings["distance"] = distances
+        readings["tag_id"] = numpy.repeat(self.tag_ids[tags], anchor_count)
+        readings["anchor_id"] = numpy.tile(self.anchor_ids, len(tags))
+        readings["timestamp"] = now
+        return readings
+
+    def due_updates(self):
+        "The text of the readings for the tags due since the last call, to keep up the rate."
+
+        now = clock.get_time()
+        if self.start_time == None:
+            self.start_time = now
+
+        anchor_count = len(self.anchor_ids)
+        due_lines = int((now - self.start_time) * self.rate) - self.sent_lines
+        tag_count = min(due_lines // anchor_count, len(self.tag_ids))
+        if tag_count <= 0:
+            return ""
+
+        tags = (self.next_tag + numpy.arange(tag_count)) % len(self.tag_ids)
+        self.next_tag = (self.next_tag + tag_count) % len(self.tag_ids)
+
+        self.move_tags(tags, now)
+        readings = self.tag_readings(tags, now)
+        self.sent_lines += len(readings)
+
+        # If we've fallen behind (by more than a round of tags), don't try to catch up.
+        if due_lines - len(readings) > len(self.tag_ids) * anchor_count:
+            logging.warning("Load generator falling behind by %d lines" % (due_lines - len(readings)))
+            self.sent_lines = int((now - self.start_time) * self.rate)
+
+        self.report(now)
+        return format_lines(readings)
+
+    def report(self, now):
+        "Log the rate we've actually been sending at, every report_period."
+
+        if now - self.last_report_time < self.report_period:
+            return
+        rate = (self.sent_lines - self.last_report_lines) / (now - self.last_report_time)
+        logging.info("Load generator: %.0f lines/sec to %d clients" % (rate, len(self.clients)))
+        self.last_report_time = now
+        self.last_report_lines = self.sent_lines
+
+if __name__ == "__main__":
+
+    import os
+    from optparse import OptionParser
+    from Almada.config import Config, ConfigError
+
+    option_parser = OptionParser()
+    option_parser.add_option("-c", "--config", dest="config", default="almada.cfg",
+                             help="The configuration file, for the anchors (default=%default).")
+    option_parser.add_option("-d", "--working_dir", dest="working_dir", default=".",
+                             help="The working directory for the above files")
+    option_parser.add_option("-n", "--tags", dest="tags", type="int", default=1000,
+                             help="The number of tags to simulate (default=%default).")
+    option_parser.add_option("-r", "--rate", dest="rate", type="float", default=10000,
+                             help="The readings per second to send, in total (default=%default).")
+    option_parser.add_option("-S", "--max_speed", dest="max_speed", type="float", default=1.5,
+                             help="The fastest a tag moves, in m/s (default=%default).")
+    option_parser.add_option("-H", "--histogram", dest="histogram", default="error_histogram.pickle",
+                             help="The distance error histogram (default=%default).")
+    option_parser.add_option("-p", "--port", dest="port", type="int", default=DEFAULT_LOCATION_SERVER_PORT,
+                             help="The TCP port to serve on (default=%default).")
+    option_parser.add_option("-l", "--log_level", dest="log_level", type="int",
+                             help="The log level.", default=20)
+    option_parser.add_option("-o", "--log_file", dest="log_file",
+                             help="The log file (default stderr).")
+
+    options, args = option_parser.parse_args()
+
+    logging.basicConfig(filename=options.log_file, level=options.log_level,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        filemode='w')
+
+    config = Config()
+    try:
+        config.load_file(options.config, options.working_dir)
+    except ConfigError, e:
+        sys.exit("Configuration error: %s" % e.msg)
+    if not config.anchors:
+        sys.exit("No anchors configured")
+
+    histogram = load_histogram(histogram_filename=os.path.join(options.working_dir, options.histogram))
+    if histogram == None:
+        sys.exit("Error loading distance error histogram: %s" % options.histogram)
+
+    load_generator = LoadGenerator(config.anchors, options.tags, options.rate, ErrorModel(histogram),
+                                   port=options.port, max_speed=options.max_speed)
+    load_generator.connect()
+    load_generator.loop()
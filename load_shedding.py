@@ -0,0 +1,186 @@
+"""
+Load shedding: what to drop when the readings come in faster than we can handle them.
+
+Sits between ingest (after the readings are coalesced) and the LocMod. A LoadShedder applies a list of policies in turn,
+each of which picks readings to drop from a batch. Readings from priority tags are never dropped.
+The policies provided are:
+ - TagRateCap: At most 'rate' readings per second from any one tag (with bursts up to 'burst').
+ - MaxLag: While the location updates are more than 'max_lag' seconds behind, drop readings until they catch up.
+   (The readings are stamped as they're received, so their own age says nothing about the backlog;
+   the lag comes from the Coalescer: see Coalescer.backlog.)
+ - FairShare: At most 'max_readings' in a batch, shared round-robin between the tags:
+   each tag keeps its newest reading, then its next newest, and so on until the budget is used up.
+So a burst from one misbehaving tag can't crowd out everybody else.
+
+Everything dropped is counted by policy and tag, and reported every report_period.
+Other policies just need a name, and shed(readings, candidates, lag) returning which of the candidates to drop.
+"""
+
+import logging
+
+import numpy
+
+from Almada.clock import shared_clock as clock
+
+def rank_from_newest(tag_ids):
+    "For each reading (given their tag IDs, in batch order), how many newer readings there are from the same tag."
+
+    reversed_tag_ids = tag_ids[::-1]
+    order = numpy.argsort(reversed_tag_ids, kind="mergesort")
+    sorted_tag_ids = reversed_tag_ids[order]
+    group_starts = numpy.flatnonzero(numpy.r_[True, sorted_tag_ids[1:] != sorted_tag_ids[:-1]])
+    group_sizes = numpy.diff(numpy.r_[group_starts, len(sorted_tag_ids)])
+
+    ranks = numpy.empty(len(tag_ids), dtype=numpy.int64)
+    ranks[order] = numpy.arange(len(tag_ids)) - numpy.repeat(group_starts, group_sizes)
+    return ranks[::-1]
+
+class TagRateCap(object):
+    """At most 'rate' readings per second from each tag (a token bucket per tag, holding up to 'burst')."""
+
+    name = "rate_cap"
+
+    def __init__(self, rate, burst=None):
+        super(TagRateCap, self).__init__()
+        self.rate = rate
+        if burst == None:
+            burst = rate
+        self.burst = burst
+        self.tokens = {} # tag_id -> (tokens, time)
+
+    def shed(self, readings, candidates, lag=0.0):
+        now = clock.get_time()
+        drop = numpy.zeros(len(readings), dtype=bool)
+        ranks = rank_from_newest(readings.tag_ids)
+
+        tag_ids, counts = numpy.unique(readings.tag_ids[candidates], return_counts=True)
+        for tag_id, count in zip(tag_ids.tolist(), counts.tolist()):
+            tokens, last_time = self.tokens.get(tag_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last_time) * self.rate)
+            allowed = int(tokens)
+            if count > allowed:
+                # Keep the newest ones.
+                drop |= candidates & (readings.tag_ids == tag_id) & (ranks >= allowed)
+            self.tokens[tag_id] = (tokens - min(count, allowed), now)
+
+        return drop
+
+class MaxLag(object):
+    """Drop readings while we're more than 'max_lag' seconds behind (and any that are that old already)."""
+
+    name = "max_lag"
+
+    def __init__(self, max_lag):
+        super(MaxLag, self).__init__()
+        self.max_lag = max_lag
+
+    def shed(self, readings, candidates, lag=0.0):
+        if lag > self.max_lag:
+            return candidates.copy()
+        return candidates & (readings.timestamps < clock.get_time() - self.max_lag)
+
+class FairShare(object):
+    """At most 'max_readings' per batch, shared round-robin between the tags (newest readings first)."""
+
+    name = "fair_share"
+
+    def __init__(self, max_readings):
+        super(FairShare, self).__init__()
+        self.max_readings = max_readings
+        self.next_tag_id = 0 # Where the round-robin picks up next time, for the last partial round.
+
+    def shed(self, readings, candidates, lag=0.0):
+        drop = numpy.zeros(len(readings), dtype=bool)
+        budget = self.max_readings - (~candidates).sum() # Priority readings use up some of the budget, but can't be dropped.
+        if candidates.sum() <= budget:
+            return drop
+        budget = max(budget, 0)
+
+        ranks = rank_from_newest(readings.tag_ids)
+        candidate_ranks = ranks[candidates]
+
+        # The number of whole rounds we can afford.
+        rounds = 0
+        while rounds < candidate_ranks.max() + 1 and (candidate_ranks <= rounds).sum() <= budget:
+            rounds += 1
+        drop[candidates & (ranks >= rounds)] = True
+
+        # Then as much of the next round as we can, carrying on from the tag after the last one served.
+        remaining = budget - (candidate_ranks < rounds).sum()
+        partial = numpy.flatnonzero(candidates & (ranks == rounds))
+        if remaining > 0 and len(partial):
+            tag_ids = readings.tag_ids[partial]
+            order = numpy.lexsort((tag_ids, tag_ids < self.next_tag_id))
+            keep = partial[order[:remaining]]
+            drop[keep] = False
+            self.next_tag_id = tag_ids[order[min(remaining, len(partial)) - 1]] + 1
+
+        return drop
+
+class LoadShedder(object):
+    """Apply the shedding policies to each batch, never dropping priority tags. Counts what was shed."""
+
+    report_period = 60.0
+
+    def __init__(self, policies, priority_tag_ids=[]):
+        super(LoadShedder, self).__init__()
+        self.policies = policies
+        self.priority_tag_ids = list(priority_tag_ids)
+        self.shed_counts = {} # (policy name, tag_id) -> readings dropped in total.
+        self.reported_shed_counts = {}
+        self.last_report_time = clock.get_time()
+
+    def shed(self, readings, lag=0.0):
+        """
+        The ReadingBatch without the readings the policies choose to drop.
+        lag - How far behind the location updates are, in seconds (see Coalescer.backlog).
+        """
+
+        if not len(readings) or not self.policies:
+            return readings
+
+        candidates = ~numpy.in1d(readings.tag_ids, self.priority_tag_ids)
+        for policy in self.policies:
+            if not candidates.any():
+                break
+            drop = policy.shed(readings, candidates, lag) & candidates
+            if drop.any():
+                tag_ids, counts = numpy.unique(readings.tag_ids[drop], return_counts=True)
+                for tag_id, count in zip(tag_ids.tolist(), counts.tolist()):
+                    key = (policy.name, tag_id)
+                    self.shed_counts[key] = self.shed_counts.get(key, 0) + count
+                readings = readings[~drop]
+                candidates = candidates[~drop]
+
+        return readings
+
+    def report(self):
+        "Log the readings shed by each policy, for each tag, since the last report, if it's time to."
+
+        now = clock.get_time()
+        if now - self.last_report_time < self.report_period:
+            return
+
+        for (name, tag_id), count in sorted(self.shed_counts.items()):
+            shed = count - self.reported_shed_counts.get((name, tag_id), 0)
+            if shed:
+                logging.warning("Tag %d: %d readings shed (%s)" % (tag_id, shed, name))
+
+        self.reported_shed_counts = dict(self.shed_counts)
+        self.last_report_time = now
+
+def new_load_shedder(config):
+    "A LoadShedder according to the given configuration (Config object), or None if there's no shedding configured."
+
+    options = config.load_shedding
+    policies = []
+    if options.get("max_lag"):
+        policies.append(MaxLag(options["max_lag"]))
+    if options.get("tag_rate"):
+        policies.append(TagRateCap(options["tag_rate"], options.get("tag_burst")))
+    if options.get("max_readings"):
+        policies.append(FairShare(options["max_readings"]))
+
+    if not policies:
+        return None
+    return LoadShedder(policies, options.get("priority_tag_ids", []))
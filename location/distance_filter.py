@@ -38,22 +38,47 @@ class DistanceFilter(object):
             name = DistanceFilterTypes.null
         self.name = name
         self.readings = {}
+        self.reading_times = {} # tag_id -> timestamp of the newest reading behind its last distances.
 
         logging.debug("Initialised distance filter: %s" % self.name)
 
-    def add_reading(self, anchor_id, tag_id, distance):
-        "FIXME: Docstring"
+    def add_reading(self, anchor_id, tag_id, distance, timestamp=None):
+        "Add a single distance reading (timestamp defaults to now)."
 
-        pair = (anchor_id, tag_id)
+        self.add_distance_reading(DistanceReading(anchor_id, tag_id, distance, timestamp))
+        
+    def add_readings(self, readings):
+        """
+        Add each of the readings in a ReadingBatch.
+        The ReadingViews are kept as they are; they have the same attributes as a DistanceReading.
+        """
+        
+        for reading in readings:
+            self.add_distance_reading(reading)
+        
+    def add_distance_reading(self, distance_reading):
+        "Keep a reading (anything with anchor_id, tag_id, distance and timestamp) in the history for its pair."
+
+        pair = (distance_reading.anchor_id, distance_reading.tag_id)
         if not self.readings.has_key(pair):
             self.readings[pair] = []
         
-        self.readings[pair].insert(0, DistanceReading(anchor_id, tag_id, distance))
+        self.readings[pair].insert(0, distance_reading)
         
         # Ensure we aren't keeping too many.
         while len(self.readings[pair]) > self.max_readings:
             self.readings[pair].pop()
         
+    def forget_tags(self, tag_ids):
+        "Drop the readings for the given tags (as they're no longer ours to track)."
+        
+        tag_ids = set(tag_ids)
+        for pair in self.readings.keys():
+            if pair[1] in tag_ids:
+                del self.readings[pair]
+        for tag_id in tag_ids:
+            self.reading_times.pop(tag_id, None)
+        
     def most_recent_distance(self, distance_readings):
         "The distance of the most recent reading."
         if distance_readings:
@@ -74,8 +99,12 @@ class DistanceFilter(object):
             return None
             
     def distances(self, tag_id):
-        "Current distance readings for the given tag."
+        """
+        Current distance readings for the given tag.
+        Also notes the timestamp of the newest reading they came from (in reading_times), for tracing.
+        """
         result = {}
+        newest = None
         
         for pair, distance_readings in self.readings.iteritems():
             anchor_id, tid = pair
@@ -90,11 +119,13 @@ class DistanceFilter(object):
             
             if distance != None:
                 result[anchor_id] = distance
+                newest = max(newest, distance_readings[0].timestamp)
 
             # We want to clear all old readings for a null filter.
             if self.name == DistanceFilterTypes.null:
                 self.readings[pair] = []
             
+        self.reading_times[tag_id] = newest
         return result
         
         
@@ -6,8 +6,11 @@ from the tags into position estimates for each tag.
 
 The basic LocMod interface is simple:
  - add_reading: Add each distance reading one by one. (Should be very lightweight - little computation)
+   (add_readings does the same for a whole ReadingBatch at once.)
  - update_location: Perform the position estimates. (This is the part that is most computationally intensive)
+   By default, only for the tags with new readings since their last estimate.
  - tag_positions: Return the current position estimate for each tag. (Also, lightweight (and is returned by update_locations))
+ - reading_times: (Optional) When the newest reading behind each tag's position was received, for tracing.
 
 Any object that provides the above three methods can serve as a LocMod, 
 but a reference implementation is provided below.
@@ -29,8 +32,11 @@ Philip Blackwell - September 2009
 
 import logging
 
+import numpy
+
 from Almada.location.distance_filter import DistanceFilter
 from Almada.location.position_filter import PositionFilter
+from Almada.stats import shared_stats as stats
 
 class LocMod(object):
     """Generic Location Module. Comprising of a Distance Filter, Location Engine, and Position Filter"""
@@ -42,37 +48,57 @@ class LocMod(object):
         self.position_filter = position_filter
     
         self.tag_ids = set()
+        self.dirty_tag_ids = set() # Tags with readings since their last location estimate.
         self.anchors = anchors
                                          
-    def add_reading(self, anchor_id, tag_id, distance):
+    def add_reading(self, anchor_id, tag_id, distance, timestamp=None):
         "Add a distance reading: The distance to an anchor as estimated by a tag."
 
         if not anchor_id in self.anchors:
             logging.warning("Received distance measurement for unknown anchor: %d" % anchor_id)
             return
 
-        self.distance_filter.add_reading(anchor_id, tag_id, distance)
+        self.distance_filter.add_reading(anchor_id, tag_id, distance, timestamp)
                 
         self.tag_ids.add(tag_id)
+        self.dirty_tag_ids.add(tag_id)
+
+    def add_readings(self, readings):
+        "Add all the distance readings in a ReadingBatch."
+        
+        readings = known_anchor_readings(readings, self.anchors)
+        
+        with stats.timer("distance_filter", len(readings)):
+            self.distance_filter.add_readings(readings)
+        
+        tag_ids = readings.unique_tag_ids()
+        self.tag_ids.update(tag_ids)
+        self.dirty_tag_ids.update(tag_ids)
 
     def update_locations(self, tag_ids=[]):
-        "Perform the location estimates based on the current best distance estimates."
+        """
+        Perform the location estimates based on the current best distance estimates.
+        Only the given tags, or if none are given, the tags with new readings since their last estimate.
+        """
         
-        if not tag_ids:
-            tag_ids = self.tag_ids
+        tag_ids = take_dirty_tag_ids(self, tag_ids)
         
         tag_locations = {}
+        reading_times = {}
 
         for tag_id in tag_ids:
-            distances = self.distance_filter.distances(tag_id)
+            with stats.timer("distance_filter"):
+                distances = self.distance_filter.distances(tag_id)
             if self.location_engine:
-                location = self.location_engine.coordinates(distances)
+                with stats.timer("engine"):
+                    location = self.location_engine.coordinates(distances)
                 tag_locations[tag_id] = location
+                reading_times[tag_id] = self.distance_filter.reading_times.get(tag_id)
                 logging.info("Estimated location for tag %d: (%.2f %.2f)" % (tag_id, location[0], location[1]))
             
-        self.position_filter.add_updates(tag_locations)
-
-        return self.position_filter.tag_locations(tag_ids)
+        with stats.timer("position_filter", len(tag_locations)):
+            self.position_filter.add_updates(tag_locations, reading_times)
+            return self.position_filter.tag_locations(tag_ids)
 
     def tag_positions(self, tag_ids=[]):
         """
@@ -85,6 +111,33 @@ class LocMod(object):
             
         return self.position_filter.tag_locations(tag_ids)
         
+    def reading_times(self, tag_ids):
+        "When the newest reading behind each tag's current position was received."
+        
+        return self.position_filter.reading_times(tag_ids)
+        
+def take_dirty_tag_ids(locmod, tag_ids=[]):
+    "The tags to update (those given, or else the dirty ones), which are no longer dirty."
+    
+    if not tag_ids:
+        tag_ids = locmod.dirty_tag_ids
+        locmod.dirty_tag_ids = set()
+    else:
+        locmod.dirty_tag_ids.difference_update(tag_ids)
+        
+    return tag_ids
+        
+def known_anchor_readings(readings, anchors):
+    "The readings (ReadingBatch) from anchors we know about. Warn about any others."
+    
+    known = numpy.in1d(readings.anchor_ids, anchors.keys())
+    if not known.all():
+        for anchor_id in numpy.unique(readings.anchor_ids[~known]):
+            logging.warning("Received distance measurement for unknown anchor: %d" % anchor_id)
+        readings = readings[known]
+        
+    return readings
+        
 def new_locmod(config):
     """A new LocMod object (or similar) according to the given configuration (Config object)."""
     
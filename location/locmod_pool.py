@@ -0,0 +1,255 @@
+"""
+A LocMod spread over a pool of worker processes.
+
+Each worker owns a shard of the tags, with its own LocMod (made by new_locmod: its own distance filter, engine and position filter),
+so a slow location engine doesn't hold up the process taking in readings, and the work is spread over the cores.
+Tags are assigned to shards by consistent hashing, so adding a worker only moves the tags it takes over
+(which start afresh on their new worker).
+
+Readings and update requests go to the workers over pipes, in order, each stamped with the shared_clock time
+at which they were sent. The workers run their LocMods on that time (their clocks are paused at it),
+and seed their random number generators from their shard, so a replay gives the same estimates as the original run
+whatever the timing of the workers.
+
+LocModPool serves as a LocMod (update_locations waits for all the workers), but it can also be used asynchronously:
+request_update starts an update, and the results are collected from the workers' pipes when they become readable.
+"""
+
+import random
+import bisect
+import hashlib
+import logging
+import multiprocessing
+
+import numpy
+
+from Almada.clock import shared_clock as clock
+from Almada.location.locmod import new_locmod
+
+def forget_tags(locmod, tag_ids):
+    "Drop the given tags from a LocMod (or ParticleFilter), and its filters, as they've moved to another worker."
+
+    for tag_id in tag_ids:
+        for attribute in ["tag_ids", "dirty_tag_ids"]:
+            getattr(locmod, attribute, set()).discard(tag_id)
+        for attribute in ["particle_clouds", "tag_reading_times"]:
+            getattr(locmod, attribute, {}).pop(tag_id, None)
+    for attribute in ["distance_filter", "position_filter"]:
+        if getattr(locmod, attribute, None) != None:
+            getattr(locmod, attribute).forget_tags(tag_ids)
+
+def run_worker(config, shard, connection):
+    "Worker process: apply the commands from the pipe to our own LocMod until told to stop."
+
+    random.seed(shard)
+    numpy.random.seed(shard)
+    locmod = new_locmod(config)
+
+    while True:
+        message = connection.recv()
+        if message == None:
+            break
+
+        command, timestamp, argument = message
+        clock.pause(timestamp)
+
+        if command == "readings":
+            locmod.add_readings(argument)
+        elif command == "reading":
+            locmod.add_reading(*argument)
+        elif command == "update":
+            tag_locations = locmod.update_locations(argument)
+            connection.send((tag_locations, locmod.reading_times(tag_locations.keys())))
+        elif command == "forget":
+            forget_tags(locmod, argument)
+
+    connection.close()
+
+def hash_key(key):
+    "A well spread (and repeatable) integer hash of a string."
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+class ConsistentHashRing(object):
+    """Assign keys (tag IDs) to shards, so that adding a shard only moves keys to it."""
+
+    def __init__(self, points_per_shard=64):
+        super(ConsistentHashRing, self).__init__()
+        self.points_per_shard = points_per_shard
+        self.points = [] # Sorted hashes.
+        self.shards = {} # Hash -> shard.
+
+    def add(self, shard):
+        for i in range(self.points_per_shard):
+            point = hash_key("shard-%d-%d" % (shard, i))
+            bisect.insort(self.points, point)
+            self.shards[point] = shard
+
+    def owner(self, key):
+        "The shard that owns the given key: the next point round the ring."
+
+        i = bisect.bisect(self.points, hash_key(str(key))) % len(self.points)
+        return self.shards[self.points[i]]
+
+class LocModPool(object):
+    """A LocMod with the location estimates done by worker processes, each owning a shard of the tags."""
+
+    def __init__(self, config, workers=2):
+        """
+        config - The Config to make each worker's LocMod from (see new_locmod).
+        workers - The number of worker processes.
+        """
+
+        super(LocModPool, self).__init__()
+
+        self.config = config
+        self.anchors = config.anchors
+        self.tag_ids = set()
+        self.locations = {} # The latest estimate for each tag.
+        self.tag_reading_times = {} # When the newest reading behind each tag's latest estimate was received.
+        self.pending_updates = {} # Worker connection -> number of update results still to come.
+        self.ring = ConsistentHashRing()
+        self.owners = {} # Tag ID -> shard, cached from the ring.
+
+        self.connections = [] # By shard.
+        self.processes = []
+        for i in range(workers):
+            self.start_worker()
+
+    def start_worker(self):
+        "Start a new worker process, for the next shard."
+
+        shard = len(self.connections)
+        connection, worker_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=run_worker, args=(self.config, shard, worker_connection), name="LocModWorker-%d" % shard)
+        process.daemon = True
+        process.start()
+        worker_connection.close()
+        self.connections.append(connection)
+        self.processes.append(process)
+        self.pending_updates[connection] = 0
+        self.ring.add(shard)
+        return shard
+
+    def add_worker(self):
+        "Add a worker process, and move the tags it now owns to it. (Their estimates start afresh.)"
+
+        old_owners = dict((tag_id, self.owner(tag_id)) for tag_id in self.tag_ids)
+        shard = self.start_worker()
+        self.owners = {}
+
+        moved = {} # Old shard -> tag IDs
+        for tag_id, old_shard in old_owners.iteritems():
+            if self.owner(tag_id) != old_shard:
+                moved.setdefault(old_shard, []).append(tag_id)
+
+        for old_shard, tag_ids in moved.iteritems():
+            self.send(self.connections[old_shard], "forget", tag_ids)
+
+        logging.info("Added LocMod worker %d, taking %d of %d tags" % (shard, sum(map(len, moved.values())), len(self.tag_ids)))
+        return shard
+
+    def owner(self, tag_id):
+        "The shard that owns the given tag."
+
+        if not tag_id in self.owners:
+            self.owners[tag_id] = self.ring.owner(tag_id)
+        return self.owners[tag_id]
+
+    def shard(self, tag_id):
+        "The connection to the worker that owns the given tag."
+        return self.connections[self.owner(tag_id)]
+
+    def send(self, connection, command, argument=None):
+        connection.send((command, clock.get_time(), argument))
+
+    def add_reading(self, anchor_id, tag_id, distance, timestamp=None):
+        "Add a distance reading: The distance to an anchor as estimated by a tag."
+
+        self.send(self.shard(tag_id), "reading", (anchor_id, tag_id, distance, timestamp))
+        self.tag_ids.add(tag_id)
+
+    def add_readings(self, readings):
+        "Add all the distance readings in a ReadingBatch, each worker getting the readings for its own tags."
+
+        if not len(readings):
+            return
+
+        tag_ids, inverse = numpy.unique(readings.tag_ids, return_inverse=True)
+        shards = numpy.array([self.owner(tag_id) for tag_id in tag_ids.tolist()])[inverse]
+        for i, connection in enumerate(self.connections):
+            shard_readings = readings[shards == i]
+            if len(shard_readings):
+                self.send(connection, "readings", shard_readings)
+        self.tag_ids.update(tag_ids.tolist())
+
+    def request_update(self, tag_ids=[]):
+        "Ask the workers to update the locations of the given tags (all if none given). Collect the results with collect."
+
+        for i, connection in enumerate(self.connections):
+            shard_tag_ids = [tag_id for tag_id in tag_ids if self.owner(tag_id) == i]
+            if tag_ids and not shard_tag_ids:
+                continue
+            self.send(connection, "update", shard_tag_ids)
+            self.pending_updates[connection] += 1
+
+    def update_pending(self):
+        "Are there any update results still to come?"
+        return any(self.pending_updates.values())
+
+    def readers(self):
+        "The connections with update results to come, to select on."
+        return [connection for connection, pending in self.pending_updates.items() if pending]
+
+    def collect(self, readers):
+        "The tag locations from the workers with results waiting (given their readable connections)."
+
+        tag_locations = {}
+        for connection in readers:
+            try:
+                update, reading_times = connection.recv()
+            except EOFError:
+                raise Exception("LocMod worker process has died")
+            self.pending_updates[connection] -= 1
+            tag_locations.update(update)
+            self.tag_reading_times.update(reading_times)
+
+        self.locations.update(tag_locations)
+        return tag_locations
+
+    def update_locations(self, tag_ids=[]):
+        "Perform the location estimates, waiting for all the workers."
+
+        # Anything from earlier asynchronous requests is collected first, so the results are in order.
+        tag_locations = {}
+        while self.update_pending():
+            tag_locations.update(self.collect(self.readers()))
+
+        self.request_update(tag_ids)
+        while self.update_pending():
+            tag_locations.update(self.collect(self.readers()))
+
+        return tag_locations
+
+    def tag_positions(self, tag_ids=[]):
+        "The latest position estimate for each tag (as last collected from the workers)."
+
+        if not tag_ids:
+            tag_ids = self.tag_ids
+
+        return dict((tag_id, self.locations[tag_id]) for tag_id in tag_ids if tag_id in self.locations)
+
+    def reading_times(self, tag_ids):
+        "When the newest reading behind each tag's latest estimate was received."
+
+        return dict((tag_id, self.tag_reading_times[tag_id]) for tag_id in tag_ids if tag_id in self.tag_reading_times)
+
+    def close(self):
+        "Stop the worker processes."
+
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except IOError:
+                pass
+        for process in self.processes:
+            process.join()
@@ -10,8 +10,10 @@ import logging
 import random
 
 from Almada.location.distance_filter import DistanceFilter
+from Almada.location.locmod import known_anchor_readings, take_dirty_tag_ids
 from Almada.clock import shared_clock as clock
 from Almada.location.distance_model import DistanceModel
+from Almada.stats import shared_stats as stats
 
 class ParticleGenerator(object):
     """docstring for ParticleGenerator"""
@@ -216,6 +218,8 @@ class ParticleFilter(object):
         super(ParticleFilter, self).__init__()
         self.anchors = anchors
         self.particle_clouds = {} # By tag ID
+        self.dirty_tag_ids = set() # Tags with readings since their last location estimate.
+        self.tag_reading_times = {} # tag_id -> when the newest reading behind its location was received.
         self.distance_filter = DistanceFilter()
         self.set_particle_generator()
         
@@ -236,21 +240,34 @@ class ParticleFilter(object):
         else:
             self.particle_generator = particle_generator
                                                                  
-    def add_reading(self, anchor_id, tag_id, distance):
-        "FIXME: Docstring"
+    def add_reading(self, anchor_id, tag_id, distance, timestamp=None):
+        "Add a distance reading: The distance to an anchor as estimated by a tag."
 
         if not anchor_id in self.anchors:
             logging.warning("Received distance measurement for unknown anchor: %d" % anchor_id)
             return
 
-        self.distance_filter.add_reading(anchor_id, tag_id, distance)
+        self.distance_filter.add_reading(anchor_id, tag_id, distance, timestamp)
         if not self.particle_clouds.has_key(tag_id):
             self.particle_clouds[tag_id] = ParticleCloud(self.anchors)
+        self.dirty_tag_ids.add(tag_id)
+                
+    def add_readings(self, readings):
+        "Add all the distance readings in a ReadingBatch."
+        
+        readings = known_anchor_readings(readings, self.anchors)
+        
+        with stats.timer("distance_filter", len(readings)):
+            self.distance_filter.add_readings(readings)
+        for tag_id in readings.unique_tag_ids():
+            if not self.particle_clouds.has_key(tag_id):
+                self.particle_clouds[tag_id] = ParticleCloud(self.anchors)
+            self.dirty_tag_ids.add(tag_id)
                 
     def update_locations(self, tag_ids=[]):
+        "Update the particle clouds of the given tags, or if none are given, those with new readings since their last estimate."
         
-        if not tag_ids:
-            tag_ids = self.particle_clouds.keys()
+        tag_ids = take_dirty_tag_ids(self, tag_ids)
 
         result = {}
                 
@@ -258,15 +275,24 @@ class ParticleFilter(object):
             if not self.particle_clouds.has_key(tag_id):
                 continue
             particle_cloud = self.particle_clouds[tag_id]
-            particle_cloud.set_distances(self.distance_filter.distances(tag_id))
-            particle_cloud.perturb()
-            particle_cloud.cull()
-            particle_cloud.generate_new(self.particle_generator)
-            particle_cloud.score()
-            particle_cloud.discard()
-            try:
-                result[tag_id] = particle_cloud.location()
-            except Exception, e:
-                logging.error("Error getting location for cloud with particles")
+            with stats.timer("distance_filter"):
+                distances = self.distance_filter.distances(tag_id)
+            with stats.timer("engine"):
+                particle_cloud.set_distances(distances)
+                particle_cloud.perturb()
+                particle_cloud.cull()
+                particle_cloud.generate_new(self.particle_generator)
+                particle_cloud.score()
+                particle_cloud.discard()
+                try:
+                    result[tag_id] = particle_cloud.location()
+                    self.tag_reading_times[tag_id] = self.distance_filter.reading_times.get(tag_id)
+                except Exception, e:
+                    logging.error("Error getting location for cloud with particles")
                 
         return result
+
+    def reading_times(self, tag_ids):
+        "When the newest reading behind each tag's current position was received."
+
+        return dict((tag_id, self.tag_reading_times[tag_id]) for tag_id in tag_ids if self.tag_reading_times.get(tag_id) != None)
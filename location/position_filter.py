@@ -11,11 +11,12 @@ class PositionFilterTypes(object):
 
 class PositionUpdate(object):
     """Simple class for the data relating to a single position update"""
-    def __init__(self, x, y):
+    def __init__(self, x, y, reading_time=None):
         super(PositionUpdate, self).__init__()
         self.x = x
         self.y = y
         self.timestamp = clock.get_time()
+        self.reading_time = reading_time # When the newest reading behind it was received (for tracing).
 
 class PositionFilter(object):
     """A filter for the x, y location estimates."""
@@ -42,21 +43,28 @@ class PositionFilter(object):
         logging.debug("Initialised position filter: %s" % self.name)
             
                         
-    def add_updates(self, tags):
-        "Add the location information given in the dictionary 'tags': tag_id -> (x,y)"
+    def add_updates(self, tags, reading_times={}):
+        """
+        Add the location information given in the dictionary 'tags': tag_id -> (x,y)
+        reading_times - tag_id -> timestamp of the newest reading behind the location, if known.
+        """
                 
         # Add these tag updates to our history
         for tag_id, location in tags.iteritems():
             x, y = location
             if not self.tag_updates.has_key(tag_id):
                 self.tag_updates[tag_id] = []
-            self.tag_updates[tag_id].append(PositionUpdate(x, y))
+            self.tag_updates[tag_id].append(PositionUpdate(x, y, reading_times.get(tag_id)))
         
-    def cull_old(self):
-        "Delete any position updates older than 'max_age'"
+    def cull_old(self, tag_ids=None):
+        "Delete any position updates older than 'max_age' (for the given tags, or all)"
         oldest = clock.get_time() - self.max_age
         
-        for tag_id, position_updates in self.tag_updates.iteritems():
+        if tag_ids == None:
+            tag_ids = self.tag_updates.keys()
+        
+        for tag_id in tag_ids:
+            position_updates = self.tag_updates.get(tag_id, [])
             i = 0
             while i < len(position_updates):
                 if position_updates[i].timestamp < oldest:
@@ -64,13 +72,20 @@ class PositionFilter(object):
                 else:
                     i += 1
                 
+    def forget_tags(self, tag_ids):
+        "Drop the position updates for the given tags (as they're no longer ours to track)."
+        
+        for tag_id in tag_ids:
+            self.tag_updates.pop(tag_id, None)
+            self.last_updates.pop(tag_id, None)
+                
     def tag_locations(self, tag_ids=[]):
         "A dictionary of tag locations: tag_id -> (x,y)"
 
         now = clock.get_time()
         result = {}
                         
-        self.cull_old()
+        self.cull_old(tag_ids)
                         
         for tag_id in tag_ids:
             if self.update_rate and (now - self.last_updates[tag_id] < self.update_rate):
@@ -82,6 +97,16 @@ class PositionFilter(object):
             
         return result
 
+    def reading_times(self, tag_ids):
+        "The timestamp of the newest reading behind the current location of each tag (where known)."
+        
+        result = {}
+        for tag_id in tag_ids:
+            times = [update.reading_time for update in self.tag_updates.get(tag_id, []) if update.reading_time != None]
+            if times:
+                result[tag_id] = max(times)
+        return result
+
     def most_recent_filter(self, position_updates):
         "Return the most recent position (x, y)"
         
@@ -9,12 +9,17 @@ It is somewhat poorly named: it only provides distance information. Determining
 Philip Blackwell August 2009
 """
 
+import errno
 import logging
 import select
 import socket
 import time
 
+import numpy
+
 from Almada.clock import shared_clock as clock
+from Almada.stats import shared_stats as stats
+from Almada.reconnect import start_connect, finish_connect
 
 class Reading(object):
     """
@@ -54,6 +59,192 @@ class Reading(object):
         "How is this reading represented by the Location Server."
         return "#%07.2f:%03d:%03d:%03d" % (self.distance, self.tag_id, self.anchor_id, self.error_code)
     
+# A structured array with one element per reading, for parsing many lines at once.
+reading_dtype = numpy.dtype([("distance", numpy.float64),
+                             ("tag_id", numpy.int32),
+                             ("anchor_id", numpy.int32),
+                             ("error_code", numpy.int32),
+                             ("timestamp", numpy.float64)])
+
+# The layout of a line from the location server. Zeros are digits, everything else must match exactly.
+line_template = "#0000.00:000:000:000"
+line_width = len(line_template)
+template_codes = numpy.fromstring(line_template, dtype=numpy.uint8)
+digit_columns = template_codes == ord("0")
+
+def place_values(template_slice, scale=1):
+    "Weights for the digits of the given slice of the template (zero for non-digit columns)."
+    
+    weights = numpy.zeros(line_width, dtype=numpy.int64)
+    columns = [i for i in range(*template_slice.indices(line_width)) if digit_columns[i]]
+    for power, column in enumerate(reversed(columns)):
+        weights[column] = scale * 10 ** power
+    return weights
+
+distance_weights = place_values(slice(1, 8)) # In hundredths of a meter.
+tag_id_weights = place_values(slice(9, 12))
+anchor_id_weights = place_values(slice(13, 16))
+error_code_weights = place_values(slice(17, 20))
+
+def parse_lines(lines, timestamp=None, keep_errors=False):
+    """
+    Parse a list of lines from the location server into an array of readings (reading_dtype).
+    
+    Lines in the usual fixed width layout (see line_template) are parsed together, without a Python loop.
+    Any other (non-blank) lines are parsed one by one, as by Reading.
+    Malformed lines and (unless keep_errors) readings with non-zero error codes are left out.
+    """
+
+    if not lines:
+        return numpy.zeros(0, dtype=reading_dtype)
+
+    text = numpy.char.strip(numpy.array(lines, dtype=str))
+    well_formed = numpy.char.str_len(text) == line_width
+    
+    # One row of character codes per line.
+    codes = text.astype("S%d" % line_width).view(numpy.uint8).reshape(len(lines), line_width)
+    digits = codes.astype(numpy.int64) - ord("0")
+    well_formed &= (codes[:, ~digit_columns] == template_codes[~digit_columns]).all(axis=1)
+    well_formed &= ((digits[:, digit_columns] >= 0) & (digits[:, digit_columns] <= 9)).all(axis=1)
+    
+    readings = numpy.zeros(len(lines), dtype=reading_dtype)
+    readings["distance"] = numpy.dot(digits, distance_weights) / 100.0
+    readings["tag_id"] = numpy.dot(digits, tag_id_weights)
+    readings["anchor_id"] = numpy.dot(digits, anchor_id_weights)
+    readings["error_code"] = numpy.dot(digits, error_code_weights)
+    readings["timestamp"] = timestamp
+    
+    # Anything that isn't in the usual layout gets parsed the slow way.
+    for i in numpy.flatnonzero(~well_formed):
+        if not text[i]:
+            continue
+        try:
+            reading = Reading(text[i])
+            readings[i] = reading.distance, reading.tag_id, reading.anchor_id, reading.error_code, timestamp
+            well_formed[i] = True
+        except Exception, e:
+            logging.error("Error reading line from location server: %s" % text[i])
+    
+    readings = readings[well_formed]
+    if keep_errors:
+        return readings
+    return without_errors(readings)
+
+def without_errors(readings):
+    "The readings (reading_dtype) without those with non-zero error codes."
+    
+    errors = readings["error_code"] != 0
+    if errors.any():
+        logging.info("Ignoring %d readings with errors" % errors.sum())
+        readings = readings[~errors]
+    return readings
+
+class ReadingView(object):
+    """
+    A single reading within a ReadingBatch.
+    
+    Has the same attributes as a Reading, but they are read straight from the batch's array.
+    """
+    
+    __slots__ = ["record"]
+    
+    def __init__(self, record):
+        self.record = record
+        
+    @property
+    def distance(self):
+        return float(self.record["distance"])
+        
+    @property
+    def tag_id(self):
+        return int(self.record["tag_id"])
+        
+    @property
+    def anchor_id(self):
+        return int(self.record["anchor_id"])
+        
+    @property
+    def error_code(self):
+        return int(self.record["error_code"])
+        
+    @property
+    def timestamp(self):
+        return float(self.record["timestamp"])
+        
+    def __repr__(self):
+        "How is this reading represented by the Location Server."
+        return "#%07.2f:%03d:%03d:%03d" % (self.distance, self.tag_id, self.anchor_id, self.error_code)
+
+class ReadingBatch(object):
+    """
+    A batch of readings, kept as columns of a structured array (reading_dtype).
+    
+    Indexing with an integer gives a ReadingView. Slices, masks and index arrays give a new ReadingBatch.
+    The columns are available directly (distances, tag_ids, anchor_ids, timestamps) for working on the whole batch.
+    """
+    
+    __slots__ = ["array"]
+    
+    def __init__(self, array=None):
+        if array is None:
+            array = numpy.zeros(0, dtype=reading_dtype)
+        self.array = array
+        
+    @classmethod
+    def from_readings(cls, readings, timestamp=None):
+        "A batch from a list of Reading (or similar) objects. Any missing timestamps are set to 'timestamp' (default now)."
+        
+        if timestamp == None:
+            timestamp = clock.get_time()
+            
+        array = numpy.zeros(len(readings), dtype=reading_dtype)
+        for i, reading in enumerate(readings):
+            reading_timestamp = reading.timestamp
+            if reading_timestamp == None:
+                reading_timestamp = timestamp
+            array[i] = reading.distance, reading.tag_id, reading.anchor_id, reading.error_code, reading_timestamp
+        
+        return cls(array)
+        
+    def __len__(self):
+        return len(self.array)
+        
+    def __iter__(self):
+        for record in self.array:
+            yield ReadingView(record)
+            
+    def __getitem__(self, index):
+        if isinstance(index, (int, long, numpy.integer)):
+            return ReadingView(self.array[index])
+        return ReadingBatch(self.array[index])
+        
+    def __repr__(self):
+        return "ReadingBatch(%d readings)" % len(self)
+        
+    @property
+    def distances(self):
+        return self.array["distance"]
+        
+    @property
+    def tag_ids(self):
+        return self.array["tag_id"]
+        
+    @property
+    def anchor_ids(self):
+        return self.array["anchor_id"]
+        
+    @property
+    def timestamps(self):
+        return self.array["timestamp"]
+        
+    def unique_tag_ids(self):
+        "A list of the distinct tag IDs in the batch."
+        return numpy.unique(self.tag_ids).tolist()
+        
+    def rows(self, *columns):
+        "A list of tuples (of plain Python values) of the given columns, e.g. for executemany."
+        return zip(*[self.array[column].tolist() for column in columns])
+        
 DEFAULT_LOCATION_SERVER_PORT = 6868
 
 class LocationServer(object):
@@ -70,11 +261,15 @@ class LocationServer(object):
     
     line_separator = "\r\n"
     receive_size = 4096
+    connect_timeout = 5.0
+    buffer_size = 65536 # Initial size of the receive buffer (grows if a burst doesn't fit).
     
-    def __init__(self, anchor_ids, hostname="", port=6868, logfile=None, log_all=False):
+    def __init__(self, anchor_ids, hostname="", port=6868, logfile=None, log_all=False, capture=None):
         """
         If a logfile is given, all data reveived from the location server will be logged.
+        (It can be a plain file, or anything else with write and flush, e.g. a LogWriter.)
         log_all - Whether to log everything, or just readings from tracked ids.
+        capture - A CaptureWriter to record the readings to (including those with errors), if any.
         """
         super(LocationServer, self).__init__()
         self.hostname = hostname
@@ -82,7 +277,14 @@ class LocationServer(object):
         self.anchor_ids = anchor_ids
         self.logfile = logfile
         self.log_all = log_all
+        self.capture = capture
         self.tracked_ids = set()
+        self.socket = None
+        self.connecting_socket = None # While connecting without waiting (see start_connect).
+        
+        # Running totals, for throughput reporting.
+        self.reading_count = 0
+        self.last_receive_time = None
 
     def should_record(self, tag_id, anchor_id=None):
         "Whether we are tracking these IDs (or logging all)."
@@ -115,9 +317,35 @@ class LocationServer(object):
         """        
         
         logging.info("Connecting to location server at %s:%d" % (self.hostname, self.port))
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.hostname, self.port))
-        self.recv_buffer = ""
+        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connection.settimeout(self.connect_timeout)
+        connection.connect((self.hostname, self.port))
+        self.setup_connection(connection)
+        
+    def start_connect(self):
+        "Start connecting without waiting. The socket to wait on being writable, before calling finish_connect (see Reconnector)."
+        
+        logging.info("Connecting to location server at %s:%d" % (self.hostname, self.port))
+        self.connecting_socket = start_connect(self.hostname, self.port)
+        return self.connecting_socket
+        
+    def finish_connect(self):
+        "Once the socket from start_connect is writable: initiate continuous mode (or raise an exception if it didn't connect)."
+        
+        connection, self.connecting_socket = self.connecting_socket, None
+        try:
+            finish_connect(connection)
+        except:
+            connection.close()
+            raise
+        self.setup_connection(connection)
+        
+    def setup_connection(self, connection):
+        "Take on a newly connected socket, and initiate continuous mode. (From then on the socket is non-blocking.)"
+        
+        connection.settimeout(None)
+        self.socket = connection
+        self.reset_buffer()
 
         # Set the commands to initiate the location server.
         init_command = "INIT %d" % (len(self.anchor_ids))
@@ -130,6 +358,17 @@ class LocationServer(object):
         self.socket.send(init_command + self.line_separator)
         self.socket.send(start_command + self.line_separator)
         self.socket.send(continuous_mode_command + self.line_separator)
+        self.socket.setblocking(0)
+        
+    def close(self):
+        "Close the connection (any partial line received is discarded)."
+        
+        if self.socket:
+            self.socket.close()
+        self.socket = None
+        if self.connecting_socket:
+            self.connecting_socket.close()
+        self.connecting_socket = None
         
     def log_line(self, line):
         "Log a line, and separator, if we are logging."
@@ -138,27 +377,100 @@ class LocationServer(object):
             self.logfile.flush()
         
     def log_lines(self, lines):
-        "Log several lines with separators, if we are logging."
-        for line in lines:
-            self.log_line(line)
+        "Log several lines with separators (in one write), if we are logging."
+        if self.logfile:
+            self.logfile.write("".join([line + self.line_separator for line in lines]))
+            self.logfile.flush()
+        
+    def timestamp_line(self):
+        "A line marking the current time in the log."
+        return "%%:%.3f" % time.time()
         
     def log_timestamp(self):
         "Log the current time."
-        timestamp = "%%:%.3f" % time.time()
-        self.log_line(timestamp)
+        self.log_line(self.timestamp_line())
+        
+    def reset_buffer(self):
+        """
+        Allocate an empty receive buffer.
+
+        Data is received directly into 'recv_buffer' (through 'recv_view').
+        recv_length - The number of bytes in the buffer that are valid.
+        scan_start - The position from which we haven't yet looked for a line separator.
+        """
+        self.recv_buffer = bytearray(self.buffer_size)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.recv_length = 0
+        self.scan_start = 0
+
+    def grow_buffer(self):
+        "Double the size of the receive buffer, keeping any data already received."
+        
+        recv_buffer = bytearray(2 * len(self.recv_buffer))
+        recv_buffer[:self.recv_length] = self.recv_view[:self.recv_length]
+        logging.debug("LocationServer: receive buffer grown to %d bytes" % len(recv_buffer))
+        self.recv_buffer = recv_buffer
+        self.recv_view = memoryview(recv_buffer)
+
+    def receive(self):
+        "Receive all the data available on the socket into the buffer (without waiting for more)."
+        
+        start_length = self.recv_length
+        received = self.receive_size
+        while received == self.receive_size:
+            if len(self.recv_buffer) - self.recv_length < self.receive_size:
+                self.grow_buffer()
+            try:
+                received = self.socket.recv_into(self.recv_view[self.recv_length:], self.receive_size)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break # Nothing more for now.
+                raise
+            logging.debug("LocationServer: received %d bytes" % received)
+            if not received and self.recv_length == start_length:
+                raise socket.error("Connection closed by location server")
+            self.recv_length += received
+        
+    def complete_lines(self):
+        """
+        A list of the complete lines in the buffer. Any trailing partial line is kept for next time.
+        
+        Only the newly received bytes are searched for line separators.
+        """
+
+        separator = self.line_separator
+        
+        end = self.recv_buffer.rfind(separator, self.scan_start, self.recv_length)
+        if end < 0:
+            # A separator may have been split across two receives.
+            self.scan_start = max(0, self.recv_length - len(separator) + 1)
+            return []
+
+        lines = self.recv_view[:end].tobytes().split(separator)
+        
+        # Move the partial line to the front of the buffer.
+        start = end + len(separator)
+        remaining = self.recv_length - start
+        self.recv_buffer[:remaining] = self.recv_buffer[start:self.recv_length]
+        self.recv_length = remaining
+        self.scan_start = max(0, remaining - len(separator) + 1)
+        
+        return lines
+        
+    def receive_lines(self):
+        "Receive any available data. A list of the complete lines (which are logged, if we are logging)."
+
+        self.receive()
+        complete_lines = self.complete_lines()
+
+        self.log_lines([self.timestamp_line()] + complete_lines)
         
+        return complete_lines
+
     def new_readings(self):
         "A list of complete lines received from the server in the order they arrived, if there are any."
 
-        new_data = self.receive_size * "a"
-        while len(new_data) == self.receive_size:
-            new_data = self.socket.recv(self.receive_size)
-            logging.debug("LocationServer: received %d bytes" % len(new_data))
-            self.recv_buffer += new_data
-        
-        lines = self.recv_buffer.split(self.line_separator)
-        complete_lines = lines[:-1]
-        self.recv_buffer = lines[-1]
+        complete_lines = self.receive_lines()
             
         # Process the lines.
         readings = []
@@ -175,33 +487,239 @@ class LocationServer(object):
             except Exception, e:
                 logging.error("Error reading line from location server: %s" % line)
 
-        # Log the lines we are about to process.
-        self.log_timestamp()
-        for line in complete_lines:
-            self.log_line(line)
-
         return readings
         
-class FakeServer(object):
+    def new_reading_array(self):
+        """
+        Like new_readings, but parsed as a batch into a structured array (reading_dtype).
+        Every reading is stamped with the time it was received.
+        """
+        
+        with stats.timer("receive") as timer:
+            complete_lines = self.receive_lines()
+            timer.items = len(complete_lines)
+        now = clock.get_time()
+        
+        with stats.timer("parse", len(complete_lines)):
+            readings = parse_lines(complete_lines, now, keep_errors=True)
+        if self.capture:
+            self.capture.write(readings)
+        readings = without_errors(readings)
+        self.reading_count += len(readings)
+        self.last_receive_time = now
+        
+        return readings
+        
+    def new_reading_batch(self):
+        "Like new_readings, but as a ReadingBatch."
+        
+        return ReadingBatch(self.new_reading_array())
+        
+def merge_batches(batches):
+    "One ReadingBatch with all the readings from the given batches, in order of timestamp."
+    
+    batches = [batch for batch in batches if len(batch)]
+    if not batches:
+        return ReadingBatch()
+    if len(batches) == 1:
+        return batches[0]
+        
+    array = numpy.concatenate([batch.array for batch in batches])
+    order = numpy.argsort(array["timestamp"], kind="mergesort") # Stable, so each source keeps its own order.
+    return ReadingBatch(array[order])
+        
+class Coalescer(object):
     """
-    Emulate a location server in continuous mode based on an experiment database.
+    Keep only the newest reading for each tag-anchor pair in a batch, whatever order they come in.
+    
+    We would prefer to drop a few measurements than to get further and further behind real time.
+    Counts how many readings were superseded for each tag, and measures the lag: 
+    how old the oldest reading was by the time it was processed (see 'processed').
+    """
+    
+    report_period = 60.0
+    
+    def __init__(self):
+        super(Coalescer, self).__init__()
+        self.superseded = {} # tag_id -> readings dropped in favour of a newer one, in total.
+        self.reported_superseded = {}
+        self.oldest_pending = None # Timestamp of the oldest reading coalesced since the last update.
+        self.lag = 0.0 # As of the last update.
+        self.max_lag = 0.0 # Since the last report.
+        self.last_report_time = clock.get_time()
+        
+    def coalesce(self, readings):
+        "A ReadingBatch with the newest reading (the last, in batch order) for each pair, in their original order."
+        
+        if not len(readings):
+            return readings
+            
+        if self.oldest_pending == None:
+            self.oldest_pending = readings.timestamps.min()
+            
+        # The last occurrence of each pair is the first in the reversed keys.
+        keys = (readings.tag_ids.astype(numpy.int64) << 32) | readings.anchor_ids.astype(numpy.int64)
+        unique_keys, reversed_indices = numpy.unique(keys[::-1], return_index=True)
+        if len(unique_keys) == len(readings):
+            return readings
+            
+        keep = numpy.sort(len(readings) - 1 - reversed_indices)
+        
+        dropped = numpy.ones(len(readings), dtype=bool)
+        dropped[keep] = False
+        tag_ids, counts = numpy.unique(readings.tag_ids[dropped], return_counts=True)
+        for tag_id, count in zip(tag_ids.tolist(), counts.tolist()):
+            self.superseded[tag_id] = self.superseded.get(tag_id, 0) + count
+        logging.debug("Coalesced %d readings to %d" % (len(readings), len(keep)))
+        
+        return readings[keep]
+        
+    def backlog(self):
+        """
+        How far behind we are, in seconds: the lag as of the last update, or how long the oldest reading since
+        has been waiting for one, if that's longer. (For MaxLag load shedding.)
+        """
+        
+        lag = self.lag
+        if self.oldest_pending != None:
+            lag = max(lag, clock.get_time() - self.oldest_pending)
+        return lag
+        
+    def processed(self):
+        "Note that everything coalesced so far has been processed (the locations updated). Updates the lag."
+        
+        if self.oldest_pending != None:
+            self.lag = clock.get_time() - self.oldest_pending
+            self.max_lag = max(self.max_lag, self.lag)
+            self.oldest_pending = None
+            
+    def report(self):
+        "Log the maximum lag, and superseded readings for each tag, since the last report, if it's time to."
+        
+        now = clock.get_time()
+        if now - self.last_report_time < self.report_period:
+            return
+            
+        logging.info("Maximum lag behind real time: %.3f seconds" % self.max_lag)
+        for tag_id, count in sorted(self.superseded.items()):
+            superseded = count - self.reported_superseded.get(tag_id, 0)
+            if superseded:
+                logging.info("Tag %d: %d readings superseded" % (tag_id, superseded))
+                
+        self.reported_superseded = dict(self.superseded)
+        self.max_lag = 0.0
+        self.last_report_time = now
+        
+class LocationServerGroup(object):
+    """
+    Several location servers (each covering some of the anchors), read as one.
+    
+    The caller selects on 'sockets()', then passes the readable ones to 'ready' to find the servers with new data.
+    (Their batches can then be combined with merge_batches.)
+    Also keeps track of the throughput and lag of each server, and reports them every 'report_period' seconds.
+    """
+    
+    report_period = 60.0
+    
+    def __init__(self, location_servers):
+        super(LocationServerGroup, self).__init__()
+        self.location_servers = location_servers
+        self.last_report_time = clock.get_time()
+        self.last_report_counts = dict((location_server, 0) for location_server in location_servers)
+        
+    def sockets(self):
+        "The sockets to select on for new readings (from those servers that are connected)."
+        return [location_server.socket for location_server in self.location_servers if location_server.socket]
+        
+    def ready(self, sockets):
+        "The location servers with data waiting, given the readable sockets."
+        return [location_server for location_server in self.location_servers 
+                if location_server.socket and location_server.socket in sockets]
+        
+    def stats(self):
+        """
+        A dictionary of stats for each location server, by (hostname, port):
+        readings - Total readings so far.
+        rate - Readings per second since the last report.
+        lag - Seconds since we last heard from this server, behind the most recently heard server.
+        """
+        
+        now = clock.get_time()
+        duration = max(now - self.last_report_time, 1e-6)
+        
+        receive_times = [location_server.last_receive_time for location_server in self.location_servers if location_server.last_receive_time]
+        if receive_times:
+            latest = max(receive_times)
+        else:
+            latest = now
+            
+        result = {}
+        for location_server in self.location_servers:
+            readings = location_server.reading_count - self.last_report_counts[location_server]
+            if location_server.last_receive_time:
+                lag = latest - location_server.last_receive_time
+            else:
+                lag = None
+            result[(location_server.hostname, location_server.port)] = {"readings": location_server.reading_count,
+                                                                        "rate": readings / duration,
+                                                                        "lag": lag}
+        return result
+        
+    def report(self):
+        "Log the stats for each location server, if it's time to."
+        
+        now = clock.get_time()
+        if now - self.last_report_time < self.report_period:
+            return
+            
+        for (hostname, port), stats in sorted(self.stats().items()):
+            if stats["lag"] == None:
+                logging.warning("Location server %s:%d: no readings yet" % (hostname, port))
+            else:
+                logging.info("Location server %s:%d: %.1f readings/sec, %.2f seconds lag" % (hostname, port, stats["rate"], stats["lag"]))
+            
+        self.last_report_time = now
+        for location_server in self.location_servers:
+            self.last_report_counts[location_server] = location_server.reading_count
+        
+def format_lines(readings):
+    "The text the location server would send for an array of readings (reading_dtype, or similar)."
+    
+    columns = [readings[name].tolist() for name in ["distance", "tag_id", "anchor_id", "error_code"]]
+    line_format = "#%07.2f:%03d:%03d:%03d" + LocationServer.line_separator
+    return "".join([line_format % reading for reading in zip(*columns)])
 
-    FIXME: Implement.
+class FakeServer(object):
     """
-    def __init__(self, experiment, port=DEFAULT_LOCATION_SERVER_PORT, repeat=True):
+    Emulate a location server in continuous mode based on an experiment database, or a capture.
+    
+    The readings are replayed at their recorded times (or faster or slower, by 'speed').
+    """
+    def __init__(self, experiment=None, port=DEFAULT_LOCATION_SERVER_PORT, repeat=True, capture=None, speed=1.0):
         """
-        Feed the data recorded in 'experiment'.
+        Feed the data recorded in 'experiment', or in 'capture' (a Capture) if given.
         """
 
         super(FakeServer, self).__init__()
         self.experiment = experiment
         self.port = port
         self.repeat = repeat
-
-        self.readings = experiment.distance_readings().fetchall()
-
-        self.next_update_time = -1.0
+        self.speed = speed
+
+        if capture != None:
+            # Memory mapped, so nothing is loaded until it's sent.
+            self.readings = capture.records
+        elif experiment != None:
+            rows = experiment.distance_readings().fetchall()
+            self.readings = numpy.zeros(len(rows), dtype=reading_dtype)
+            for name in ["distance", "tag_id", "anchor_id", "timestamp"]:
+                self.readings[name] = [row[name] for row in rows]
+        else:
+            self.readings = numpy.zeros(0, dtype=reading_dtype)
+                
+        self.timestamps = self.readings["timestamp"]
         self.next_reading = 0
+        self.replay_start = None # (time, recorded time) when the replay (re)started.
 
     def connect(self):
         "Bind the TCP socket."
@@ -221,7 +739,7 @@ class FakeServer(object):
         while True:
 
             # Deal with any incoming data first.
-            (readers, writers, exceptors) = select.select(self.rdset + self.clients,[], [], 0.1)
+            (readers, writers, exceptors) = select.select(self.rdset + self.clients,[], [], 0.01)
             for reader in readers:
                 if reader == self.socket:
                     # Accecpt a new connection from this socket.
@@ -239,40 +757,57 @@ class FakeServer(object):
                             if client == reader:
                                 del self.clients[i]
 
-            # Then, see if it's time to push some data.
-            if clock.get_time() > self.next_update_time:
-                self.push_updates()
+            # Then, push whatever is due.
+            self.push_updates()
 
-    def push_updates(self):
-        "Send distance readings to all the clients, update self.next_update_time."
-        
-        now = clock.get_time()
-        updates = ""
+    def start_replay(self, recorded_time):
+        "(Re)start the replay from the given recorded time, now."
+        self.replay_start = clock.get_time(), recorded_time
 
-        reading = self.readings[self.next_reading]
-        while reading["timestamp"] < now:
-            
-            distance_reading = Reading(distance=reading["distance"], tag_id=reading["tag_id"], anchor_id=reading["anchor_id"], error_code=0)
-            updates += "%s%s" % (str(distance_reading), LocationServer.line_separator)
-            
-            self.next_reading += 1
-
-            if self.next_reading >= len(self.readings):
-                if self.loop:
-                    # Set the next reading to the first, and set the time three seconds before the first reading.
-                    self.next_reading = 0
-                    first_timestamp = self.readings[0]["timestamp"]
-                    clock.set_time(first_timestamp - 3.0)
-                    self.next_update_time = first_timestamp
-                break
+    def replay_time(self):
+        "The recorded time we have reached in the replay."
+        
+        if self.replay_start == None:
+            self.start_replay(self.timestamps[0])
             
-            reading = self.readings[self.next_reading]
+        start_time, start_recorded_time = self.replay_start
+        return start_recorded_time + (clock.get_time() - start_time) * self.speed
 
+    def push_updates(self):
+        "Send the distance readings that are due to all the clients."
+
+        updates = self.due_updates()
         if updates:
-            logging.info("Pushing updates of length %d" % len(updates))
-            logging.debug("Updates:\n%s" % updates)
-            for client in self.clients:
-                client.send(updates)
+            self.send_updates(updates)
+
+    def due_updates(self):
+        "The text of the readings due since the last call."
+        
+        if self.next_reading >= len(self.readings):
+            return ""
+        
+        end = numpy.searchsorted(self.timestamps, self.replay_time(), side="right")
+        end = max(end, self.next_reading)
+        updates = format_lines(self.readings[self.next_reading:end])
+        self.next_reading = end
+
+        if self.next_reading >= len(self.readings) and self.repeat:
+            # Start again from the first reading, three seconds from now.
+            self.next_reading = 0
+            self.start_replay(self.timestamps[0] - 3.0 * self.speed)
+
+        return updates
+
+    def send_updates(self, updates):
+        "Send some text to all the clients (dropping any that fail)."
+
+        logging.debug("Pushing updates of length %d" % len(updates))
+        for client in list(self.clients):
+            try:
+                client.sendall(updates)
+            except socket.error, e:
+                logging.info("Dropping client connection: %s" % str(e))
+                self.clients.remove(client)
 
 # The main LocationServer is intended to be used as a module in the LAT Frontend.
 # However, if run as an executable, we can provide a "Fake" location server 
@@ -287,6 +822,10 @@ if __name__ == "__main__":
     option_parser = OptionParser()
     option_parser.add_option("-e", "--experiment", dest="experiment", 
                              help="The experiment database to replay from.")
+    option_parser.add_option("-c", "--capture", dest="capture",
+                             help="The capture file to replay from (instead of an experiment).")
+    option_parser.add_option("-s", "--speed", dest="speed", type="float", default=1.0,
+                             help="The replay speed, relative to the recorded time (default=%default).")
     option_parser.add_option("-l", "--log_level", dest="log_level", type="int",
                              help="The log level.", default=0)
     option_parser.add_option("-o", "--log_file", dest="log_file",
@@ -298,8 +837,15 @@ if __name__ == "__main__":
                         format='%(asctime)s %(levelname)s %(message)s',
                         filemode='w')
     
-    experiment = load_experiment(options.experiment)
-    fake_server = FakeServer(experiment)
+    if options.capture:
+        from Almada.capture import load_capture
+        capture = load_capture(options.capture)
+        if capture == None:
+            raise Exception("Capture not found: %s" % options.capture)
+        fake_server = FakeServer(capture=capture, speed=options.speed)
+    else:
+        experiment = load_experiment(options.experiment)
+        fake_server = FakeServer(experiment, speed=options.speed)
     fake_server.connect()
     fake_server.loop()
 
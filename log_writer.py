@@ -0,0 +1,221 @@
+"""
+A log file that is written on a background thread.
+
+Anything written is put on a bounded queue, so writing never waits on the disk.
+The background thread writes whatever has queued up in one go, optionally compressed (gzip or zstd),
+and rotates to a fresh file once the current one is big enough or old enough.
+
+If the queue is full, the data is dropped (and counted) rather than holding up the caller.
+If writing fails (a full disk, say), the error is logged, the batch counted as dropped, and the thread carries on,
+reopening the file (appending) if need be.
+
+It behaves enough like a file (write, flush, close) to be given to LocationServer as its logfile.
+"""
+
+import os
+import gzip
+import time
+import logging
+import threading
+import Queue
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from Almada.clock import shared_clock as clock
+
+class LogCompression(object):
+
+    none = None
+    gzip = "gzip"
+    zstd = "zstd"
+    types = [none, gzip, zstd]
+    extensions = {none: "", gzip: ".gz", zstd: ".zst"}
+
+class LogWriter(object):
+    """A log file written in batches by a background thread."""
+
+    def __init__(self, filename, compression=None, max_bytes=None, max_age=None, queue_size=10000, batch_size=1000):
+        """
+        filename - The file to write to (an extension is added for compression).
+        compression - One of LogCompression.types
+        max_bytes - Rotate once this much (uncompressed) data has been written to the current file.
+        max_age - Rotate once the current file is this many seconds old.
+        queue_size - The number of writes that can be waiting before any more are dropped.
+        batch_size - The most writes to take off the queue for one write to the file.
+        """
+
+        super(LogWriter, self).__init__()
+
+        if not compression in LogCompression.types:
+            raise Exception("Unrecognised log compression: %s" % compression)
+        if compression == LogCompression.zstd and zstandard == None:
+            raise Exception("zstd log compression requires the zstandard module")
+
+        self.filename = filename + LogCompression.extensions[compression]
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.batch_size = batch_size
+
+        self.queue = Queue.Queue(queue_size)
+        self.dropped_lines = 0 # Total lines dropped (queue full, or the write failed).
+        self.reported_dropped_lines = 0
+        self.dropped_lock = threading.Lock() # Lines are dropped by both the caller and the writer thread.
+        self.written_bytes = 0 # Written to the current file.
+
+        self.file = None
+        self.open()
+
+        self.thread = threading.Thread(target=self.run, name="LogWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open(self, mode="wb"):
+        "Open a fresh file to write to (or with mode 'ab', carry on with the one there; gzip and zstd streams can be appended to)."
+
+        if self.compression == LogCompression.gzip:
+            self.file = gzip.open(self.filename, mode)
+        elif self.compression == LogCompression.zstd:
+            self.raw_file = open(self.filename, mode)
+            self.file = zstandard.ZstdCompressor().stream_writer(self.raw_file)
+        else:
+            self.file = open(self.filename, mode)
+
+        self.open_time = clock.get_time()
+        self.written_bytes = 0
+
+    def close_file(self):
+        "Close the current file."
+
+        file, self.file = self.file, None
+        if file == None:
+            return
+        if self.compression == LogCompression.zstd:
+            file.flush(zstandard.FLUSH_FRAME)
+            self.raw_file.close()
+        else:
+            file.close()
+
+    def rotate(self):
+        "Move the current file aside (with the time it was opened in the name), and start a new one."
+
+        self.close_file()
+
+        base, extension = os.path.splitext(self.filename)
+        if not self.compression:
+            base, extension = self.filename, ""
+        suffix = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.open_time))
+        rotated_filename = "%s.%s%s" % (base, suffix, extension)
+        count = 1
+        while os.path.exists(rotated_filename):
+            count += 1
+            rotated_filename = "%s.%s-%d%s" % (base, suffix, count, extension)
+        os.rename(self.filename, rotated_filename)
+        logging.info("Rotated log file to %s" % rotated_filename)
+
+        self.open()
+
+    def should_rotate(self):
+        "Is the current file big enough or old enough to be rotated?"
+
+        if self.max_bytes and self.written_bytes >= self.max_bytes:
+            return True
+        if self.max_age and clock.get_time() - self.open_time >= self.max_age:
+            return True
+        return False
+
+    def write(self, data):
+        "Queue some data to be written. Never blocks; if the queue is full the data is dropped."
+
+        try:
+            self.queue.put_nowait(data)
+        except Queue.Full:
+            self.drop(data)
+
+    def drop(self, data):
+        "Count the lines in some data that won't be written."
+
+        with self.dropped_lock:
+            self.dropped_lines += data.count("\n")
+
+    def flush(self):
+        "Nothing to do: the background thread flushes after each batch."
+        pass
+
+    def close(self, timeout=10.0):
+        "Write everything queued so far, then stop the background thread and close the file (giving up after timeout seconds)."
+
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+                self.thread.join(timeout)
+            except Queue.Full:
+                logging.error("Log %s: writer not keeping up, closing without writing what's queued" % self.filename)
+            if self.thread.is_alive():
+                logging.error("Log %s: writer did not finish within %.1f seconds" % (self.filename, timeout))
+        self.report_dropped()
+
+    def report_dropped(self):
+        "Log how many lines have been dropped since the last report."
+
+        dropped_lines = self.dropped_lines
+        if dropped_lines > self.reported_dropped_lines:
+            logging.warning("Log %s: dropped %d lines (%d in total)" % (self.filename, dropped_lines - self.reported_dropped_lines, dropped_lines))
+            self.reported_dropped_lines = dropped_lines
+
+    def run(self):
+        "Background thread: write data from the queue in batches until close is called."
+
+        closing = False
+        while not closing:
+            try:
+                batch = [self.queue.get(timeout=1.0)]
+            except Queue.Empty:
+                batch = []
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                closing = True
+
+            if batch:
+                data = "".join(batch)
+                try:
+                    if self.file == None:
+                        self.open("ab")
+                    self.file.write(data)
+                    self.file.flush()
+                    self.written_bytes += len(data)
+                except (IOError, OSError), e:
+                    self.drop(data)
+                    logging.error("Log %s: write failed: %s" % (self.filename, e))
+                    self.close_file_quietly()
+
+            self.report_dropped()
+
+            try:
+                if closing:
+                    self.close_file()
+                elif self.should_rotate():
+                    self.rotate()
+            except (IOError, OSError), e:
+                logging.error("Log %s: %s failed: %s" % (self.filename, closing and "close" or "rotation", e))
+                if not closing:
+                    self.close_file_quietly()
+
+    def close_file_quietly(self):
+        "After a failure, drop the current file (it's reopened, appending, for the next batch)."
+
+        try:
+            self.close_file()
+        except (IOError, OSError), e:
+            logging.error("Log %s: close failed: %s" % (self.filename, e))
+        self.file = None
@@ -0,0 +1,155 @@
+"""
+Keep connections to other servers up.
+
+If a connection can't be made, or is lost, the Reconnector tries again later,
+doubling the delay after each failure (up to a maximum). The delay only goes back to the minimum
+once the connection has stayed up for a while, so a server that accepts and then drops us isn't hammered.
+
+Connecting doesn't block: the connection's start_connect() returns a socket with the connection under way,
+which the owner selects on for writing, calling ready() once it is writable (poll times out attempts taking too long).
+So the connection needs start_connect(), finish_connect() (raising an exception on failure) and close();
+start_connect and finish_connect below do the socket part.
+"""
+
+import os
+import errno
+import socket
+import logging
+
+from Almada.clock import shared_clock as clock
+
+def start_connect(hostname, port):
+    "A non-blocking socket, with a connection to hostname:port under way (see finish_connect)."
+
+    connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connection.setblocking(0)
+    error = connection.connect_ex((hostname, port))
+    if not error in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        connection.close()
+        raise socket.error(error, os.strerror(error))
+    return connection
+
+def finish_connect(connection):
+    "Once the socket from start_connect is writable, raise a socket.error if the connection failed."
+
+    error = connection.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if error:
+        raise socket.error(error, os.strerror(error))
+
+class LinkState(object):
+
+    connected = "connected"
+    connecting = "connecting"
+    disconnected = "disconnected"
+
+class Reconnector(object):
+    """Reconnect a connection with exponential backoff."""
+
+    def __init__(self, connection, name, min_delay=1.0, max_delay=60.0, connect_timeout=5.0, stable_time=10.0):
+        """
+        connection - Anything with start_connect(), finish_connect() and close(). It's assumed connected if it has a socket.
+        name - For logging.
+        min_delay, max_delay - The range of delays between attempts (seconds).
+        connect_timeout - Give up on an attempt that hasn't connected in this long (seconds).
+        stable_time - Go back to the minimum delay once connected for this long (seconds).
+        """
+
+        super(Reconnector, self).__init__()
+        self.connection = connection
+        self.name = name
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.connect_timeout = connect_timeout
+        self.stable_time = stable_time
+        self.delay = min_delay
+        self.next_attempt_time = clock.get_time()
+        self.failures = 0 # Consecutive failed attempts.
+        self.socket = None # While connecting, the socket to wait on being writable.
+        self.connect_start_time = None
+        self.connected_time = clock.get_time()
+
+        if getattr(connection, "socket", None):
+            self.state = LinkState.connected
+        else:
+            self.state = LinkState.disconnected
+
+    def connected(self):
+        return self.state == LinkState.connected
+
+    def start(self):
+        "Start an attempt to connect."
+
+        try:
+            self.socket = self.connection.start_connect()
+        except Exception, e:
+            self.failed(e)
+            return
+        self.state = LinkState.connecting
+        self.connect_start_time = clock.get_time()
+
+    def writer(self):
+        "While connecting, the socket to select on for writing (then call ready), otherwise None."
+
+        if self.state == LinkState.connecting:
+            return self.socket
+        return None
+
+    def ready(self):
+        "The socket being connected is writable: finish connecting. Whether it worked."
+
+        try:
+            self.connection.finish_connect()
+        except Exception, e:
+            self.failed(e)
+            return False
+
+        if self.failures:
+            logging.warning("Reconnected to %s after %d attempts" % (self.name, self.failures))
+        else:
+            logging.info("Connected to %s" % self.name)
+        self.state = LinkState.connected
+        self.socket = None
+        self.connected_time = clock.get_time()
+        self.failures = 0
+        return True
+
+    def failed(self, error):
+        "Note a failed attempt, and schedule the next one."
+
+        self.close()
+        self.failures += 1
+        self.next_attempt_time = clock.get_time() + self.delay
+        logging.error("Error connecting to %s (attempt %d): %s. Retrying in %.1f seconds" % (self.name, self.failures, str(error), self.delay))
+        self.delay = min(2 * self.delay, self.max_delay)
+
+    def lost(self, error):
+        "The connection has failed while in use. Reconnect straight away if it had been up a while, otherwise back off."
+
+        self.close()
+        now = clock.get_time()
+        if now - self.connected_time >= self.stable_time:
+            logging.error("Lost connection to %s: %s" % (self.name, str(error)))
+            self.next_attempt_time = now
+        else:
+            logging.error("Lost connection to %s: %s. Retrying in %.1f seconds" % (self.name, str(error), self.delay))
+            self.next_attempt_time = now + self.delay
+        self.delay = min(2 * self.delay, self.max_delay)
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception, e:
+            logging.debug("Error closing connection to %s: %s" % (self.name, str(e)))
+        self.state = LinkState.disconnected
+        self.socket = None
+
+    def poll(self):
+        "Call regularly: if disconnected, and it's time, try again; give up on attempts taking too long; reset the delay once stable."
+
+        now = clock.get_time()
+        if self.state == LinkState.disconnected and now >= self.next_attempt_time:
+            self.start()
+        elif self.state == LinkState.connecting and now - self.connect_start_time >= self.connect_timeout:
+            self.failed("timed out")
+        elif self.state == LinkState.connected and self.delay > self.min_delay and now - self.connected_time >= self.stable_time:
+            self.delay = self.min_delay
@@ -0,0 +1,186 @@
+"""
+Timers and counters for each stage of the processing, so we can see where the time goes.
+
+Each stage keeps a histogram of how long it took (logarithmic buckets), from which the percentiles are estimated,
+and a count of the items (lines, readings, tags...) it has handled, for throughput.
+Readings are also counted by tag.
+
+Use the module's shared_stats (like shared_clock):
+
+    from Almada.stats import shared_stats as stats
+    with stats.timer("parse") as timer:
+        readings = parse_lines(lines)
+        timer.items = len(readings)
+
+The summary is available as text from the infield device server ("stats?"), or from a StatsServer.
+
+Tracing (optional): readings are stamped when they are received, and the stamp of the newest reading behind each position
+is carried through the distance filter, engine and position filter to the LatServer. If trace_sample_rate is set,
+that fraction of the positions sent have their age (time sent - time received) recorded, as the "position_age" stage.
+
+Durations are measured in real time (time.time), not by the shared clock, which may be paused during a replay.
+With a LocModPool, the engine and filters run in the worker processes, so their stages aren't seen here.
+"""
+
+import math
+import time
+import random
+import socket
+import logging
+
+import numpy
+
+class StageStats(object):
+    """The count, items and duration histogram for one stage."""
+
+    buckets_per_decade = 20
+    min_duration = 1e-6 # The bottom of the first bucket (seconds).
+    bucket_count = 8 * buckets_per_decade # Up to 100 seconds.
+
+    def __init__(self):
+        super(StageStats, self).__init__()
+        self.count = 0
+        self.items = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.buckets = [0] * self.bucket_count
+
+    def add(self, duration, items=1):
+        self.count += 1
+        self.items += items
+        self.total_duration += duration
+        self.max_duration = max(self.max_duration, duration)
+
+        if duration > self.min_duration:
+            bucket = int(math.log10(duration / self.min_duration) * self.buckets_per_decade)
+        else:
+            bucket = 0
+        self.buckets[min(bucket, self.bucket_count - 1)] += 1
+
+    def percentile(self, p):
+        "The duration (seconds) below which p percent of the timings fell (to the top of its bucket)."
+
+        if not self.count:
+            return None
+        cumulative = numpy.cumsum(self.buckets)
+        bucket = numpy.searchsorted(cumulative, self.count * p / 100.0)
+        return min(self.min_duration * 10 ** (float(bucket + 1) / self.buckets_per_decade), self.max_duration)
+
+class Timer(object):
+    """Time a block (with the 'with' statement), adding it to a stage. Set 'items' for the throughput."""
+
+    def __init__(self, stats, stage, items=1):
+        super(Timer, self).__init__()
+        self.stats = stats
+        self.stage = stage
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.stats.record(self.stage, time.time() - self.start, self.items)
+        return False
+
+class Stats(object):
+    """StageStats for each stage (by name), and readings by tag."""
+
+    def __init__(self):
+        super(Stats, self).__init__()
+        self.trace_sample_rate = 0.0 # The fraction of positions to trace.
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.tag_readings = {} # tag_id -> readings
+        self.start_time = time.time()
+
+    def timer(self, stage, items=1):
+        return Timer(self, stage, items)
+
+    def record(self, stage, duration, items=1):
+        if not stage in self.stages:
+            self.stages[stage] = StageStats()
+        self.stages[stage].add(duration, items)
+
+    def tracing(self):
+        "Is tracing on at all?"
+        return self.trace_sample_rate > 0
+
+    def sampled(self):
+        "Should this position be traced?"
+        return self.trace_sample_rate > 0 and random.random() < self.trace_sample_rate
+
+    def count_readings(self, tag_ids):
+        "Count readings by tag (given the tag ID of each, as an array)."
+
+        if not len(tag_ids):
+            return
+        tag_ids, counts = numpy.unique(tag_ids, return_counts=True)
+        for tag_id, count in zip(tag_ids.tolist(), counts.tolist()):
+            self.tag_readings[tag_id] = self.tag_readings.get(tag_id, 0) + count
+
+    def summary(self):
+        """
+        A dictionary of:
+        stages - By name: count, items per second, and the p50, p95 and p99 durations (seconds).
+        tags - Readings per second, by tag ID.
+        duration - Seconds since the stats started.
+        """
+
+        duration = max(time.time() - self.start_time, 1e-6)
+        stages = {}
+        for name, stage in self.stages.iteritems():
+            stages[name] = {"count": stage.count,
+                            "rate": stage.items / duration,
+                            "p50": stage.percentile(50),
+                            "p95": stage.percentile(95),
+                            "p99": stage.percentile(99)}
+        tags = dict((tag_id, count / duration) for tag_id, count in self.tag_readings.iteritems())
+        return {"stages": stages, "tags": tags, "duration": duration}
+
+    def text(self):
+        "The summary as lines of text."
+
+        summary = self.summary()
+        lines = ["Stats over %.1f seconds" % summary["duration"],
+                 "%-16s %10s %12s %10s %10s %10s" % ("Stage", "Count", "Items/sec", "p50 (ms)", "p95 (ms)", "p99 (ms)")]
+        for name, stage in sorted(summary["stages"].items()):
+            lines.append("%-16s %10d %12.1f %10.3f %10.3f %10.3f" % (name, stage["count"], stage["rate"],
+                         stage["p50"] * 1000, stage["p95"] * 1000, stage["p99"] * 1000))
+        for tag_id, rate in sorted(summary["tags"].items()):
+            lines.append("Tag %d: %.2f readings/sec" % (tag_id, rate))
+        return "\r\n".join(lines) + "\r\n"
+
+# The module keeps a singleton stats object, as the clock module does.
+shared_stats = Stats()
+
+class StatsServer(object):
+    """A local TCP endpoint that sends the stats text to anything that connects, then hangs up."""
+
+    def __init__(self, port, hostname="localhost", stats=shared_stats):
+        super(StatsServer, self).__init__()
+        self.port = port
+        self.hostname = hostname
+        self.stats = stats
+        self.socket = None
+
+    def connect(self):
+        "Bind the TCP socket."
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.hostname, self.port))
+        self.socket.listen(5)
+
+    def accept_client(self):
+        "Accept a connection on the socket, and send it the stats."
+
+        client, address = self.socket.accept()
+        client.settimeout(1.0)
+        try:
+            client.sendall(self.stats.text())
+        except socket.error, e:
+            logging.warning("Error sending stats to %s: %s" % (str(address), str(e)))
+        client.close()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Checks for the binary capture of readings (capture): the block index, time ranges, and appending to an existing capture.
+# Run directly: each check asserts, and "OK" is printed at the end.
+
+import os
+import shutil
+import tempfile
+
+import numpy
+
+from Almada.location_server import reading_dtype
+from Almada.capture import CaptureWriter, Capture, index_filename, header_size, capture_dtype
+
+def readings(start, count):
+    "Readings a tenth of a second apart from start (every tenth with an error code)."
+
+    array = numpy.zeros(count, dtype=reading_dtype)
+    array["timestamp"] = start + numpy.arange(count) * 0.1
+    array["tag_id"] = numpy.arange(count) % 3 + 1
+    array["anchor_id"] = numpy.arange(count) % 5 + 1
+    array["distance"] = numpy.arange(count) * 0.01
+    array["error_code"] = (numpy.arange(count) % 10 == 9)
+    return array
+
+def test_time_range(directory):
+    "The records in a time range are found through the block index, as a search of all of them would."
+
+    filename = os.path.join(directory, "range.cap")
+    writer = CaptureWriter(filename, block_size=16)
+    for i in range(10):
+        writer.write(readings(100.0 + i * 10.0, 100))
+    writer.close()
+
+    capture = Capture(filename)
+    assert len(capture) == 1000
+    assert len(capture.index) == (1000 + 15) // 16
+    timestamps = numpy.asarray(capture.records["timestamp"])
+    for start_time, end_time in [(None, None), (100.0, 200.0), (123.45, 157.0), (99.0, 100.05), (150.0, 150.0), (300.0, None)]:
+        first, last = capture.record_range(start_time, end_time)
+        selected = numpy.ones(len(timestamps), dtype=bool)
+        if start_time != None:
+            selected &= timestamps >= start_time
+        if end_time != None:
+            selected &= timestamps < end_time
+        assert (first, last) == (selected.argmax() if selected.any() else first, first + selected.sum())
+
+    rows = list(capture.readings(120.0, 130.0))
+    assert len(rows) == 90 # A tenth have errors.
+    assert rows[0][3] == 120.0 and rows[-1][3] < 130.0
+
+def test_append(directory):
+    "Carrying on a capture drops a partly written record, and the index follows on."
+
+    filename = os.path.join(directory, "append.cap")
+    writer = CaptureWriter(filename, block_size=8)
+    writer.write(readings(0.0, 20))
+    writer.close()
+    f = open(filename, "ab")
+    f.write("\0" * (capture_dtype.itemsize // 2)) # Interrupted.
+    f.close()
+
+    writer = CaptureWriter(filename)
+    assert writer.block_size == 8
+    assert os.path.getsize(filename) == header_size + 20 * capture_dtype.itemsize
+    writer.write(readings(2.0, 20))
+    writer.close()
+
+    capture = Capture(filename)
+    assert len(capture) == 40
+    assert capture.index["record"].tolist() == [0, 8, 16, 24, 32]
+    assert numpy.all(numpy.diff(capture.records["timestamp"]) > 0)
+
+def test_missing_index(directory):
+    "Without its index file, a capture's index is rebuilt from the records."
+
+    filename = os.path.join(directory, "missing.cap")
+    writer = CaptureWriter(filename, block_size=4)
+    writer.write(readings(0.0, 10))
+    writer.close()
+    expected = Capture(filename).index
+    os.remove(index_filename(filename))
+    assert Capture(filename).index.tolist() == expected.tolist()
+
+if __name__ == "__main__":
+
+    for test in [test_time_range, test_append, test_missing_index]:
+        directory = tempfile.mkdtemp()
+        try:
+            test(directory)
+        finally:
+            shutil.rmtree(directory)
+    print "OK"
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# Checks for the coalescing of readings (location_server.Coalescer): the newest reading for each tag-anchor pair is kept,
+# the rest counted as superseded, and the lag measured.
+# Run directly: each check asserts, and "OK" is printed at the end.
+
+from Almada.clock import shared_clock as clock
+from Almada.location_server import Reading, ReadingBatch, Coalescer
+
+def batch(pairs, timestamp=None):
+    "A batch with a reading for each (tag_id, anchor_id, distance), in order."
+    return ReadingBatch.from_readings([Reading(distance=distance, tag_id=tag_id, anchor_id=anchor_id, error_code=0)
+                                       for tag_id, anchor_id, distance in pairs], timestamp)
+
+def test_newest_kept():
+    "Only the last reading for each pair is kept, in the order they came in."
+
+    clock.pause(100.0)
+    coalescer = Coalescer()
+    readings = coalescer.coalesce(batch([(1, 1, 1.0), (1, 2, 2.0), (1, 1, 3.0), (2, 1, 4.0), (1, 1, 5.0)]))
+    assert zip(readings.tag_ids.tolist(), readings.anchor_ids.tolist(), readings.distances.tolist()) == \
+           [(1, 2, 2.0), (2, 1, 4.0), (1, 1, 5.0)]
+    assert coalescer.superseded == {1: 2}
+
+def test_nothing_superseded():
+    "A batch with a reading a pair is passed through as it is."
+
+    clock.pause(200.0)
+    coalescer = Coalescer()
+    original = batch([(1, 1, 1.0), (1, 2, 2.0), (2, 1, 3.0)])
+    assert coalescer.coalesce(original) is original
+    assert coalescer.superseded == {}
+    assert len(coalescer.coalesce(batch([]))) == 0
+
+def test_lag():
+    "The lag is how long the oldest reading waited for the update that processed it."
+
+    clock.pause(300.0)
+    coalescer = Coalescer()
+    coalescer.coalesce(batch([(1, 1, 1.0)]))
+    clock.pause(300.5)
+    coalescer.coalesce(batch([(1, 1, 2.0)]))
+    clock.pause(301.25)
+    assert abs(coalescer.backlog() - 1.25) < 1e-6
+    coalescer.processed()
+    assert abs(coalescer.lag - 1.25) < 1e-6
+    assert coalescer.max_lag == coalescer.lag
+    coalescer.processed() # Nothing new: the lag stands.
+    assert abs(coalescer.lag - 1.25) < 1e-6
+
+if __name__ == "__main__":
+
+    test_newest_kept()
+    test_nothing_superseded()
+    test_lag()
+    print "OK"
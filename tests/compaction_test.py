@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+# Checks for the compaction of distance readings (experiment.compaction): the summaries, the readings kept around
+# ground truth, and carrying on from where an earlier compaction got to.
+# Run directly: each check asserts, and "OK" is printed at the end.
+
+import os
+import shutil
+import random
+import tempfile
+
+import numpy
+
+from Almada.experiment.experiment_db import new_experiment
+from Almada.experiment import compaction
+
+def readings_experiment(directory, name, duration=6000):
+    "An experiment (without indexes) with a reading a second from tags 1 and 2 at anchor 1, and ground truth for tag 1 at 1000-1200."
+
+    random.seed(1)
+    experiment = new_experiment(os.path.join(directory, name), indexes=False)
+    experiment.add_anchor(1, (0.0, 0.0))
+    rows = [(1, tag_id, random.gauss(5.0, 1.0), None, float(t)) for t in range(duration) for tag_id in (1, 2)]
+    experiment.cursor.executemany(experiment.add_reading_sql, rows)
+    experiment.connection.commit()
+    experiment.add_ground_truth("g", 1, 1000.0, 1200.0, 0.0, 0.0, None, None)
+    return experiment, rows
+
+def summaries(experiment):
+    return [tuple(row) for row in experiment.query("SELECT anchor_id, tag_id, start_time, end_time, count, median, spread "
+                                                   "FROM distance_summary ORDER BY tag_id, start_time").fetchall()]
+
+def test_summaries(directory):
+    "Readings older than keep_recent become a summary a bucket, except those near ground truth."
+
+    experiment, rows = readings_experiment(directory, "summaries.db")
+    summarised = compaction.compact(experiment, keep_recent=1000, bucket=60, ground_truth_margin=30, window=600)
+    # Only the timestamp index is built (for the windows), the others are left to migrate.
+    assert [row[0] for row in experiment.query("SELECT name FROM sqlite_master WHERE type = 'index'")] == ["distance_reading_timestamp"]
+
+    # Up to 4980 (the bucket 1000 seconds before the newest reading): tag 2's, and tag 1's but for the 260 around its ground truth.
+    assert summarised == 4980 + 4980 - 260
+    assert experiment.query("SELECT COUNT(*) FROM distance_reading WHERE timestamp < 4980").fetchone()[0] == 260
+    assert experiment.query("SELECT COUNT(*) FROM distance_reading WHERE timestamp >= 4980").fetchone()[0] == 2 * 1020
+
+    first = summaries(experiment)[0]
+    distances = [distance for anchor_id, tag_id, distance, ground_truth_id, timestamp in rows if tag_id == 1 and timestamp < 60]
+    assert first[:5] == (1, 1, 0.0, 60.0, 60)
+    assert abs(first[5] - numpy.median(distances)) < 1e-9
+    assert abs(first[6] - (numpy.percentile(distances, 75) - numpy.percentile(distances, 25))) < 1e-9
+
+def test_resume(directory):
+    "Compacting part of the way, then carrying on, gives the same as compacting in one go."
+
+    whole, rows = readings_experiment(directory, "whole.db")
+    compaction.compact(whole, keep_recent=1000, bucket=60, ground_truth_margin=30, window=600)
+
+    parts, rows = readings_experiment(directory, "parts.db")
+    compaction.compact(parts, keep_recent=1000, bucket=60, ground_truth_margin=30, window=600, now=2500)
+    assert parts.query(compaction.compaction_state_sql).fetchone()[0] == 1500.0
+    assert compaction.compact(parts, keep_recent=1000, bucket=60, ground_truth_margin=30, window=600, now=2500) == 0 # Nothing twice.
+    compaction.compact(parts, keep_recent=1000, bucket=60, ground_truth_margin=30, window=600)
+
+    assert summaries(parts) == summaries(whole)
+    assert parts.query("SELECT COUNT(*) FROM distance_reading").fetchone()[0] == whole.query("SELECT COUNT(*) FROM distance_reading").fetchone()[0]
+
+def test_bucket_size(directory):
+    "Carrying on with a different bucket size is refused."
+
+    experiment, rows = readings_experiment(directory, "bucket.db")
+    compaction.compact(experiment, keep_recent=1000, bucket=60, now=3000)
+    try:
+        compaction.compact(experiment, keep_recent=1000, bucket=30)
+    except Exception, e:
+        assert "60 second buckets" in str(e)
+    else:
+        assert False, "A different bucket size was allowed"
+
+if __name__ == "__main__":
+
+    for test in [test_summaries, test_resume, test_bucket_size]:
+        directory = tempfile.mkdtemp()
+        try:
+            test(directory)
+        finally:
+            shutil.rmtree(directory)
+    print "OK"
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Checks for the configurations' estimate databases (Experiment.estimate_connection): many configurations queried at once,
+# nothing committed behind the caller's back, cancelling ground truth while recording, and clearing them.
+# Run directly: each check asserts, and "OK" is printed at the end.
+
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+
+from Almada.clock import shared_clock as clock
+from Almada.experiment import schema
+from Almada.experiment.experiment_db import new_experiment
+
+def estimates_experiment(directory, configurations=12):
+    "An experiment with the given number of configurations, each with an estimate (x the configuration's index)."
+
+    experiment = new_experiment(os.path.join(directory, "estimates.db"))
+    for i in range(configurations):
+        experiment.register_configuration("configuration %d" % i)
+        experiment.add_full_estimate(5, float(i), 0.0, 100.0 + i, None, None)
+    experiment.commit()
+    return experiment
+
+def test_many_configurations(directory):
+    "Every configuration can be queried while another's rows are still being read."
+
+    experiment = estimates_experiment(directory)
+    assert sorted(os.listdir(schema.estimates_directory(experiment.filename()))) == sorted("%d.db" % i for i in range(1, 13))
+
+    held = experiment.estimates(1)
+    assert tuple(held.fetchone()) == (5, 0.0, 0.0, 100.0)
+    for configuration_id in range(1, 13):
+        assert [row["x"] for row in experiment.estimates(configuration_id)] == [configuration_id - 1.0]
+    assert held.fetchall() == []
+    experiment.close()
+
+def test_no_hidden_commit(directory):
+    "Querying (and adding to) an estimate database leaves the main connection's transaction alone."
+
+    experiment = estimates_experiment(directory)
+    experiment.cursor.execute("INSERT INTO anchor (id, x, y) VALUES (9, 0.0, 0.0)")
+    experiment.estimates(3).fetchall()
+    experiment.configuration_id = 4
+    experiment.add_full_estimate(5, 1.0, 1.0, 200.0, None, None)
+
+    other = sqlite3.connect(experiment.filename())
+    assert other.execute("SELECT COUNT(*) FROM anchor WHERE id = 9").fetchone()[0] == 0
+    experiment.connection.rollback()
+    experiment.commit()
+    assert len(experiment.estimates(4).fetchall()) == 2
+    other.close()
+    experiment.close()
+
+def test_cancel_while_recording(directory):
+    "Cancelled ground truth is taken off the estimates, in turn with those being recorded (written as start_recording says)."
+
+    experiment = estimates_experiment(directory, 2)
+    clock.pause(1000.0)
+    ground_truth_id = experiment.start_ground_truth(5, "A", (0.0, 0.0))
+    for configuration_id in (1, 2):
+        connection = experiment.estimate_connection(configuration_id)
+        connection.execute("UPDATE estimate SET ground_truth_id = ?", (ground_truth_id,))
+        connection.commit()
+
+    experiment.start_recording(commit_size=5, commit_interval=30.0)
+    experiment.configuration_id = 2
+    for i in range(5):
+        experiment.add_estimate(5, 1.0, 1.0)
+    writer = experiment.estimate_writers[2]
+    assert (writer.commit_size, writer.commit_interval) == (5, 30.0)
+    time.sleep(0.5) # Written, as there are commit_size of them.
+    experiment.estimate_connection(2).execute("UPDATE estimate SET ground_truth_id = ?", (ground_truth_id,))
+    experiment.estimate_connection(2).commit()
+
+    experiment.cancel_ground_truth(ground_truth_id)
+    experiment.stop_recording()
+    for configuration_id, count in [(1, 1), (2, 6)]:
+        assert tuple(experiment.estimate_query(configuration_id, "SELECT COUNT(*), COUNT(ground_truth_id) FROM estimate").fetchone()) == (count, 0)
+    experiment.close()
+
+def test_clear(directory):
+    "Clearing a configuration deletes its estimate database; clearing them all deletes every one."
+
+    experiment = estimates_experiment(directory, 3)
+    experiment.estimates(2).fetchall()
+    experiment.clear_generated_data(2)
+    assert experiment.configuration_ids() == [1, 3]
+    assert sorted(os.listdir(schema.estimates_directory(experiment.filename()))) == ["1.db", "3.db"]
+    assert not 2 in experiment.estimate_connections
+
+    experiment.clear_generated_data()
+    assert experiment.configuration_ids() == []
+    assert os.listdir(schema.estimates_directory(experiment.filename())) == []
+    assert experiment.estimate_connections == {}
+    experiment.close()
+
+if __name__ == "__main__":
+
+    for test in [test_many_configurations, test_no_hidden_commit, test_cancel_while_recording, test_clear]:
+        directory = tempfile.mkdtemp()
+        try:
+            test(directory)
+        finally:
+            shutil.rmtree(directory)
+    print "OK"
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Benchmark for the experiment database indexes.
+# Builds a synthetic experiment without indexes, times the queries run_experiment and analyze_experiment make,
+# then migrates it (building the indexes) and times them again.
+
+import os
+import random
+import shutil
+import tempfile
+import time
+from optparse import OptionParser
+
+from Almada.experiment.experiment_db import new_experiment, load_experiment
+
+def generate_experiment(filename, tag_count, anchor_count, duration, rate, configurations):
+    "An experiment (without indexes) with readings at 'rate' per tag-anchor pair, a ground truth entry every ten seconds, and estimates."
+
+    experiment = new_experiment(filename, indexes=False)
+    for anchor_id in range(1, anchor_count + 1):
+        experiment.add_anchor(anchor_id, (random.uniform(0, 20), random.uniform(0, 10)))
+
+    ground_truth_rows = []
+    ground_truth_id = 0
+    for tag_id in range(1, tag_count + 1):
+        for start_time in range(0, int(duration), 10):
+            ground_truth_id += 1
+            ground_truth_rows.append((ground_truth_id, "P%d" % ground_truth_id, tag_id, start_time, start_time + 10.0,
+                                      random.uniform(0, 20), random.uniform(0, 10)))
+    experiment.cursor.executemany("INSERT INTO ground_truth (id, label, tag_id, start_time, end_time, start_x, start_y) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  ground_truth_rows)
+
+    reading_rows = []
+    for i in range(int(duration * rate)):
+        timestamp = i / float(rate)
+        for tag_id in range(1, tag_count + 1):
+            ground_truth_id = (tag_id - 1) * int(duration / 10) + int(timestamp / 10) + 1
+            for anchor_id in range(1, anchor_count + 1):
+                reading_rows.append((anchor_id, tag_id, random.uniform(0, 20), ground_truth_id, timestamp))
+    experiment.cursor.executemany("INSERT INTO distance_reading (anchor_id, tag_id, distance, ground_truth_id, timestamp) VALUES (?, ?, ?, ?, ?)",
+                                  reading_rows)
+
+    for configuration in range(configurations):
+        experiment.register_configuration("config%d" % configuration)
+        estimate_rows = [(tag_id, random.uniform(0, 20), random.uniform(0, 10), timestamp, ground_truth_id, experiment.configuration_id)
+                         for anchor_id, tag_id, distance, ground_truth_id, timestamp in reading_rows if anchor_id == 1]
+        experiment.estimate_connection(experiment.configuration_id).executemany(
+            "INSERT INTO estimate (tag_id, x, y, timestamp, ground_truth_id, configuration_id) VALUES (?, ?, ?, ?, ?, ?)", estimate_rows)
+
+    experiment.commit()
+    return len(reading_rows)
+
+def run_experiment_queries(experiment, lookups):
+    "The reading scan, and the ground truth lookups for each estimate, as run_experiment.run_locmod does them."
+
+    sql = "SELECT anchor_id, tag_id, distance, timestamp FROM distance_reading ORDER BY timestamp"
+    readings = experiment.query(sql).fetchall()
+    for anchor_id, tag_id, distance, timestamp in random.sample(readings, min(lookups, len(readings))):
+        experiment.ground_truth(tag_id, timestamp)
+        experiment.ground_truth_id(tag_id, timestamp)
+    experiment.tag_ids()
+
+def analyze_experiment_queries(experiment):
+    "The per ground truth queries of analyze_experiment (analyze_distance_readings, dump_anchor_reception, plot_moving_estimates)."
+
+    configuration_ids = experiment.configuration_ids()
+    for ground_truth_id in experiment.ground_truth_ids():
+        experiment.query("SELECT DISTINCT(timestamp) FROM distance_reading WHERE ground_truth_id = ? ORDER BY timestamp", (ground_truth_id,)).fetchall()
+        experiment.query("SELECT MIN(timestamp), MAX(timestamp) FROM distance_reading WHERE ground_truth_id = ?", (ground_truth_id,)).fetchone()
+        for anchor_id in experiment.anchors:
+            experiment.query("SELECT COUNT(*) FROM distance_reading WHERE ground_truth_id = ? AND anchor_id = ?", (ground_truth_id, anchor_id)).fetchone()
+        for configuration_id in configuration_ids:
+            experiment.estimate_query(configuration_id, "SELECT x, y FROM estimate WHERE configuration_id = ? AND ground_truth_id = ? ORDER BY timestamp ASC",
+                                      (configuration_id, ground_truth_id)).fetchall()
+    for configuration_id in configuration_ids:
+        experiment.estimates(configuration_id).fetchall()
+
+def time_queries(filename, lookups):
+    "Seconds for the run_experiment and analyze_experiment queries."
+
+    random.seed(1)
+    experiment = load_experiment(filename)
+    start = time.time()
+    run_experiment_queries(experiment, lookups)
+    run_time = time.time() - start
+    start = time.time()
+    analyze_experiment_queries(experiment)
+    analyze_time = time.time() - start
+    experiment.connection.close()
+    return run_time, analyze_time
+
+if __name__ == "__main__":
+
+    option_parser = OptionParser()
+    option_parser.add_option("-t", "--tags", dest="tags", type="int", default=10,
+                             help="The number of tags (default=%default).")
+    option_parser.add_option("-a", "--anchors", dest="anchors", type="int", default=8,
+                             help="The number of anchors (default=%default).")
+    option_parser.add_option("-d", "--duration", dest="duration", type="float", default=300,
+                             help="The length of the experiment in seconds (default=%default).")
+    option_parser.add_option("-r", "--rate", dest="rate", type="float", default=2,
+                             help="Readings per second for each tag-anchor pair (default=%default).")
+    option_parser.add_option("-n", "--lookups", dest="lookups", type="int", default=2000,
+                             help="The number of ground truth lookups (default=%default).")
+
+    options, args = option_parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "experiment.db")
+        count = generate_experiment(filename, options.tags, options.anchors, options.duration, options.rate, 2)
+        print "%d distance readings" % count
+
+        before = time_queries(filename, options.lookups)
+
+        start = time.time()
+        experiment = load_experiment(filename)
+        experiment.migrate()
+        experiment.connection.close()
+        print "Migration (index build): %.2f seconds" % (time.time() - start)
+
+        after = time_queries(filename, options.lookups)
+
+        print "%-20s %10s %10s" % ("", "Before", "After")
+        print "%-20s %9.2fs %9.2fs" % ("run_experiment", before[0], after[0])
+        print "%-20s %9.2fs %9.2fs" % ("analyze_experiment", before[1], after[1])
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+# Checks for the load shedding policies (load_shedding), and the backlog MaxLag sheds on (Coalescer.backlog).
+# Run directly: each check asserts, and "OK" is printed at the end.
+
+from Almada.clock import shared_clock as clock
+from Almada.location_server import Reading, ReadingBatch, Coalescer
+from Almada.load_shedding import LoadShedder, MaxLag, TagRateCap, FairShare
+
+def batch(tag_ids, anchor_id=1, timestamp=None):
+    "A batch with a reading from each of the given tags (in order), stamped now."
+    return ReadingBatch.from_readings([Reading(distance=1.0, tag_id=tag_id, anchor_id=anchor_id, error_code=0) for tag_id in tag_ids],
+                                      timestamp)
+
+def test_max_lag_delayed_batch():
+    "A batch taken in while the last one is still waiting for its update is shed once the wait passes max_lag."
+
+    clock.pause(1000.0)
+    coalescer = Coalescer()
+    shedder = LoadShedder([MaxLag(2.0)], priority_tag_ids=[9])
+
+    readings = coalescer.coalesce(batch([1, 2, 3]))
+    assert len(shedder.shed(readings, coalescer.backlog())) == 3 # Just arrived: nothing to shed.
+
+    # No update for 3 seconds (a slow LocMod), then the next batch, stamped as it's received.
+    clock.pause(1003.0)
+    readings = coalescer.coalesce(batch([1, 2, 9], anchor_id=2))
+    assert abs(coalescer.backlog() - 3.0) < 1e-6
+    kept = shedder.shed(readings, coalescer.backlog())
+    assert kept.tag_ids.tolist() == [9] # Only the priority tag gets through.
+    assert shedder.shed_counts == {("max_lag", 1): 1, ("max_lag", 2): 1}
+
+    # Once an update has caught up, nothing more is shed.
+    coalescer.processed()
+    clock.pause(1003.5)
+    readings = coalescer.coalesce(batch([1, 2]))
+    coalescer.processed()
+    readings = coalescer.coalesce(batch([1, 2]))
+    assert len(shedder.shed(readings, coalescer.backlog())) == 2
+
+def test_max_lag_slow_update():
+    "An update that finished more than max_lag behind sheds the next batch, then recovers."
+
+    clock.pause(2000.0)
+    coalescer = Coalescer()
+    shedder = LoadShedder([MaxLag(1.0)])
+    coalescer.coalesce(batch([1]))
+    clock.pause(2005.0) # The update took 5 seconds.
+    coalescer.processed()
+
+    readings = coalescer.coalesce(batch([1, 2]))
+    assert len(shedder.shed(readings, coalescer.backlog())) == 0
+    coalescer.processed()
+    readings = coalescer.coalesce(batch([1, 2]))
+    assert len(shedder.shed(readings, coalescer.backlog())) == 2
+
+def test_tag_rate_cap():
+    "A tag over its rate keeps only its newest readings; the others are untouched."
+
+    clock.pause(3000.0)
+    shedder = LoadShedder([TagRateCap(rate=2, burst=2)])
+    readings = ReadingBatch.from_readings([Reading(distance=float(i), tag_id=1, anchor_id=i, error_code=0) for i in range(5)] +
+                                          [Reading(distance=0.0, tag_id=2, anchor_id=1, error_code=0)])
+    kept = shedder.shed(readings)
+    assert kept.tag_ids.tolist() == [1, 1, 2]
+    assert kept.distances.tolist() == [3.0, 4.0, 0.0]
+
+    clock.pause(3001.0) # Another 2 tokens.
+    assert len(shedder.shed(readings)) == 3
+
+def test_fair_share():
+    "The budget is shared round-robin, newest first, so a noisy tag can't crowd out the rest."
+
+    clock.pause(4000.0)
+    shedder = LoadShedder([FairShare(4)])
+    readings = batch([1] * 10 + [2, 3])
+    kept = shedder.shed(readings)
+    assert len(kept) == 4
+    assert sorted(kept.tag_ids.tolist()) == [1, 1, 2, 3]
+
+if __name__ == "__main__":
+
+    test_max_lag_delayed_batch()
+    test_max_lag_slow_update()
+    test_tag_rate_cap()
+    test_fair_share()
+    print "OK"
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Microbenchmark for LocationServer.new_readings.
+# Compares the current receive path with the old string concatenation one (lines/sec).
+# Also compares parsing lines one by one with parsing them as a batch, for several batch sizes.
+
+import logging
+import random
+import time
+from optparse import OptionParser
+
+from Almada.location_server import LocationServer, Reading, parse_lines
+
+class FakeSocket(object):
+    """Serve a fixed string of data in chunks, as a socket would."""
+
+    def __init__(self, data, chunk_size):
+        super(FakeSocket, self).__init__()
+        self.data = data
+        self.chunk_size = chunk_size
+        self.position = 0
+
+    def recv(self, size):
+        size = min(size, self.chunk_size)
+        result = self.data[self.position:self.position + size]
+        self.position += len(result)
+        return result
+
+    def recv_into(self, buffer, size):
+        result = self.recv(size)
+        buffer[:len(result)] = result
+        return len(result)
+
+class StringLocationServer(LocationServer):
+    """The old receive path: grow a string, and split the whole thing each time."""
+
+    def reset_buffer(self):
+        self.recv_buffer = ""
+
+    def receive(self):
+        new_data = self.receive_size * "a"
+        while len(new_data) == self.receive_size:
+            new_data = self.socket.recv(self.receive_size)
+            logging.debug("LocationServer: received %d bytes" % len(new_data))
+            self.recv_buffer += new_data
+
+    def complete_lines(self):
+        lines = self.recv_buffer.split(self.line_separator)
+        self.recv_buffer = lines[-1]
+        return lines[:-1]
+
+def generate_data(line_count, tag_count, anchor_ids):
+    "A string of line_count lines in the Nanotron line protocol."
+
+    lines = []
+    for i in range(line_count):
+        reading = Reading(distance=random.uniform(0, 30), tag_id=random.randint(1, tag_count),
+                          anchor_id=random.choice(anchor_ids), error_code=0)
+        lines.append(repr(reading))
+    return LocationServer.line_separator.join(lines) + LocationServer.line_separator
+
+def run(server_class, data, chunk_size, burst_size, parse=True):
+    "Lines per second, and the lines (or readings if parsing) as returned by the server."
+
+    server = server_class([])
+    server.reset_buffer()
+    results = []
+
+    start = time.time()
+    for i in range(0, len(data), burst_size):
+        server.socket = FakeSocket(data[i:i + burst_size], chunk_size)
+        if parse:
+            results.extend(server.new_readings())
+        else:
+            server.receive()
+            results.extend(server.complete_lines())
+    duration = time.time() - start
+
+    return len(results) / duration, results
+
+def run_batch_parse(lines, batch_size):
+    "Lines per second, and the readings, when parsing batch_size lines at a time."
+
+    results = []
+
+    start = time.time()
+    for i in range(0, len(lines), batch_size):
+        results.extend(parse_lines(lines[i:i + batch_size]).tolist())
+    duration = time.time() - start
+
+    return len(lines) / duration, results
+
+if __name__ == "__main__":
+
+    option_parser = OptionParser()
+    option_parser.add_option("-n", "--lines", dest="lines", type="int", default=200000,
+                             help="The number of lines to parse (default=%default).")
+    option_parser.add_option("-t", "--tags", dest="tags", type="int", default=50,
+                             help="The number of tags (default=%default).")
+    option_parser.add_option("-b", "--burst", dest="burst", type="int", default=256 * 1024,
+                             help="The bytes available on each call to new_readings (default=%default).")
+
+    options, args = option_parser.parse_args()
+
+    data = generate_data(options.lines, options.tags, range(1, 9))
+
+    before, old_lines = run(StringLocationServer, data, LocationServer.receive_size, options.burst, parse=False)
+    after, new_lines = run(LocationServer, data, LocationServer.receive_size, options.burst, parse=False)
+    assert old_lines == new_lines, "Lines differ between receive paths"
+
+    print "Receive only"
+    print "Before: %10.0f lines/sec" % before
+    print "After:  %10.0f lines/sec" % after
+
+    before, old_readings = run(StringLocationServer, data, LocationServer.receive_size, options.burst)
+    after, new_readings = run(LocationServer, data, LocationServer.receive_size, options.burst)
+    assert map(repr, old_readings) == map(repr, new_readings), "Readings differ between receive paths"
+
+    print "Receive and parse"
+    print "Before: %10.0f lines/sec" % before
+    print "After:  %10.0f lines/sec" % after
+
+    lines = new_lines
+    expected = [(r.distance, r.tag_id, r.anchor_id) for r in new_readings]
+
+    print "Batch parse"
+    for batch_size in [10, 100, 1000, 10000, 100000]:
+        rate, readings = run_batch_parse(lines, batch_size)
+        assert [r[:3] for r in readings] == expected, "Readings differ for batch parse"
+        print "%6d lines: %10.0f lines/sec" % (batch_size, rate)
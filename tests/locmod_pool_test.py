@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#
+# Checks for the sharding of tags between LocModPool workers (location.locmod_pool): the consistent hash ring,
+# and dropping the tags that move to another worker.
+# Run directly: each check asserts, and "OK" is printed at the end.
+
+from Almada.location.locmod_pool import ConsistentHashRing, forget_tags
+from Almada.location.distance_filter import DistanceFilter
+
+def test_ring_spread():
+    "The tags are spread over the shards, the same way every time."
+
+    ring = ConsistentHashRing()
+    for shard in range(4):
+        ring.add(shard)
+    owners = dict((tag_id, ring.owner(tag_id)) for tag_id in range(1000))
+    counts = [owners.values().count(shard) for shard in range(4)]
+    assert min(counts) > 150, counts
+
+    again = ConsistentHashRing()
+    for shard in range(4):
+        again.add(shard)
+    assert owners == dict((tag_id, again.owner(tag_id)) for tag_id in range(1000))
+
+def test_ring_add():
+    "Adding a shard only moves tags to it."
+
+    ring = ConsistentHashRing()
+    for shard in range(3):
+        ring.add(shard)
+    before = dict((tag_id, ring.owner(tag_id)) for tag_id in range(1000))
+    ring.add(3)
+    moved = [tag_id for tag_id in range(1000) if ring.owner(tag_id) != before[tag_id]]
+    assert moved
+    assert all(ring.owner(tag_id) == 3 for tag_id in moved)
+
+class FakeLocMod(object):
+    "Just the attributes forget_tags looks at."
+
+    def __init__(self):
+        self.tag_ids = set([1, 2, 3])
+        self.dirty_tag_ids = set([1, 3])
+        self.particle_clouds = {1: "cloud", 2: "cloud"}
+        self.tag_reading_times = {1: 10.0, 3: 11.0}
+        self.distance_filter = DistanceFilter()
+        self.distance_filter.readings = {(1, 1): [], (2, 1): [], (1, 2): []}
+        self.distance_filter.reading_times = {1: 10.0, 2: 10.0}
+        self.position_filter = None
+
+def test_forget_tags():
+    "The tags that have moved are dropped from the LocMod and its filters, and the others kept."
+
+    locmod = FakeLocMod()
+    forget_tags(locmod, [1, 3])
+    assert locmod.tag_ids == set([2])
+    assert locmod.dirty_tag_ids == set()
+    assert locmod.particle_clouds == {2: "cloud"}
+    assert locmod.tag_reading_times == {}
+    assert locmod.distance_filter.readings == {(1, 2): []}
+    assert locmod.distance_filter.reading_times == {2: 10.0}
+
+if __name__ == "__main__":
+
+    test_ring_spread()
+    test_ring_add()
+    test_forget_tags()
+    print "OK"
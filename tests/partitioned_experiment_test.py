@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Checks for the partitioned experiment (experiment.partitioned_experiment): rolling over to a new shard each period,
+# ground truth carried over from shard to shard, carrying on a recording, archiving, and queries across the shards.
+# Run directly: each check asserts, and "OK" is printed at the end.
+
+import os
+import json
+import shutil
+import tempfile
+
+from Almada.clock import shared_clock as clock
+from Almada.experiment.partitioned_experiment import PartitionedExperiment, manifest_filename, archive_dirname
+from Almada.experiment.experiment_db import load_experiment
+
+hour = 3600.0
+base = 1000 * hour # The start of an hour, so the shards start on it.
+
+def record(experiment, start, end, step=600.0):
+    "A reading from tag 5 (and an estimate) every step seconds."
+
+    t = start
+    while t < end:
+        clock.pause(t)
+        experiment.add_reading(1, 5, 1.5)
+        experiment.add_estimate(5, 1.0, 2.0)
+        t += step
+
+def test_rollover(directory):
+    "Each hour is recorded to a shard of its own, with the anchors, configuration and ground truth in progress in every one."
+
+    clock.pause(base + 10)
+    experiment = PartitionedExperiment(directory, "hour")
+    experiment.add_anchor(1, (0.0, 0.0))
+    experiment.register_configuration("c")
+    experiment.start_recording(commit_interval=0.05)
+    ground_truth_id = experiment.start_ground_truth(5, "A>B", (1.0, 1.0))
+    record(experiment, base + 10, base + 3 * hour)
+    experiment.end_ground_truth(ground_truth_id, (2.0, 2.0))
+    experiment.stop_recording()
+    experiment.close() # Waits for the closed shards to be finalised.
+
+    shards = experiment.manifest["shards"]
+    assert len(shards) == 3
+    assert [shard["start_time"] for shard in shards] == [base, base + hour, base + 2 * hour]
+    assert [shard["finalised"] for shard in shards] == [True, True, False]
+
+    for shard in shards:
+        shard_experiment = load_experiment(os.path.join(directory, shard["filename"]))
+        assert shard_experiment.anchors == {1: (0.0, 0.0)}
+        assert shard_experiment.configuration_ids() == [1]
+        # The same ground truth, ended in each shard (the closed ones by the background thread).
+        assert tuple(shard_experiment.ground_truth_details(ground_truth_id)) == (u"A>B", 1.0, 1.0, 2.0, 2.0, base + 10, clock.get_time())
+        assert shard_experiment.query("SELECT COUNT(*) FROM distance_reading").fetchone()[0] == 6
+        shard_experiment.close()
+
+    assert len(list(experiment.distance_readings())) == 18
+    assert len(list(experiment.estimates(1))) == 18
+    assert [row[0] for row in experiment.query("SELECT COUNT(*) FROM distance_reading")] == [6, 6, 6]
+    assert len(experiment.query("SELECT * FROM distance_reading", (), base + hour + 10, base + hour + 20).fetchall()) == 6 # Just the shard for the time.
+    assert experiment.ground_truth_ids() == [ground_truth_id]
+    assert experiment.tag_id_for_ground_truth(ground_truth_id) == 5
+
+    positions, ids = experiment.ground_truth_at(5, [base + 100, base + 2 * hour + 100, base + 4 * hour])
+    assert ids.tolist() == [ground_truth_id, ground_truth_id, -1]
+    assert experiment.to_columns()["ground_truth"]["id"].tolist() == [ground_truth_id] # Given once, not once a shard.
+
+def test_resume(directory):
+    "Carrying on in the same directory, the anchors are kept, and new ground truth and configuration IDs follow on."
+
+    clock.pause(base + 10)
+    experiment = PartitionedExperiment(directory, "hour")
+    experiment.add_anchor(1, (0.0, 0.0))
+    experiment.register_configuration("first")
+    first_ground_truth_id = experiment.start_ground_truth(5, "A", (1.0, 1.0))
+    experiment.end_ground_truth(first_ground_truth_id)
+    experiment.stop_recording()
+    experiment.close()
+    experiment.current.close()
+
+    clock.pause(base + hour + 10)
+    experiment = PartitionedExperiment(directory, "hour")
+    assert experiment.anchors == {1: (0.0, 0.0)}
+    experiment.register_configuration("second")
+    assert experiment.configuration_id == 2
+    assert experiment.start_ground_truth(5, "B", (1.0, 1.0)) == first_ground_truth_id + 1
+    assert experiment.configuration_ids() == [1, 2]
+    experiment.close()
+
+def test_archive(directory):
+    "Shards old enough are compressed into the archive directory (with their estimates), and left out of queries."
+
+    clock.pause(base + 10)
+    experiment = PartitionedExperiment(directory, "hour", archive_after=hour)
+    experiment.add_anchor(1, (0.0, 0.0))
+    experiment.register_configuration("c")
+    record(experiment, base + 10, base + 3 * hour)
+    experiment.close()
+
+    shards = experiment.manifest["shards"]
+    assert [bool(shard["archived"]) for shard in shards] == [True, False, False]
+    assert not os.path.exists(os.path.join(directory, shards[0]["filename"]))
+    assert os.path.exists(os.path.join(directory, shards[0]["archived"]))
+    assert os.path.exists(os.path.join(directory, shards[0]["archived_estimates"]))
+    assert len(os.listdir(os.path.join(directory, archive_dirname))) == 2
+    assert not os.path.exists(os.path.join(directory, shards[0]["filename"] + ".estimates"))
+    assert json.load(open(os.path.join(directory, manifest_filename)))["shards"][0]["archived"] == shards[0]["archived"]
+    assert len(list(experiment.distance_readings())) == 12
+
+def test_readers(directory):
+    "Only max_readers shards are kept open for queries, but not at the expense of rows still being read."
+
+    clock.pause(base + 10)
+    experiment = PartitionedExperiment(directory, "hour")
+    experiment.max_readers = 2
+    experiment.add_anchor(1, (0.0, 0.0))
+    experiment.register_configuration("c")
+    record(experiment, base + 10, base + 6 * hour)
+    experiment.close()
+
+    readings = experiment.distance_readings()
+    readings.next() # The first shard is now being read.
+    assert [row[0] for row in experiment.query("SELECT COUNT(*) FROM distance_reading")] == [6] * 6
+    assert len(experiment.readers) <= experiment.max_readers + 1
+    assert 1 + len(list(readings)) == 36
+    experiment.query("SELECT COUNT(*) FROM distance_reading").fetchall()
+    assert len(experiment.readers) <= experiment.max_readers
+
+if __name__ == "__main__":
+
+    for test in [test_rollover, test_resume, test_archive, test_readers]:
+        directory = tempfile.mkdtemp()
+        try:
+            test(directory)
+        finally:
+            shutil.rmtree(directory)
+    print "OK"
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+# Checks for the recording writer (experiment.recording_writer): failed groups are rolled back and counted,
+# and a busy database is retried rather than given up on.
+# Run directly: each check asserts, and "OK" is printed at the end. Takes about 10 seconds (waiting on a lock).
+
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+
+from Almada.experiment.recording_writer import RecordingWriter
+
+def new_database(directory):
+    filename = os.path.join(directory, "writer.db")
+    connection = sqlite3.connect(filename)
+    connection.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, v)")
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.commit()
+    return filename, connection
+
+def test_failed_group_rolled_back(directory):
+    "A group that fails part way is rolled back, not committed with the next one, and its rows are counted as lost."
+
+    filename, connection = new_database(directory)
+    writer = RecordingWriter(filename, commit_interval=0.1)
+    writer.add("INSERT INTO t (v) VALUES (?)", [(1,), (2,)])
+    writer.add("INSERT INTO t (id, v) VALUES (?, ?)", [(100, 1), (100, 2)]) # Fails on the second row.
+    time.sleep(0.5)
+    writer.add("INSERT INTO t (v) VALUES (?)", [(3,)])
+    writer.close()
+
+    assert connection.execute("SELECT v FROM t").fetchall() == [(3,)]
+    assert writer.lost_rows == 4
+
+def test_busy_retried(directory):
+    "Rows written while another connection holds the write lock (for longer than the busy timeout) are written once it's released."
+
+    filename, connection = new_database(directory)
+    writer = RecordingWriter(filename, commit_interval=0.1)
+    connection.execute("BEGIN IMMEDIATE")
+    connection.execute("INSERT INTO t (v) VALUES (9)")
+    writer.add("INSERT INTO t (v) VALUES (?)", [(4,)])
+    time.sleep(7)
+    connection.commit()
+    writer.close()
+
+    assert connection.execute("SELECT v FROM t ORDER BY id").fetchall() == [(9,), (4,)]
+    assert writer.lost_rows == 0
+
+if __name__ == "__main__":
+
+    for test in [test_failed_group_rolled_back, test_busy_retried]:
+        directory = tempfile.mkdtemp()
+        try:
+            test(directory)
+        finally:
+            shutil.rmtree(directory)
+    print "OK"